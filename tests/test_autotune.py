@@ -0,0 +1,90 @@
+"""Bisection of the rotation slow factor by autotune on reports of scans with and without dropped projections."""
+
+import argparse
+
+import pytest
+
+from tomo2bm import aps2bm
+from tomo2bm import autotune
+
+NUM_PROJECTIONS = 100
+
+
+class _PV(object):
+
+    def __init__(self, pvname, value):
+        self.pvname = pvname
+        self.value = value
+        self.connection_callbacks = []
+
+    def get(self, as_string=False):
+        return self.value
+
+    def add_callback(self, callback, **kwargs):
+        pass
+
+
+def _pvs(size_x=2048, binning=1):
+    aps2bm._pv_cache.clear()
+    return {'Cam1_SizeX': _PV('test:cam1:SizeX', size_x), 'Cam1_SizeY': _PV('test:cam1:SizeY', 1200),
+            'Cam1_BinX': _PV('test:cam1:BinX', binning)}
+
+
+def _params(tmp_path, slow_factor=1.0):
+    return argparse.Namespace(camera_ioc_prefix='test:', exposure_time=0.01, logs_home=str(tmp_path),
+                              rotation_slow_factor=slow_factor, slow_factor_tolerance=0.05, slew_speed=20.0,
+                              sample_rotation_start=0.0, sample_rotation_end=180.0, file_name='000_test')
+
+
+def _scan(global_PVs, params, max_slow_factor, camera_missed=0):
+    # the scan drops projections when the rotation is faster than max_slow_factor
+    dropped = 0 if params.rotation_slow_factor <= max_slow_factor else 10
+    fly = {'triggers': NUM_PROJECTIONS, 'camera': NUM_PROJECTIONS - camera_missed, 'frames_per_projection': 1}
+    return autotune.update(global_PVs, params, fly, {'dropped': dropped + camera_missed})
+
+
+def test_converges(tmp_path):
+    global_PVs, params = _pvs(), _params(tmp_path)
+    autotune.start(global_PVs, params)
+    for scan in range(12):
+        _scan(global_PVs, params, 0.6)
+    assert 0.6 - params.slow_factor_tolerance <= params.rotation_slow_factor <= 0.6
+    assert params.slew_speed == pytest.approx(20.0 * params.rotation_slow_factor)
+    assert autotune.read_history(params)[-1]['decision'] == 'converged'
+
+
+def test_hdf_and_camera_drops(tmp_path):
+    global_PVs, params = _pvs(), _params(tmp_path)
+    autotune.start(global_PVs, params)
+    _scan(global_PVs, params, 0.6, camera_missed=2)
+    record = autotune.read_history(params)[-1]
+    assert (record['dropped'], record['hdf_dropped']) == (12, 10)
+    assert params.rotation_slow_factor < 1.0
+
+
+def test_no_report_counts_camera(tmp_path):
+    global_PVs, params = _pvs(), _params(tmp_path)
+    autotune.start(global_PVs, params)
+    fly = {'triggers': NUM_PROJECTIONS, 'camera': NUM_PROJECTIONS, 'frames_per_projection': 1}
+    assert autotune.update(global_PVs, params, fly) == 1.0
+
+
+def test_history_keyed_on_setup(tmp_path):
+    global_PVs, params = _pvs(), _params(tmp_path)
+    autotune.start(global_PVs, params)
+    for scan in range(3):
+        _scan(global_PVs, params, 0.6)
+    next_factor = params.rotation_slow_factor
+
+    params = _params(tmp_path)
+    autotune.start(_pvs(), params)
+    assert params.rotation_slow_factor == next_factor
+
+    # a binned camera or another exposure time starts over
+    params = _params(tmp_path)
+    autotune.start(_pvs(binning=2), params)
+    assert params.rotation_slow_factor == 1.0
+    params = _params(tmp_path)
+    params.exposure_time = 0.02
+    autotune.start(_pvs(), params)
+    assert params.rotation_slow_factor == 1.0
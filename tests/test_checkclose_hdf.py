@@ -0,0 +1,83 @@
+"""checkclose_hdf on an HDF plugin that writes its queue at a fixed rate."""
+
+import time
+
+from tomo2bm import flir
+
+QUEUE_SIZE = 100
+
+
+class _Plugin(object):
+
+    def __init__(self, queued, rate, closes=True):
+        self.start = time.time()
+        self.queued = queued
+        self.rate = rate
+        self.closes = closes
+        self.capture = 1
+
+    def written(self):
+        return min(int((time.time() - self.start) * self.rate), self.queued)
+
+    def capture_rbv(self):
+        if self.closes and self.written() == self.queued:
+            self.capture = 0
+        return self.capture
+
+
+class _PV(object):
+
+    pvname = 'test:HDF1'
+
+    def __init__(self, get, put=None):
+        self._get = get
+        self._put = put
+
+    def get(self, as_string=False):
+        return self._get()
+
+    def put(self, value):
+        self._put(value)
+
+    def add_callback(self, callback, **kwargs):
+        return 0
+
+    def remove_callback(self, index):
+        pass
+
+
+def _pvs(plugin):
+    return {'HDF1_QueueSize': _PV(lambda: QUEUE_SIZE),
+            'HDF1_QueueFree': _PV(lambda: QUEUE_SIZE - plugin.queued + plugin.written()),
+            'HDF1_NumCaptured_RBV': _PV(plugin.written),
+            'HDF1_Capture_RBV': _PV(plugin.capture_rbv),
+            'HDF1_Capture': _PV(None, lambda value: setattr(plugin, 'capture', value)),
+            'HDF1_FullFileName_RBV': _PV(lambda: '/tmp/000_test.h5')}
+
+
+def test_timeout_from_write_rate():
+    timeout, poll = flir._hdf_drain_timeout(50, 100.0)
+    assert timeout == flir.HDF_DRAIN_MARGIN * 0.5 + flir.HDF_DRAIN_IDLE
+    assert poll == 0.05
+    assert flir._hdf_drain_timeout(0, 100.0) == (flir.HDF_DRAIN_IDLE, flir.HDF_DRAIN_POLL_MIN)
+    assert flir._hdf_drain_timeout(50, None) == (flir.HDF_DRAIN_STALL, flir.HDF_DRAIN_POLL)
+
+
+def test_drain_measures_rate():
+    del flir._hdf_write_rates[:]
+    plugin = _Plugin(60, 40.0)
+    flir.checkclose_hdf(_pvs(plugin), None)
+    assert plugin.capture == 0
+    fullname, frames, rate = flir._hdf_write_rates[-1]
+    assert 30.0 < rate < 50.0
+
+
+def test_stalled_writer_closed_after_drain_time():
+    # the writer stops with frames queued: the file is closed once the drain time at the previous rate is over
+    del flir._hdf_write_rates[:]
+    flir._hdf_write_rates.append(('/tmp/previous.h5', 100, 100.0))
+    plugin = _Plugin(20, 0.0, closes=False)
+    start = time.time()
+    flir.checkclose_hdf(_pvs(plugin), None)
+    assert plugin.capture == 0
+    assert time.time() - start < flir.HDF_DRAIN_STALL / 2
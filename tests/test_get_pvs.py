@@ -0,0 +1,53 @@
+"""get_PVs sends the channel access reads of all the pv's, instrumented or not, before waiting for any reply."""
+
+from tomo2bm import aps2bm
+from tomo2bm import pvmetrics
+
+
+class _CA(object):
+
+    def __init__(self):
+        self.calls = []
+
+    def get(self, chid, wait=True):
+        self.calls.append(('get', chid, wait))
+
+    def poll(self):
+        self.calls.append(('poll',))
+
+    def get_complete(self, chid, as_string=False, timeout=None):
+        self.calls.append(('get_complete', chid))
+        return chid * 10.0
+
+
+class _PV(object):
+
+    auto_monitor = False
+    connected = True
+    type = 'double'
+
+    def __init__(self, chid):
+        self.chid = chid
+        self.pvname = 'test:pv%d' % chid
+
+    def get(self, as_string=False):
+        raise AssertionError('read one by one')
+
+
+class _SimPV(object):
+
+    pvname = 'test:sim'
+
+    def get(self, as_string=False):
+        return 7.0
+
+
+def test_concurrent_reads(monkeypatch):
+    ca = _CA()
+    monkeypatch.setattr(aps2bm, 'ca', ca)
+    global_PVs = {'Plain': _PV(1), 'Instrumented': pvmetrics.InstrumentedPV('Test_Instrumented', _PV(2)),
+                  'Sim': _SimPV()}
+    values = aps2bm.get_PVs(global_PVs, ['Plain', 'Instrumented', 'Sim'])
+    assert values == {'Plain': 10.0, 'Instrumented': 20.0, 'Sim': 7.0}
+    assert ca.calls == [('get', 1, False), ('get', 2, False), ('poll',), ('get_complete', 1), ('get_complete', 2)]
+    assert pvmetrics.metrics()['Test_Instrumented']['get']['count'] == 1
@@ -0,0 +1,56 @@
+"""planner.sweep and planner.best on the candidate grid, without a camera."""
+
+import numpy as np
+
+from tomo2bm import config
+from tomo2bm import planner
+
+WIDTH = 2048
+ROWS = 1200
+
+
+def _params(**values):
+    params = config.Params(sections=config.SCAN_PARAMS).get_defaults()
+    params.plan_count_rate = 0
+    for name, value in values.items():
+        setattr(params, name, value)
+    return params
+
+
+def _best(params, blur_width=None):
+    candidates = planner.sweep(params, WIDTH, ROWS, ROWS, 0.1, blur_width)
+    index = planner.best(candidates)
+    return candidates, index
+
+
+def test_best_is_fastest_feasible():
+    candidates, index = _best(_params())
+    assert candidates['feasible'][index]
+    feasible = candidates['feasible']
+    assert candidates['total_time'][index] <= np.round(candidates['total_time'][feasible], 3).min() + 1e-3
+
+
+def test_constraints():
+    params = _params()
+    candidates, index = _best(params)
+    assert candidates['blur'][index] <= params.plan_max_blur
+    assert candidates['sampling'][index] >= params.plan_min_sampling
+
+    # the counts need longer exposures
+    params = _params(plan_count_rate=1000.0, plan_min_counts=100.0)
+    count_candidates, count_index = _best(params)
+    assert count_candidates['counts'][count_index] >= params.plan_min_counts
+    assert count_candidates['exposure_time'][count_index] > candidates['exposure_time'][index]
+
+
+def test_blur_at_the_sensor_edge():
+    # the blur at a wider sensor edge slows the planned rotation down
+    candidates, index = _best(_params())
+    edge_candidates, edge_index = _best(_params(), 2 * WIDTH)
+    assert edge_candidates['blur'][edge_index] <= _params().plan_max_blur
+    assert edge_candidates['total_time'][edge_index] > candidates['total_time'][index]
+
+
+def test_nothing_feasible():
+    candidates, index = _best(_params(plan_max_blur=0.0))
+    assert index is None
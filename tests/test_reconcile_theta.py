@@ -0,0 +1,88 @@
+"""reconcile_theta on HDF files written like the ones of the HDF plugin, with frames dropped."""
+
+import h5py
+import numpy as np
+
+from tomo2bm import flir
+
+NUM_TRIGGERS = 20
+PERIOD = 0.05
+FIRST_ID = 101
+
+
+def _fly(camera=NUM_TRIGGERS, first_id=FIRST_ID):
+    return {'triggers': NUM_TRIGGERS, 'camera': camera, 'positions': np.arange(NUM_TRIGGERS) * 9.0,
+            'period': PERIOD, 'frames_per_projection': 1, 'first_id': first_id}
+
+
+def _write(fname, saved, camera_missed=()):
+    # saved: trigger indices of the frames in the file; the camera gives ids only to the triggers it did not miss
+    ids = {}
+    for trigger in range(NUM_TRIGGERS):
+        if trigger not in camera_missed:
+            ids[trigger] = FIRST_ID + len(ids)
+    with h5py.File(fname, 'w') as f:
+        f.create_dataset('/exchange/data', (len(saved), 2, 2), dtype=np.uint16)
+        f['/defaults/NDArrayTimeStamp'] = 1000.0 + PERIOD * np.asarray(saved, dtype=float)
+        f['/defaults/NDArrayUniqueId'] = np.array([ids[trigger] for trigger in saved])
+    return str(fname)
+
+
+def _theta_index(fname):
+    with h5py.File(fname, 'r') as f:
+        return f['/exchange/theta_index'][:], f['/exchange/theta'][:]
+
+
+def test_all_frames(tmp_path):
+    fname = _write(tmp_path / 'scan.h5', range(NUM_TRIGGERS))
+    report = flir.reconcile_theta(fname, _fly())
+    index, theta = _theta_index(fname)
+    assert report['dropped'] == 0
+    assert np.array_equal(index, np.arange(NUM_TRIGGERS))
+    assert np.allclose(theta, np.arange(NUM_TRIGGERS) * 9.0)
+
+
+def test_first_frames_dropped(tmp_path):
+    saved = list(range(3, NUM_TRIGGERS))
+    fname = _write(tmp_path / 'scan.h5', saved)
+    report = flir.reconcile_theta(fname, _fly())
+    index, theta = _theta_index(fname)
+    assert report['dropped'] == 3
+    assert np.array_equal(index, saved)
+    assert np.allclose(theta, np.array(saved) * 9.0)
+
+
+def test_middle_frames_dropped(tmp_path):
+    saved = [t for t in range(NUM_TRIGGERS) if t not in (5, 6, 12)]
+    fname = _write(tmp_path / 'scan.h5', saved)
+    report = flir.reconcile_theta(fname, _fly())
+    index, _ = _theta_index(fname)
+    assert report['dropped'] == 3
+    assert np.array_equal(index, saved)
+
+
+def test_first_and_middle_frames_dropped(tmp_path):
+    saved = [t for t in range(NUM_TRIGGERS) if t not in (0, 1, 9)]
+    fname = _write(tmp_path / 'scan.h5', saved)
+    flir.reconcile_theta(fname, _fly())
+    index, _ = _theta_index(fname)
+    assert np.array_equal(index, saved)
+
+
+def test_camera_missed_middle_trigger(tmp_path):
+    # the camera ids are contiguous, only the time stamps show the missed trigger
+    saved = [t for t in range(NUM_TRIGGERS) if t != 7]
+    fname = _write(tmp_path / 'scan.h5', saved, camera_missed=(7,))
+    report = flir.reconcile_theta(fname, _fly(camera=NUM_TRIGGERS - 1))
+    index, _ = _theta_index(fname)
+    assert report['dropped'] == 1
+    assert np.array_equal(index, saved)
+
+
+def test_without_first_id(tmp_path):
+    # fly counters of an older scan: the index starts at the first saved frame
+    saved = list(range(NUM_TRIGGERS))
+    fname = _write(tmp_path / 'scan.h5', saved)
+    flir.reconcile_theta(fname, _fly(first_id=None))
+    index, _ = _theta_index(fname)
+    assert np.array_equal(index, saved)
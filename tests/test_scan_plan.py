@@ -0,0 +1,97 @@
+"""compile_plan and mosaic_tiles on the simulated 2-BM IOC."""
+
+import pytest
+
+from tomo2bm import aps2bm
+from tomo2bm import config
+from tomo2bm import scan
+
+
+@pytest.fixture
+def sim():
+    params = config.Params(sections=config.SCAN_PARAMS).get_defaults()
+    params.pv_backend = 'sim'
+    params.sleep_steps = 1
+    global_PVs = aps2bm.init_general_PVs(params)
+    speeds = {name: global_PVs[name].get() for name in ('Motor_SampleX_Velo', 'Motor_SampleY_Velo', 'Motor_SampleRot_Velo')}
+    global_PVs['Sample_Name'].put('sim')
+    yield global_PVs, params
+    for name, value in speeds.items():
+        global_PVs[name].put(value)
+
+
+def test_file_names(sim):
+    global_PVs, params = sim
+    params.sleep_steps = 3
+    global_PVs['HDF1_FileNumber'].put(998)
+    plan = scan.compile_plan(global_PVs, params, 'standard')
+    assert [entry['file_name'] for entry in plan] == ['998_sim', '999_sim', '1000_sim']
+    assert all(entry['suffix'] == '_sim' for entry in plan)
+
+
+def test_mosaic_file_names(sim):
+    global_PVs, params = sim
+    global_PVs['HDF1_FileNumber'].put(7)
+    params.vertical_scan_end = params.horizontal_scan_end = 1
+    plan = scan.compile_plan(global_PVs, params, 'mosaic')
+    assert plan[0]['file_name'] == '007_sim_y0_x0'
+    assert sorted(entry['suffix'] for entry in plan) == ['_sim_y0_x0', '_sim_y0_x1', '_sim_y1_x0', '_sim_y1_x1']
+
+
+def test_bidirectional_order(sim):
+    global_PVs, params = sim
+    params.bidirectional = True
+    params.sleep_steps = 4
+    global_PVs['Motor_SampleRot_Velo'].put(1000.0)
+    global_PVs['Motor_SampleRot'].put(params.sample_rotation_start, wait=True)
+    plan = scan.compile_plan(global_PVs, params, 'standard')
+    assert [entry['backward'] for entry in plan] == [False, True, False, True]
+
+    # a series left at the end of the rotation by the last one starts backward
+    global_PVs['Motor_SampleRot'].put(params.sample_rotation_end, wait=True)
+    plan = scan.compile_plan(global_PVs, params, 'standard')
+    assert [entry['backward'] for entry in plan] == [True, False, True, False]
+
+
+def test_reverse_follows_file_number(sim):
+    global_PVs, params = sim
+    params.reverse = 'True'
+    params.sleep_steps = 3
+    global_PVs['HDF1_FileNumber'].put(5)
+    plan = scan.compile_plan(global_PVs, params, 'standard')
+    assert [entry['backward'] for entry in plan] == [True, False, True]
+
+
+def _grid(order):
+    return [(v, h) for v, y, h, x, row_start in order]
+
+
+def test_mosaic_orders(sim):
+    global_PVs, params = sim
+    ys, xs = [0.0, 1.0], [0.0, 1.0, 2.0]
+
+    params.mosaic_order = 'raster'
+    tiles = scan.mosaic_tiles(global_PVs, params, ys, xs)
+    assert _grid(tiles) == [(0, 0), (0, 1), (0, 2), (1, 0), (1, 1), (1, 2)]
+    assert [row_start for v, y, h, x, row_start in tiles] == [True, False, False, True, False, False]
+
+    params.mosaic_order = 'serpentine'
+    assert _grid(scan.mosaic_tiles(global_PVs, params, ys, xs)) == [(0, 0), (0, 1), (0, 2), (1, 2), (1, 1), (1, 0)]
+
+
+def test_mosaic_travel_order(sim):
+    global_PVs, params = sim
+    params.mosaic_order = 'travel'
+
+    # slow Y: serpentine by rows
+    global_PVs['Motor_SampleX_Velo'].put(10.0)
+    global_PVs['Motor_SampleY_Velo'].put(0.1)
+    tiles = scan.mosaic_tiles(global_PVs, params, [0.0, 1.0], [0.0, 1.0, 2.0])
+    assert _grid(tiles) == [(0, 0), (0, 1), (0, 2), (1, 2), (1, 1), (1, 0)]
+
+    # slow X: serpentine by columns
+    global_PVs['Motor_SampleX_Velo'].put(0.1)
+    global_PVs['Motor_SampleY_Velo'].put(10.0)
+    tiles = scan.mosaic_tiles(global_PVs, params, [0.0, 1.0, 2.0], [0.0, 1.0])
+    assert _grid(tiles) == [(0, 0), (1, 0), (2, 0), (2, 1), (1, 1), (0, 1)]
+    assert [row_start for v, y, h, x, row_start in tiles] == [True, False, False, True, False, False]
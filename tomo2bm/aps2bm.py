@@ -47,10 +47,17 @@
 Epics PV definition for Sector 2-BM.
 """
 
+import math
 import time
+import threading
+import collections
 
 from epics import PV
+from epics import ca
 from tomo2bm import log
+from tomo2bm import sim2bm
+from tomo2bm import pvmetrics
+from tomo2bm import motion
 
 TESTING = False
 
@@ -64,36 +71,172 @@ ShutterB_Close_Value = 0
 Recursive_Filter_Type = 'RecursiveAve'
 
 EPSILON = 0.1
+CONNECT_TIMEOUT = 5.0         # s, default deadline for connecting all pv's
+MONITOR_REFRESH = 1.0         # s, wait_pv re-reads the pvs at this period if no monitor arrives
+PUT_TIMEOUT = 10.0            # s, default time for a group of puts to complete
+GET_TIMEOUT = 5.0             # s, default time for a group of gets to complete
+MOVE_TIMEOUT = 1000.0         # s, time for a group of motor moves to complete when their speed is not known
+PSO_CALC_TIMEOUT = 3.0        # s, max time for the PSO controller to update the number of triggers
+
+SHUTTER_TIMEOUT = 30.0        # s, max time for the fast shutter motor to complete its move
+SHUTTER_SLOW_FACTOR = 3.0     # a shutter is slow when it takes longer than this times its slowest recorded time
+SHUTTER_HISTORY = 50          # number of open/close times kept for each shutter
+
+# s a shutter move is given at least, from the command to a settled shutter: the fixed delays of the shutter
+# moves before the history, including the 2 s before the dark fields after closing
+SHUTTER_SETTLE = {('A', 'open'): 3.0, ('A', 'close'): 2.0, ('fast', 'open'): 1.0, ('fast', 'close'): 3.0,
+                  ('B', 'open'): 0.0, ('B', 'close'): 2.0}
+
+# open/close times of each shutter, keyed by (shutter, action)
+_shutter_times = {}
+
+# pv's that change during a scan, or are waited on, and are always read from the IOC by cached_get
+NEVER_CACHE = frozenset((
+    'Cam1_Acquire', 'Cam1_SoftwareTrigger', 'Cam1_Image', 'Cam1_ArrayCounter', 'Cam1_ArrayCounter_RBV', 'Cam1_NumImagesCounter', 'Cam1_FrameType', 'Cam1_NumImages', 'Cam1_TriggerMode', 'Cam1_ImageMode',
+    'HDF1_Capture', 'HDF1_Capture_RBV', 'HDF1_FileNumber', 'HDF1_QueueFree', 'HDF1_NumCaptured_RBV', 'HDF1_DroppedArrays_RBV', 'HDF1_FullFileName_RBV',
+    'Fly_Run', 'Fly_Taxi', 'Fly_Calc_Projections', 'Theta_Array', 'Theta_Cnt',
+    'ShutterA_Move_Status', 'ShutterB_Move_Status', 'Fast_Shutter',
+    'Motor_SampleX', 'Motor_SampleX_RBV', 'Motor_SampleY', 'Motor_SampleY_RBV', 'Motor_SampleRot', 'Motor_SampleRot_RBV',
+    'Time',
+    ))
+
+# last value of the pv's read by cached_get, kept up to date by their monitors: {(pvname, as_string): value}
+_pv_cache = {}
+_pv_cache_monitored = set()
+_pv_cache_stats = {'hits': 0, 'misses': 0, 'uncached': 0, 'invalidated': 0}
+
+# connected pv dictionaries shared by the whole process, keyed by (pv_backend, station, camera_ioc_prefix)
+_pv_pool = {}
+_pv_pool_stats = {'hits': 0, 'misses': 0, 'reconnects': 0}
+
+
+def _pv_matches(pv_val, wait_val):
+
+    # float readbacks (motor positions, ...) only need to be within EPSILON
+    if type(pv_val) == float:
+        if abs(pv_val - wait_val) < EPSILON:
+            return True
+    return pv_val == wait_val
 
 
 def wait_pv(pv, wait_val, max_timeout_sec=-1):
 
     # wait on a pv to be a value until max_timeout (default forever)   
+    return wait_pvs([(pv, wait_val)], max_timeout_sec)
+
+
+def wait_pvs(pv_vals, max_timeout_sec=-1):
+
+    # wait on several (pv, value) pairs to all reach their value until max_timeout (default forever).
+    # The wait is driven by the pv monitor callbacks so the thread sleeps until one of the pvs posts
+    # a new value; the values are read again every MONITOR_REFRESH s in case a monitor is missed.
     # delay for pv to change
     time.sleep(.01)
     startTime = time.time()
-    while(True):
-        pv_val = pv.get()
-        if type(pv_val) == float:
-            if abs(pv_val - wait_val) < EPSILON:
+
+    changed = threading.Event()
+    values = [None] * len(pv_vals)
+
+    def on_change(value=None, position=None, **kws):
+        values[position] = value
+        changed.set()
+
+    indexes = [pv.add_callback(on_change, with_ctrlvars=False, position=position) for position, (pv, wait_val) in enumerate(pv_vals)]
+    try:
+        refresh = True
+        while(True):
+            if refresh:
+                for position, (pv, wait_val) in enumerate(pv_vals):
+                    values[position] = pv.get()
+            changed.clear()
+            pending = [(pv, wait_val) for (pv, wait_val), pv_val in zip(pv_vals, values) if not _pv_matches(pv_val, wait_val)]
+            if not pending:
+                _record_waits(pv_vals, startTime, [])
                 return True
-        if (pv_val != wait_val):
+            wait_sec = MONITOR_REFRESH
             if max_timeout_sec > -1:
                 curTime = time.time()
                 diffTime = curTime - startTime
                 if diffTime >= max_timeout_sec:
                     log.error('  *** ERROR: DROPPED IMAGES ***')
-                    log.error('  *** wait_pv(%s, %d, %5.2f reached max timeout. Return False' % (pv.pvname, wait_val, max_timeout_sec))
+                    for pv, wait_val in pending:
+                        log.error('  *** wait_pv(%s, %s, %5.2f reached max timeout. Return False' % (pv.pvname, wait_val, max_timeout_sec))
+                    _record_waits(pv_vals, startTime, pending)
+                    return False
+                wait_sec = min(wait_sec, max_timeout_sec - diffTime)
+            refresh = not changed.wait(wait_sec)
+    finally:
+        for (pv, wait_val), index in zip(pv_vals, indexes):
+            pv.remove_callback(index)
 
 
-                    return False
-            time.sleep(.01)
-        else:
-            return True
+def _record_waits(pv_vals, startTime, pending):
+
+    # wait time of the instrumented pv's, see pvmetrics
+    elapsed = time.time() - startTime
+    for pv, wait_val in pv_vals:
+        if isinstance(pv, pvmetrics.InstrumentedPV):
+            pv.record_wait(elapsed, (pv, wait_val) in pending)
 
 
 def init_general_PVs(params):
 
+    # pv's are pooled by station and camera so that repeated calls (e.g. by each sphere alignment
+    # step) hand back the already connected channels instead of creating and connecting them again
+    pool_key = (params.pv_backend, params.station, params.camera_ioc_prefix)
+    global_PVs = _pv_pool.get(pool_key)
+    if global_PVs is not None:
+        _pv_pool_stats['hits'] += 1
+        disconnected = {name: pv for name, pv in global_PVs.items() if not pv.connected}
+        if disconnected:
+            log.warning('  *** %d pooled PVs are disconnected: reconnecting' % len(disconnected))
+            report = connect_PVs(disconnected, params.pv_connect_timeout)
+            _pv_pool_stats['reconnects'] += len(report['connected'])
+            log_connect_report(report)
+        if params.pv_metrics:
+            pvmetrics.instrument(global_PVs)
+        return global_PVs
+
+    _pv_pool_stats['misses'] += 1
+    global_PVs = _create_general_PVs(params)
+    if global_PVs is None:
+        return None
+
+    report = connect_PVs(global_PVs, params.pv_connect_timeout)
+    log_connect_report(report)
+    if params.pv_metrics:
+        pvmetrics.instrument(global_PVs)
+    _pv_pool[pool_key] = global_PVs
+
+    return global_PVs
+
+
+def pv_pool_stats():
+
+    stats = dict(_pv_pool_stats)
+    stats['pools'] = len(_pv_pool)
+    stats['pvs'] = sum(len(global_PVs) for global_PVs in _pv_pool.values())
+    return stats
+
+
+def log_pv_pool_stats():
+
+    stats = pv_pool_stats()
+    log.info('  *** PV pool: %d hits, %d misses, %d reconnects (%d PVs in %d pools)' % (stats['hits'], stats['misses'], stats['reconnects'], stats['pvs'], stats['pools']))
+
+
+def pv_backend(params):
+
+    # class used to create the pv's: pyepics or the in-process simulated 2-BM IOC
+    if params.pv_backend == 'sim':
+        log.warning('*** Using the simulated 2-BM IOC')
+        return sim2bm.PV
+    return PV
+
+
+def _create_general_PVs(params):
+
+    PV = pv_backend(params)
     global_PVs = {}
 
     # shutter pv's
@@ -163,7 +306,13 @@ def init_general_PVs(params):
         # Set sample stack motor pv's:
         global_PVs['Motor_SampleX'] = PV('2bma:m49.VAL')
         global_PVs['Motor_SampleX_SET'] = PV('2bma:m49.SET')
+        global_PVs['Motor_SampleX_RBV'] = PV('2bma:m49.RBV')
+        global_PVs['Motor_SampleX_Velo'] = PV('2bma:m49.VELO')
+        global_PVs['Motor_SampleX_Accl'] = PV('2bma:m49.ACCL')
         global_PVs['Motor_SampleY'] = PV('2bma:m20.VAL')
+        global_PVs['Motor_SampleY_RBV'] = PV('2bma:m20.RBV')
+        global_PVs['Motor_SampleY_Velo'] = PV('2bma:m20.VELO')
+        global_PVs['Motor_SampleY_Accl'] = PV('2bma:m20.ACCL')
         global_PVs['Motor_SampleRot'] = PV('2bma:m82.VAL') # Aerotech ABR-250
         global_PVs['Motor_SampleRot_RBV'] = PV('2bma:m82.RBV') # Aerotech ABR-250
         global_PVs['Motor_SampleRot_Cnen'] = PV('2bma:m82.CNEN') 
@@ -186,6 +335,7 @@ def init_general_PVs(params):
         global_PVs['Fly_ScanControl'] = PV('2bma:PSOFly2:scanControl')
         global_PVs['Fly_Calc_Projections'] = PV('2bma:PSOFly2:numTriggers')
         global_PVs['Theta_Array'] = PV('2bma:PSOFly2:motorPos.AVAL')
+        global_PVs['Theta_Cnt'] = PV('2bma:PSOFly2:motorPos.NORD')
 
         global_PVs['Fast_Shutter'] = PV('2bma:m23.VAL')
         global_PVs['Motor_Focus'] = PV('2bma:m41.VAL')
@@ -196,7 +346,13 @@ def init_general_PVs(params):
         # Sample stack motor pv's:
         global_PVs['Motor_SampleX'] = PV('2bmb:m63.VAL')
         global_PVs['Motor_SampleX_SET'] = PV('2bmb:m63.SET')
+        global_PVs['Motor_SampleX_RBV'] = PV('2bmb:m63.RBV')
+        global_PVs['Motor_SampleX_Velo'] = PV('2bmb:m63.VELO')
+        global_PVs['Motor_SampleX_Accl'] = PV('2bmb:m63.ACCL')
         global_PVs['Motor_SampleY'] = PV('2bmb:m57.VAL') 
+        global_PVs['Motor_SampleY_RBV'] = PV('2bmb:m57.RBV')
+        global_PVs['Motor_SampleY_Velo'] = PV('2bmb:m57.VELO')
+        global_PVs['Motor_SampleY_Accl'] = PV('2bmb:m57.ACCL')
         global_PVs['Motor_SampleRot'] = PV('2bmb:m100.VAL') # Aerotech ABR-150
         global_PVs['Motor_SampleRot_Accl'] = PV('2bma:m100.ACCL') 
         global_PVs['Motor_SampleRot_Stop'] = PV('2bma:m100.STOP') 
@@ -218,6 +374,7 @@ def init_general_PVs(params):
         global_PVs['Fly_ScanControl'] = PV('2bmb:PSOFly:scanControl')
         global_PVs['Fly_Calc_Projections'] = PV('2bmb:PSOFly:numTriggers')
         global_PVs['Theta_Array'] = PV('2bmb:PSOFly:motorPos.AVAL')
+        global_PVs['Theta_Cnt'] = PV('2bmb:PSOFly:motorPos.NORD')
 
         global_PVs['Motor_Focus'] = PV('2bmb:m78.VAL')
         global_PVs['Motor_Focus_Name'] = PV('2bmb:m78.DESC')
@@ -248,6 +405,8 @@ def init_general_PVs(params):
 
         global_PVs['Cam1_SizeX'] = PV(params.camera_ioc_prefix + 'cam1:SizeX')
         global_PVs['Cam1_SizeY'] = PV(params.camera_ioc_prefix + 'cam1:SizeY')
+        global_PVs['Cam1_BinX'] = PV(params.camera_ioc_prefix + 'cam1:BinX')
+        global_PVs['Cam1_BinY'] = PV(params.camera_ioc_prefix + 'cam1:BinY')
         global_PVs['Cam1_SizeX_RBV'] = PV(params.camera_ioc_prefix + 'cam1:SizeX_RBV')
         global_PVs['Cam1_SizeY_RBV'] = PV(params.camera_ioc_prefix + 'cam1:SizeY_RBV')
         global_PVs['Cam1_MaxSizeX_RBV'] = PV(params.camera_ioc_prefix + 'cam1:MaxSizeX_RBV')
@@ -255,6 +414,9 @@ def init_general_PVs(params):
         global_PVs['Cam1PixelFormat_RBV'] = PV(params.camera_ioc_prefix + 'cam1:PixelFormat_RBV')
 
         global_PVs['Cam1_Image'] = PV(params.camera_ioc_prefix + 'image1:ArrayData')
+        global_PVs['Cam1_ArrayCounter'] = PV(params.camera_ioc_prefix + 'image1:ArrayCounter_RBV')
+        global_PVs['Cam1_ArrayCounter_RBV'] = PV(params.camera_ioc_prefix + 'cam1:ArrayCounter_RBV')
+        global_PVs['Cam1_NumImagesCounter'] = PV(params.camera_ioc_prefix + 'cam1:NumImagesCounter_RBV')
 
         # hdf5 writer PV's
         global_PVs['HDF1_AutoSave'] = PV(params.camera_ioc_prefix + 'HDF1:AutoSave')
@@ -275,6 +437,9 @@ def init_general_PVs(params):
 
         global_PVs['HDF1_QueueSize'] = PV(params.camera_ioc_prefix + 'HDF1:QueueSize')
         global_PVs['HDF1_QueueFree'] = PV(params.camera_ioc_prefix + 'HDF1:QueueFree')
+        global_PVs['HDF1_NumCaptured_RBV'] = PV(params.camera_ioc_prefix + 'HDF1:NumCaptured_RBV')
+        global_PVs['HDF1_DroppedArrays'] = PV(params.camera_ioc_prefix + 'HDF1:DroppedArrays')
+        global_PVs['HDF1_DroppedArrays_RBV'] = PV(params.camera_ioc_prefix + 'HDF1:DroppedArrays_RBV')
                                                                       
         # proc1 PV's
         global_PVs['Image1_Callbacks'] = PV(params.camera_ioc_prefix + 'image1:EnableCallbacks')
@@ -313,16 +478,221 @@ def init_general_PVs(params):
     return global_PVs
 
 
+def connect_PVs(global_PVs, timeout=CONNECT_TIMEOUT):
+
+    # The channel searches of all pv's are sent as soon as the PV objects are created so waiting
+    # on each pv against a single deadline connects them in parallel: the connection phase lasts
+    # as long as the slowest pv (or timeout for a dead IOC), not the sum of all of them.
+    # Returns a report with the connection time of each pv and the list of pv's that failed.
+    startTime = time.time()
+    deadline = startTime + timeout
+    connect_times = {}
+
+    def on_connect(pvname=None, conn=None, **kws):
+        if conn:
+            connect_times.setdefault(pvname, time.time())
+
+    for pv in global_PVs.values():
+        pv.connection_callbacks.append(on_connect)
+    try:
+        for pv in global_PVs.values():
+            pv.wait_for_connection(timeout=max(deadline - time.time(), 0))
+    finally:
+        for pv in global_PVs.values():
+            pv.connection_callbacks.remove(on_connect)
+
+    report = {'connected': {}, 'failed': {}, 'time': time.time() - startTime}
+    for name, pv in global_PVs.items():
+        if pv.connected:
+            # pv's connected before the connection phase started count as 0 s
+            report['connected'][name] = max(connect_times.get(pv.pvname, startTime) - startTime, 0)
+        else:
+            report['failed'][name] = pv.pvname
+
+    return report
+
+
+def log_connect_report(report):
+
+    connected = report['connected']
+    num_pvs = len(connected) + len(report['failed'])
+    if connected:
+        slowest = max(connected, key=connected.get)
+        log.info('  *** Connected %d/%d PVs in %4.2f s (slowest: %s %4.2f s)' % (len(connected), num_pvs, report['time'], slowest, connected[slowest]))
+    for name, pvname in sorted(report['failed'].items()):
+        log.error('  *** PV %s (%s) did not connect' % (name, pvname))
+
+
+def put_PVs(global_PVs, values, timeout=PUT_TIMEOUT):
+
+    # write several pv's at once: all the puts are sent before waiting for any of them to complete.
+    # values is a {pv name: value} dictionary; returns {pv name: time (s) to complete the put, None if it did not}
+    tic = time.time()
+    completed = dict((name, threading.Event()) for name in values)
+    put_times = dict((name, None) for name in values)
+
+    def on_complete(data=None, **kws):
+        put_times[data] = time.time() - tic
+        completed[data].set()
+
+    for name, value in values.items():
+        invalidate_cache(global_PVs[name].pvname)
+        global_PVs[name].put(value, callback=on_complete, callback_data=name)
+
+    deadline = tic + timeout
+    for name, event in completed.items():
+        if not event.wait(max(deadline - time.time(), 0)):
+            log.error('  *** put %s = %s did not complete in %3.1f s' % (name, values[name], timeout))
+            if isinstance(global_PVs[name], pvmetrics.InstrumentedPV):
+                global_PVs[name].record('put', time.time() - tic, True)
+    return put_times
+
+
+def cached_get(global_PVs, name, as_string=False):
+
+    # read a slowly changing pv: the first read subscribes to its monitor, which keeps the cached value up
+    # to date, so the following reads cost no network round trip. The pv's in NEVER_CACHE are always read
+    # from the IOC. The cached value is dropped when the pv disconnects or is written by put_PVs.
+    pv = global_PVs[name]
+    if name in NEVER_CACHE:
+        _pv_cache_stats['uncached'] += 1
+        return pv.get(as_string=as_string)
+
+    key = (pv.pvname, as_string)
+    if key in _pv_cache:
+        _pv_cache_stats['hits'] += 1
+        return _pv_cache[key]
+
+    _pv_cache_stats['misses'] += 1
+    if pv.pvname not in _pv_cache_monitored:
+        _pv_cache_monitored.add(pv.pvname)
+        pv.add_callback(_update_cache, with_ctrlvars=False)
+        pv.connection_callbacks.append(_invalidate_cache)
+    value = pv.get(as_string=as_string)
+    if value is not None:
+        _pv_cache[key] = value
+    return value
+
+
+def _update_cache(pvname=None, value=None, char_value=None, **kws):
+
+    if (pvname, False) in _pv_cache:
+        _pv_cache[(pvname, False)] = value
+    if (pvname, True) in _pv_cache:
+        _pv_cache[(pvname, True)] = char_value
+
+
+def _invalidate_cache(pvname=None, conn=True, **kws):
+
+    if not conn:
+        invalidate_cache(pvname)
+
+
+def invalidate_cache(pvname):
+
+    for as_string in (False, True):
+        if _pv_cache.pop((pvname, as_string), None) is not None:
+            _pv_cache_stats['invalidated'] += 1
+
+
+def pv_cache_stats():
+
+    stats = dict(_pv_cache_stats)
+    reads = stats['hits'] + stats['misses']
+    stats['hit_rate'] = stats['hits'] / reads if reads else 0.0
+    stats['pvs'] = len(_pv_cache)
+    return stats
+
+
+def log_pv_cache_stats():
+
+    stats = pv_cache_stats()
+    log.info('  *** PV cache: %d hits, %d misses (hit rate %3.1f %%), %d uncached reads, %d invalidated, %d values cached' \
+                % (stats['hits'], stats['misses'], 100 * stats['hit_rate'], stats['uncached'], stats['invalidated'], stats['pvs']))
+
+
+def put_PVs_ordered(global_PVs, stages, timeout=PUT_TIMEOUT):
+
+    # write groups of pv's one after the other: the pv's of each {pv name: value} stage are written together
+    # with put_PVs and the next stage starts once all of them completed, e.g. to keep the camera trigger mode
+    # off while the trigger settings change. Returns {pv name: time (s) to complete the put, None if it did not}
+    put_times = {}
+    for values in stages:
+        put_times.update(put_PVs(global_PVs, values, timeout))
+    return put_times
+
+
+def get_PVs(global_PVs, names, as_string=False, timeout=GET_TIMEOUT):
+
+    # read several pv's at once: the read requests of all the pv's are sent before waiting for any reply,
+    # so the group costs one network round trip. Any pv with a channel access channel is read this way,
+    # including the instrumented ones of pvmetrics, which record the time to their reply. Monitored pv's
+    # already hold their value and are read directly, as are the pv's of the sim backend (no channel).
+    # Returns {pv name: value, None if it did not arrive}
+    values = {}
+    pending = []
+    tic = time.time()
+    for name in names:
+        pv = global_PVs[name]
+        chid = getattr(pv, 'chid', None)
+        if (chid is None) or pv.auto_monitor or (as_string and pv.type in ('enum', 'ctrl_enum', 'time_enum')):
+            values[name] = pv.get(as_string=as_string)
+        elif pv.connected:
+            ca.get(chid, wait=False)
+            pending.append(name)
+        else:
+            values[name] = None
+    ca.poll()
+    for name in pending:
+        pv = global_PVs[name]
+        values[name] = ca.get_complete(pv.chid, as_string=as_string, timeout=timeout)
+        if isinstance(pv, pvmetrics.InstrumentedPV):
+            pv.record_get(time.time() - tic, values[name])
+    return values
+
+
+def move_motors(global_PVs, positions, timeout=None):
+
+    # start all the motors together and wait for all of them to be done, so the move lasts as long as the
+    # slowest axis. positions is a {motor pv name: position} dictionary; returns {motor pv name: (move time (s),
+    # position error)}. The error is measured on the motor readback (motor pv name + '_RBV') when defined.
+    # The timeout defaults to the one of the slowest move predicted by the motion model, and the measured
+    # move times calibrate the model.
+    model_times = motion.move_model_times(global_PVs, positions)
+    if timeout is None:
+        predicted = [motion.predict(name, model_time) for name, model_time in model_times.items() if model_time is not None]
+        timeout = MOVE_TIMEOUT
+        if len(predicted) == len(positions):
+            timeout = motion.timeout(max(predicted), MOVE_TIMEOUT)
+    put_times = put_PVs(global_PVs, dict((name, float(position)) for name, position in positions.items()), timeout)
+    for name, model_time in model_times.items():
+        motion.calibrate(name, model_time, put_times[name])
+
+    moves = {}
+    for name, position in positions.items():
+        readback = global_PVs.get(name + '_RBV', global_PVs[name]).get()
+        error = readback - float(position) if readback is not None else None
+        moves[name] = (put_times[name], error)
+        if (put_times[name] is None) or (error is None) or (abs(error) >= EPSILON):
+            log.error('%s did not move in properly' % name)
+            log.error(str(readback))
+        else:
+            log.info('      *** *** %s at %f in %4.2f s (error %f)' % (name, float(position), put_times[name], error))
+    return moves
+
+
 def user_info_params_update_from_pv(global_PVs, params):
 
-    params.proposal_title = global_PVs['Proposal_Title'].get(as_string=True)
-    params.user_email = global_PVs['User_Email'].get(as_string=True)
-    params.user_badge = global_PVs['User_Badge'].get(as_string=True)
-    params.user_last_name = global_PVs['User_Last_Name'].get(as_string=True)
-    params.proposal_number = global_PVs['Proposal_Number'].get(as_string=True)
-    params.user_institution = global_PVs['User_Institution'].get(as_string=True)
-    params.experiment_year_month = global_PVs['Experiment_Year_Month'].get(as_string=True)
-    params.user_info_update = global_PVs['User_Info_Update'].get(as_string=True)
+    values = get_PVs(global_PVs, ['Proposal_Title', 'User_Email', 'User_Badge', 'User_Last_Name', 'Proposal_Number',
+                                  'User_Institution', 'Experiment_Year_Month', 'User_Info_Update'], as_string=True)
+    params.proposal_title = values['Proposal_Title']
+    params.user_email = values['User_Email']
+    params.user_badge = values['User_Badge']
+    params.user_last_name = values['User_Last_Name']
+    params.proposal_number = values['Proposal_Number']
+    params.user_institution = values['User_Institution']
+    params.experiment_year_month = values['Experiment_Year_Month']
+    params.user_info_update = values['User_Info_Update']
 
 
 def image_resolution_pv_update(global_PVs, params):
@@ -335,6 +705,66 @@ def image_resolution_pv_update(global_PVs, params):
         global_PVs['Lens_Magnification'].put(params.lens_magnification, wait=True)
 
 
+def _move_shutter(global_PVs, shutter, action, command, value, status=None, status_value=None):
+
+    # send the open/close command and wait for the shutter readback: the status pv when there is one,
+    # otherwise the put completion of the fast shutter motor. A readback is not a settled shutter, so the
+    # move is then given at least its SHUTTER_SETTLE delay, longer when the slowest readback of the shutter
+    # history took longer. The time to the readback is kept in the history and flagged when much longer than
+    # the slowest time recorded so far.
+    tic = time.time()
+    if status is None:
+        done = put_PVs(global_PVs, {command: value}, SHUTTER_TIMEOUT)[command] is not None
+    else:
+        global_PVs[command].put(value, wait=True)
+        done = wait_pv(global_PVs[status], status_value)
+    move_time = time.time() - tic
+
+    history = _shutter_times.setdefault((shutter, action), collections.deque(maxlen=SHUTTER_HISTORY))
+    if history and move_time > SHUTTER_SLOW_FACTOR * max(history):
+        log.warning('  *** shutter %s was slow to %s: %4.2f s (max so far %4.2f s)' % (shutter, action, move_time, max(history)))
+    settle = _shutter_move_time(shutter, action) - move_time
+    if settle > 0:
+        time.sleep(settle)
+    if done:
+        history.append(move_time)
+    log.info('  *** %s_shutter %s: Done! (%4.2f s)' % (action, shutter, time.time() - tic))
+
+
+def shutter_time(params):
+
+    # predicted time of opening and closing the shutters once, as given by _move_shutter
+    if TESTING:
+        return 0.0
+    if params.station == '2-BM-A':
+        moves = [('A', 'open'), ('fast', 'open'), ('fast', 'close')] if ShutterAisFast else [('A', 'open'), ('A', 'close')]
+    else:
+        moves = [('B', 'open'), ('B', 'close')]
+    return sum(_shutter_move_time(*key) for key in moves)
+
+
+def _shutter_move_time(shutter, action):
+
+    # time given to a shutter move: its SHUTTER_SETTLE delay, or the slowest readback of its history if longer
+    history = _shutter_times.get((shutter, action))
+    return max([SHUTTER_SETTLE.get((shutter, action), 0.0)] + list(history or []))
+
+
+def shutter_stats():
+
+    # {(shutter, action): {'count', 'mean', 'max', 'total'}} over the recorded history
+    stats = {}
+    for key, history in _shutter_times.items():
+        stats[key] = {'count': len(history), 'mean': sum(history) / len(history), 'max': max(history), 'total': sum(history)}
+    return stats
+
+
+def log_shutter_stats():
+
+    for (shutter, action), stats in sorted(shutter_stats().items()):
+        log.info('  *** Shutter %s %s: %d times, mean %4.2f s, max %4.2f s, total %4.2f s' % (shutter, action, stats['count'], stats['mean'], stats['max'], stats['total']))
+
+
 def open_shutters(global_PVs, params):
     log.info(' ')
     log.info('  *** open_shutters')
@@ -344,22 +774,11 @@ def open_shutters(global_PVs, params):
     else:
         if params.station == '2-BM-A':
         # Use Shutter A
+            _move_shutter(global_PVs, 'A', 'open', 'ShutterA_Open', 1, 'ShutterA_Move_Status', ShutterA_Open_Value)
             if ShutterAisFast:
-                global_PVs['ShutterA_Open'].put(1, wait=True)
-                wait_pv(global_PVs['ShutterA_Move_Status'], ShutterA_Open_Value)
-                time.sleep(3)                
-                global_PVs['Fast_Shutter'].put(1, wait=True)
-                time.sleep(1)
-                log.info('  *** open_shutter fast: Done!')
-            else:
-                global_PVs['ShutterA_Open'].put(1, wait=True)
-                wait_pv(global_PVs['ShutterA_Move_Status'], ShutterA_Open_Value)
-                time.sleep(3)
-                log.info('  *** open_shutter A: Done!')
+                _move_shutter(global_PVs, 'fast', 'open', 'Fast_Shutter', 1)
         elif params.station == '2-BM-B':
-            global_PVs['ShutterB_Open'].put(1, wait=True)
-            wait_pv(global_PVs['ShutterB_Move_Status'], ShutterB_Open_Value)
-            log.info('  *** open_shutter B: Done!')
+            _move_shutter(global_PVs, 'B', 'open', 'ShutterB_Open', 1, 'ShutterB_Move_Status', ShutterB_Open_Value)
  
 
 def close_shutters(global_PVs, params):
@@ -371,86 +790,79 @@ def close_shutters(global_PVs, params):
     else:
         if params.station == '2-BM-A':
             if ShutterAisFast:
-                global_PVs['Fast_Shutter'].put(0, wait=True)
-                time.sleep(1)
-                log.info('  *** close_shutter fast: Done!')
+                _move_shutter(global_PVs, 'fast', 'close', 'Fast_Shutter', 0)
             else:
-                global_PVs['ShutterA_Close'].put(1, wait=True)
-                wait_pv(global_PVs['ShutterA_Move_Status'], ShutterA_Close_Value)
-                log.info('  *** close_shutter A: Done!')
+                _move_shutter(global_PVs, 'A', 'close', 'ShutterA_Close', 1, 'ShutterA_Move_Status', ShutterA_Close_Value)
         elif params.station == '2-BM-B':
-            global_PVs['ShutterB_Close'].put(1, wait=True)
-            wait_pv(global_PVs['ShutterB_Move_Status'], ShutterB_Close_Value)
-            log.info('  *** close_shutter B: Done!')
+            _move_shutter(global_PVs, 'B', 'close', 'ShutterB_Close', 1, 'ShutterB_Move_Status', ShutterB_Close_Value)
 
 def move_sample_out(global_PVs, params):
 
+    # the furnace is moved out of the way before the sample, never together with it
     log.info('      *** Sample out')
     if not (params.sample_move_freeze):
         if (params.sample_in_out=="vertical"):
             log.info('      *** *** Move Sample Y out at: %f' % params.sample_out_position)
-            global_PVs['Motor_SampleY'].put(str(params.sample_out_position), wait=True, timeout=1000.0)                
-            if wait_pv(global_PVs['Motor_SampleY'], float(params.sample_out_position), 60) == False:
-                log.error('Motor_SampleY did not move in properly')
-                log.error(global_PVs['Motor_SampleY'].get())
+            move_motors(global_PVs, {'Motor_SampleY': params.sample_out_position})
         else:
             if (params.use_furnace):
                 log.info('      *** *** Move Furnace Y out at: %f' % params.furnace_out_position)
-                global_PVs['Motor_FurnaceY'].put(str(params.furnace_out_position), wait=True, timeout=1000.0)
-                if wait_pv(global_PVs['Motor_FurnaceY'], float(params.furnace_out_position), 60) == False:
-                    log.error('Motor_FurnaceY did not move in properly')
-                    log.error(global_PVs['Motor_FurnaceY'].get())
+                move_motors(global_PVs, {'Motor_FurnaceY': params.furnace_out_position})
             log.info('      *** *** Move Sample X out at: %f' % params.sample_out_position)
-            global_PVs['Motor_SampleX'].put(str(params.sample_out_position), wait=True, timeout=1000.0)
-            if wait_pv(global_PVs['Motor_SampleX'], float(params.sample_out_position), 60) == False:
-                log.error('Motor_SampleX did not move in properly')
-                log.error(global_PVs['Motor_SampleX'].get())
+            move_motors(global_PVs, {'Motor_SampleX': params.sample_out_position})
     else:
         log.info('      *** *** Sample Stack is Frozen')
 
 
-
 def move_sample_in(global_PVs, params):
 
+    # the sample is moved back in before the furnace, never together with it
     log.info('      *** Sample in')
     if not (params.sample_move_freeze):
         if (params.sample_in_out=="vertical"):
             log.info('      *** *** Move Sample Y in at: %f' % params.sample_in_position)
-            global_PVs['Motor_SampleY'].put(str(params.sample_in_position), wait=True, timeout=1000.0)                
-            if wait_pv(global_PVs['Motor_SampleY'], float(params.sample_in_position), 60) == False:
-                log.error('Motor_SampleY did not move in properly')
-                log.error(global_PVs['Motor_SampleY'].get())
+            move_motors(global_PVs, {'Motor_SampleY': params.sample_in_position})
         else:
             log.info('      *** *** Move Sample X in at: %f' % params.sample_in_position)
-            global_PVs['Motor_SampleX'].put(str(params.sample_in_position), wait=True, timeout=1000.0)
-            if wait_pv(global_PVs['Motor_SampleX'], float(params.sample_in_position), 60) == False:
-                log.error('Motor_SampleX did not move in properly')
-                log.error(global_PVs['Motor_SampleX'].get())
+            move_motors(global_PVs, {'Motor_SampleX': params.sample_in_position})
             if (params.use_furnace):
                 log.info('      *** *** Move Furnace Y in at: %f' % params.furnace_in_position)
-                global_PVs['Motor_FurnaceY'].put(str(params.furnace_in_position), wait=True, timeout=1000.0)
-                if wait_pv(global_PVs['Motor_FurnaceY'], float(params.furnace_in_position), 60) == False:
-                    log.error('Motor_FurnaceY did not move in properly')
-                    log.error(global_PVs['Motor_FurnaceY'].get())
+                move_motors(global_PVs, {'Motor_FurnaceY': params.furnace_in_position})
     else:
         log.info('      *** *** Sample Stack is Frozen')
 
 
 def set_pso(global_PVs, params):
 
+    tic = time.time()
     acclTime = 1.0 * params.slew_speed/params.accl_rot
     scanDelta = abs(((float(params.sample_rotation_end) - float(params.sample_rotation_start))) / ((float(params.num_projections)) * float(params.recursive_filter_n_images)))
 
     log.info('  *** *** start_pos %f' % float(params.sample_rotation_start))
     log.info('  *** *** end pos %f' % float(params.sample_rotation_end))
 
-    global_PVs['Fly_StartPos'].put(float(params.sample_rotation_start), wait=True)
-    global_PVs['Fly_EndPos'].put(float(params.sample_rotation_end), wait=True)
-    global_PVs['Fly_SlewSpeed'].put(params.slew_speed, wait=True)
-    global_PVs['Fly_ScanDelta'].put(scanDelta, wait=True)
-    time.sleep(3.0)
-
-    calc_num_proj = global_PVs['Fly_Calc_Projections'].get()
+    # the PSO controller recalculates numTriggers once the new settings are processed. The update is caught by
+    # a callback armed before the puts; it is waited for only when the angular range or step changed and the
+    # readback still holds the value it had before the puts. The same range and step (e.g. the swapped start
+    # and end of a backward scan) give the same numTriggers, which the controller does not post again.
+    before = get_PVs(global_PVs, ['Fly_StartPos', 'Fly_EndPos', 'Fly_ScanDelta', 'Fly_Calc_Projections'])
+    calc_updated = threading.Event()
+    index = global_PVs['Fly_Calc_Projections'].add_callback(lambda **kws: calc_updated.set(), with_ctrlvars=False)
+    try:
+        put_PVs(global_PVs, {'Fly_StartPos': float(params.sample_rotation_start),
+                             'Fly_EndPos': float(params.sample_rotation_end),
+                             'Fly_SlewSpeed': params.slew_speed,
+                             'Fly_ScanDelta': scanDelta})
+        changed = (None in before.values()) or \
+                  not math.isclose(abs(before['Fly_EndPos'] - before['Fly_StartPos']), abs(float(params.sample_rotation_end) - float(params.sample_rotation_start)), rel_tol=1e-6) or \
+                  not math.isclose(before['Fly_ScanDelta'], scanDelta, rel_tol=1e-6)
+        calc_num_proj = global_PVs['Fly_Calc_Projections'].get()
+        if changed and (calc_num_proj == before['Fly_Calc_Projections']):
+            if not calc_updated.wait(PSO_CALC_TIMEOUT):
+                log.warning('  *** *** Fly calculated number of projections not updated after %3.1f s' % PSO_CALC_TIMEOUT)
+            calc_num_proj = global_PVs['Fly_Calc_Projections'].get()
+    finally:
+        global_PVs['Fly_Calc_Projections'].remove_callback(index)
     
     if calc_num_proj == None:
         log.error('  *** *** Error getting fly calculated number of projections!')
@@ -462,9 +874,16 @@ def set_pso(global_PVs, params):
     log.info('  *** *** Number of projections: %d' % int(params.num_projections))
     log.info('  *** *** Fly calc triggers: %d' % int(calc_num_proj))
     global_PVs['Fly_ScanControl'].put('Standard')
+    log.info('  *** *** PSO setup time: %4.2f s' % (time.time() - tic))
 
     log.info(' ')
     log.info('  *** Taxi before starting capture')
-    global_PVs['Fly_Taxi'].put(1, wait=True)
-    wait_pv(global_PVs['Fly_Taxi'], 0)
-    log.info('  *** Taxi before starting capture: Done!')
\ No newline at end of file
+    tic = time.time()
+    taxi_model_time = motion.taxi_model_time(global_PVs, params)
+    taxi_timeout = MOVE_TIMEOUT
+    if taxi_model_time is not None:
+        taxi_timeout = motion.timeout(motion.predict('taxi', taxi_model_time), MOVE_TIMEOUT)
+    global_PVs['Fly_Taxi'].put(1, wait=True, timeout=taxi_timeout)
+    if wait_pv(global_PVs['Fly_Taxi'], 0, taxi_timeout):
+        motion.calibrate('taxi', taxi_model_time, time.time() - tic)
+    log.info('  *** Taxi before starting capture: Done! (%4.2f s)' % (time.time() - tic))
@@ -0,0 +1,184 @@
+# #########################################################################
+# Copyright (c) 2019-2020, UChicago Argonne, LLC. All rights reserved.    #
+#                                                                         #
+# Copyright 2019-2020. UChicago Argonne, LLC. This software was produced  #
+# under U.S. Government contract DE-AC02-06CH11357 for Argonne National   #
+# Laboratory (ANL), which is operated by UChicago Argonne, LLC for the    #
+# U.S. Department of Energy. The U.S. Government has rights to use,       #
+# reproduce, and distribute this software.  NEITHER THE GOVERNMENT NOR    #
+# UChicago Argonne, LLC MAKES ANY WARRANTY, EXPRESS OR IMPLIED, OR        #
+# ASSUMES ANY LIABILITY FOR THE USE OF THIS SOFTWARE.  If software is     #
+# modified to produce derivative works, such modified software should     #
+# be clearly marked, so as not to confuse it with the version available   #
+# from ANL.                                                               #
+#                                                                         #
+# Additionally, redistribution and use in source and binary forms, with   #
+# or without modification, are permitted provided that the following      #
+# conditions are met:                                                     #
+#                                                                         #
+#     * Redistributions of source code must retain the above copyright    #
+#       notice, this list of conditions and the following disclaimer.     #
+#                                                                         #
+#     * Redistributions in binary form must reproduce the above copyright #
+#       notice, this list of conditions and the following disclaimer in   #
+#       the documentation and/or other materials provided with the        #
+#       distribution.                                                     #
+#                                                                         #
+#     * Neither the name of UChicago Argonne, LLC, Argonne National       #
+#       Laboratory, ANL, the U.S. Government, nor the names of its        #
+#       contributors may be used to endorse or promote products derived   #
+#       from this software without specific prior written permission.     #
+#                                                                         #
+# THIS SOFTWARE IS PROVIDED BY UChicago Argonne, LLC AND CONTRIBUTORS     #
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT       #
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS       #
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL UChicago     #
+# Argonne, LLC OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT,        #
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING,    #
+# BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;        #
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER        #
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT      #
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN       #
+# ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE         #
+# POSSIBILITY OF SUCH DAMAGE.                                             #
+# #########################################################################
+
+"""
+Closed-loop tuning of the rotation slow factor.
+
+After each scan of a series the projections lost by the camera (PSO triggers without a frame) or by the
+HDF plugin are counted by flir.reconcile_theta; the white and dark fields do not count. The slow factor is
+then bisected between the fastest factor that dropped no projection and the slowest one that did, so that
+the series converges on the fastest rotation speed the camera and the storage keep up with. Every decision
+is appended to slow_factor_history.json (one JSON record per line) in logs-home; the last record for the
+same camera, exposure time, ROI size and binning is the starting point of the next series.
+"""
+
+import os
+import json
+import time
+
+from tomo2bm import log
+from tomo2bm import aps2bm
+
+SLOW_FACTOR_MIN = 0.05        # slowest factor tried
+HISTORY_FILE_NAME = 'slow_factor_history.json'
+
+# fastest slow factor without dropped frames and slowest one with dropped frames in this series
+_bounds = {'good': None, 'bad': None}
+
+
+def setup(global_PVs, params):
+
+    # what the frame rate the camera and the storage keep up with depends on
+    return {'camera': params.camera_ioc_prefix, 'exposure_time': round(float(params.exposure_time), 6),
+            'size_x': aps2bm.cached_get(global_PVs, 'Cam1_SizeX'), 'size_y': aps2bm.cached_get(global_PVs, 'Cam1_SizeY'),
+            'binning': aps2bm.cached_get(global_PVs, 'Cam1_BinX')}
+
+
+def start(global_PVs, params):
+    """Start a series from the last slow factor and bounds of the history for the same camera setup."""
+    _bounds['good'] = _bounds['bad'] = None
+    current = setup(global_PVs, params)
+    history = read_history(params)
+    for record in reversed(history):
+        if record.get('setup') == current:
+            params.rotation_slow_factor = record['next']
+            _bounds['good'], _bounds['bad'] = record['good'], record['bad']
+            log.info('  *** Rotation slow factor %4.2f from the history of %s' % (params.rotation_slow_factor, record['time']))
+            break
+    else:
+        log.info('  *** Rotation slow factor %4.2f: no history for this exposure time, ROI and binning' % params.rotation_slow_factor)
+
+
+def update(global_PVs, params, fly, frames=None, file_name=None):
+    """
+    Count the projections dropped by the last scan and set the slow factor (and slew speed) of the next one.
+
+    Parameters
+    ----------
+    fly : dict
+        Counters of the last fly scan, see flir.fly_counts
+    frames : dict
+        Projections report of the last scan, see flir.reconcile_theta. Without it only the triggers the
+        camera missed are counted
+    file_name : str
+        File of the last scan, params.file_name by default
+
+    Returns
+    -------
+    float
+        The slow factor of the next scan
+    """
+    slow_factor = params.rotation_slow_factor
+    camera_dropped = max(fly['triggers'] - fly['camera'], 0) // fly['frames_per_projection']
+    if frames is not None:
+        dropped = frames['dropped']
+    else:
+        log.warning('  *** No projections report of the last scan, counting only the triggers the camera missed')
+        dropped = camera_dropped
+    hdf_dropped = max(dropped - camera_dropped, 0)
+    angular_range = abs(params.sample_rotation_end - params.sample_rotation_start)
+    frame_rate = fly['camera'] * params.slew_speed / angular_range if angular_range else 0.0
+
+    if dropped == 0:
+        _bounds['good'] = max(_bounds['good'] or 0.0, slow_factor)
+    else:
+        _bounds['bad'] = min(_bounds['bad'] or 1.0, slow_factor)
+        if _bounds['good'] is not None and _bounds['good'] >= slow_factor:
+            # the camera or the storage got slower: forget the factors that used to work
+            _bounds['good'] = None
+
+    good = _bounds['good']
+    upper = _bounds['bad'] if _bounds['bad'] is not None else 1.0
+    if good is not None and upper - good <= params.slow_factor_tolerance:
+        next_factor = good
+    elif good is None:
+        next_factor = max((SLOW_FACTOR_MIN + upper) / 2.0, SLOW_FACTOR_MIN)
+    else:
+        next_factor = (good + upper) / 2.0
+    next_factor = round(next_factor, 3)
+    if next_factor == good and upper - good <= params.slow_factor_tolerance:
+        decision = 'converged'
+    else:
+        decision = 'faster' if next_factor > slow_factor else 'slower'
+
+    log.info('  *** Rotation slow factor %4.2f: %d dropped projections (%d camera, %d HDF) at %4.1f fps => %s, next %4.3f' 
+             % (slow_factor, dropped, dropped - hdf_dropped, hdf_dropped, frame_rate, decision, next_factor))
+    _append_history(params, {'time': time.strftime('%Y-%m-%d %H:%M:%S'), 'camera': params.camera_ioc_prefix,
+                             'setup': setup(global_PVs, params),
+                             'file': file_name if file_name is not None else params.file_name, 'slow_factor': slow_factor, 'slew_speed': params.slew_speed,
+                             'frame_rate': frame_rate, 'triggers': fly['triggers'], 'camera_frames': fly['camera'],
+                             'hdf_dropped': hdf_dropped, 'dropped': dropped, 'good': _bounds['good'],
+                             'bad': _bounds['bad'], 'decision': decision, 'next': next_factor})
+
+    params.slew_speed = params.slew_speed * next_factor / slow_factor
+    params.rotation_slow_factor = next_factor
+    return next_factor
+
+
+def history_file(params):
+    return os.path.join(params.logs_home, HISTORY_FILE_NAME)
+
+
+def read_history(params):
+    """All the recorded decisions, oldest first."""
+    history = []
+    try:
+        with open(history_file(params)) as f:
+            for line in f:
+                if line.strip():
+                    history.append(json.loads(line))
+    except FileNotFoundError:
+        pass
+    except (OSError, ValueError) as e:
+        log.error('  *** Could not read %s: %s' % (history_file(params), e))
+    return history
+
+
+def _append_history(params, record):
+    try:
+        with open(history_file(params), 'a') as f:
+            f.write(json.dumps(record) + '\n')
+    except OSError as e:
+        log.error('  *** Could not save the slow factor decision in %s: %s' % (history_file(params), e))
@@ -107,6 +107,31 @@ SECTIONS['general'] = {
         'default': False,
         'help': ' ',
         'action': 'store_true'},
+    'pv-backend': {
+        'default': 'epics',
+        'type': str,
+        'choices': ['epics', 'sim'],
+        'help': "epics: run on the beamline; sim: run on the in-process simulated 2-BM IOC (no beamline needed)"},
+    'pv-metrics': {
+        'default': False,
+        'help': 'Record per-PV get/put/wait latencies and save them as JSON in logs-home at the end of the run',
+        'action': 'store_true'},
+    'pv-metrics-prometheus': {
+        'default': False,
+        'help': 'When pv-metrics is set, also save the PV metrics as a Prometheus text file in logs-home',
+        'action': 'store_true'},
+    'profile-last': {
+        'default': 0,
+        'type': int,
+        'help': 'Number of most recent scan timelines combined by tomo profile, 0 for all'},
+    'plan-only': {
+        'default': False,
+        'help': 'Log the plan of the scan series (positions, file names, references and predicted times) without running it',
+        'action': 'store_true'},
+    'auto-plan': {
+        'default': False,
+        'help': 'Replace exposure time, number of projections, rotation slow factor and binning with the fastest scan meeting the planner constraints',
+        'action': 'store_true'},
         }
 
 SECTIONS['experiment-info'] = {
@@ -163,6 +188,10 @@ SECTIONS['detector'] = {
         'default': 0.01,
         'type': float,
         'help': "8-bit: 0.006; 16-bit: 0.01"},
+    'pva-image-pv': {
+        'default': None,
+        'type': str,
+        'help': "NDPluginPva image PV (e.g. 2bmbSP1:Pva1:Image) used to read single frames over PVAccess; requires p4p, Channel Access is used when not set"},
         }
 
 SECTIONS['scintillator'] = {
@@ -213,6 +242,10 @@ SECTIONS['beamline'] = {
         'default': None,
         'type': str,
         'help': " "},
+    'pv-connect-timeout': {
+        'default': 5.0,
+        'type': float,
+        'help': "Time (s) allowed for connecting all the beamline PVs at start up"},
     }
 
 SECTIONS['sample'] = {
@@ -266,6 +299,10 @@ SECTIONS['scan'] = {
         'default': False,
         'choices': ['True', 'False'],
         'help': 'When set, the data set was collected in reverse (180-0)'},
+    'bidirectional': {
+        'default': False,
+        'action': 'store_true',
+        'help': "Rotate back and forth: each scan of a series starts where the previous one ended, without rewinding the rotary stage"},
     'scan-type': {
         'choices': ['standard', 'vertical', 'mosaic'],
         'default': 'standard',
@@ -283,6 +320,15 @@ SECTIONS['scan'] = {
         'type': util.positive_int,
         'default': 20,
         'help': " "},
+    'reference-policy': {
+        'default': 'every-scan',
+        'type': str,
+        'choices': ['every-scan', 'every-n-scans', 'per-row', 'series-ends'],
+        'help': "When white and dark fields are taken in a series: every scan, every reference-every-n scans, in the first scan of each vertical pass or mosaic row, or in the first and last scan; the other scans link to the last references"},
+    'reference-every-n': {
+        'type': util.positive_int,
+        'default': 5,
+        'help': "Scans between references with --reference-policy every-n-scans"},
     'white-field-motion': {
         'choices': ['horizontal', 'vertical'],
         'default': 'horizontal',
@@ -312,6 +358,11 @@ SECTIONS['scan'] = {
         'default': 1,
         'type': float,
         'help': " "},
+    'mosaic-order': {
+        'default': 'serpentine',
+        'type': str,
+        'choices': ['serpentine', 'raster', 'travel'],
+        'help': "Mosaic tile order: X alternating direction in each Y row, X always from horizontal-scan-start, or the serpentine by rows or by columns with the shortest predicted motor travel"},
     'sleep-time': {
         'default': 0,
         'type': float,
@@ -361,6 +412,54 @@ SECTIONS['stage-settings'] = {
         'default': 1.0,
         'type': util.restricted_float,
         'help': "Reduce rotation speed to reduce blurring"},
+    'auto-slow-factor': {
+        'default': False,
+        'help': 'When set, the rotation slow factor is tuned between the scans of a series to the fastest speed without dropped frames',
+        'action': 'store_true'},
+    'slow-factor-tolerance': {
+        'default': 0.02,
+        'type': float,
+        'help': "The slow factor tuning stops when the fastest factor without dropped frames is this close to the slowest one with"},
+    }
+
+SECTIONS['planner'] = {
+    'plan-exposure-min': {
+        'default': 0.001,
+        'type': float,
+        'help': "Shortest exposure time (s) tried by --auto-plan"},
+    'plan-exposure-max': {
+        'default': 1.0,
+        'type': float,
+        'help': "Longest exposure time (s) tried by --auto-plan"},
+    'plan-projections-min': {
+        'default': 500,
+        'type': util.positive_int,
+        'help': "Smallest number of projections tried by --auto-plan"},
+    'plan-projections-max': {
+        'default': 3000,
+        'type': util.positive_int,
+        'help': "Largest number of projections tried by --auto-plan"},
+    'plan-max-binning': {
+        'default': 1,
+        'type': util.positive_int,
+        'choices': [1, 2, 4],
+        'help': "Largest camera binning tried by --auto-plan"},
+    'plan-max-blur': {
+        'default': 0.2,
+        'type': float,
+        'help': "Largest rotation blur (pixels) at the edge of the field of view"},
+    'plan-min-sampling': {
+        'default': 0.5,
+        'type': float,
+        'help': "Smallest number of projections as a fraction of the Nyquist number pi/2 * width"},
+    'plan-count-rate': {
+        'default': 0.0,
+        'type': float,
+        'help': "White field counts/s in an unbinned pixel; 0: unknown, the counts constraint is not used"},
+    'plan-min-counts': {
+        'default': 1000.0,
+        'type': float,
+        'help': "Smallest white field counts in a binned pixel"},
     }
 
 SECTIONS['sphere'] = {
@@ -400,6 +499,15 @@ SECTIONS['adjust'] = {
         'default': 45,
         'type': float,
         'help': "Adjust center second angle (deg)"},
+    'reference-frames': {
+        'default': 1,
+        'type': util.positive_int,
+        'help': "Number of frames taken in one acquisition and reduced into each dark and white field reference"},
+    'reference-reduce': {
+        'default': 'mean',
+        'type': str,
+        'choices': ['mean', 'median'],
+        'help': "How the reference frames are reduced: mean (lowest noise) or median (rejects outliers such as zingers)"},
     }
 
 SECTIONS['dx-options'] = {
@@ -410,10 +518,10 @@ SECTIONS['dx-options'] = {
         }
 
 
-SCAN_PARAMS = ('experiment-info', 'detector', 'scintillator', 'hdf-plugin', 'file', 'beamline', 'sample', 'sample-motion', 'scan', 'furnace', 'file-transfer', 'stage-settings', 'dx-options')
+SCAN_PARAMS = ('experiment-info', 'detector', 'scintillator', 'hdf-plugin', 'file', 'beamline', 'sample', 'sample-motion', 'scan', 'furnace', 'file-transfer', 'stage-settings', 'planner', 'dx-options')
 SPHERE_PARAMS = ('detector', 'file', 'beamline', 'sample-motion', 'furnace', 'sphere', 'adjust')
 
-NICE_NAMES = ('general', 'experiment info', 'detector', 'scintillator', 'hdf plugin', 'file', 'beam line', 'sample', 'sample motion', 'scan', 'furnace', 'file transfer', 'stage settings', 'dx options')
+NICE_NAMES = ('general', 'experiment info', 'detector', 'scintillator', 'hdf plugin', 'file', 'beam line', 'sample', 'sample motion', 'scan', 'furnace', 'file transfer', 'stage settings', 'planner', 'sphere', 'adjust', 'dx options')
 
 
 def get_config_name():
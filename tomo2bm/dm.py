@@ -91,6 +91,11 @@ def create_remote_directory(remote_server, remote_dir):
 
 def scp(global_PVs, params):
 
+    return scp_file(params, global_PVs['HDF1_FullFileName_RBV'].get(as_string=True))
+
+
+def scp_file(params, fname_origin):
+
     log.info(' ')
     log.info('  *** Data transfer')
 
@@ -99,7 +104,6 @@ def scp(global_PVs, params):
     log.info('      *** remote server: %s' % remote_server)
     log.info('      *** remote top directory: %s' % remote_top_dir)
 
-    fname_origin = global_PVs['HDF1_FullFileName_RBV'].get(as_string=True)
     p = pathlib.Path(fname_origin)
     fname_destination = params.remote_analysis_dir + p.parts[-3] + '/' + p.parts[-2] + '/'
     remote_dir = remote_top_dir + p.parts[-3] + '/' + p.parts[-2] + '/'
@@ -0,0 +1,201 @@
+# #########################################################################
+# Copyright (c) 2019-2020, UChicago Argonne, LLC. All rights reserved.    #
+#                                                                         #
+# Copyright 2019-2020. UChicago Argonne, LLC. This software was produced  #
+# under U.S. Government contract DE-AC02-06CH11357 for Argonne National   #
+# Laboratory (ANL), which is operated by UChicago Argonne, LLC for the    #
+# U.S. Department of Energy. The U.S. Government has rights to use,       #
+# reproduce, and distribute this software.  NEITHER THE GOVERNMENT NOR    #
+# UChicago Argonne, LLC MAKES ANY WARRANTY, EXPRESS OR IMPLIED, OR        #
+# ASSUMES ANY LIABILITY FOR THE USE OF THIS SOFTWARE.  If software is     #
+# modified to produce derivative works, such modified software should     #
+# be clearly marked, so as not to confuse it with the version available   #
+# from ANL.                                                               #
+#                                                                         #
+# Additionally, redistribution and use in source and binary forms, with   #
+# or without modification, are permitted provided that the following      #
+# conditions are met:                                                     #
+#                                                                         #
+#     * Redistributions of source code must retain the above copyright    #
+#       notice, this list of conditions and the following disclaimer.     #
+#                                                                         #
+#     * Redistributions in binary form must reproduce the above copyright #
+#       notice, this list of conditions and the following disclaimer in   #
+#       the documentation and/or other materials provided with the        #
+#       distribution.                                                     #
+#                                                                         #
+#     * Neither the name of UChicago Argonne, LLC, Argonne National       #
+#       Laboratory, ANL, the U.S. Government, nor the names of its        #
+#       contributors may be used to endorse or promote products derived   #
+#       from this software without specific prior written permission.     #
+#                                                                         #
+# THIS SOFTWARE IS PROVIDED BY UChicago Argonne, LLC AND CONTRIBUTORS     #
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT       #
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS       #
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL UChicago     #
+# Argonne, LLC OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT,        #
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING,    #
+# BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;        #
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER        #
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT      #
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN       #
+# ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE         #
+# POSSIBILITY OF SUCH DAMAGE.                                             #
+# #########################################################################
+
+"""
+Post-scan finalization of Sector 2-BM scans.
+
+Once the HDF file of a scan is closed, the theta array is appended, the config file and the DX metadata
+are written, the config file is copied next to the data and the transfer to the analysis computer is
+started by a background worker, so that the next scan can start taxiing right away. Each scan gets a
+status record with the time and the errors of every step.
+"""
+
+import sys
+import copy
+import time
+import queue
+import atexit
+import threading
+import traceback
+import numpy as np
+
+from tomo2bm import dm
+from tomo2bm import log
+from tomo2bm import flir
+from tomo2bm import config
+from tomo2bm import timeline as scan_timeline
+
+QUEUE_SIZE = 4                # scans waiting to be finalized before submit blocks the next acquisition
+FRAMES_TIMEOUT = 60.0         # s, max wait for the projections report of a scan
+
+_queue = queue.Queue(QUEUE_SIZE)
+_worker = None
+_lock = threading.Lock()
+
+# one status record per submitted scan, in submission order
+_status = []
+
+
+def submit(params, fullname, theta, fly=None, references=None, transfer=True, timeline=None):
+    """
+    Queue the finalization of the scan saved in *fullname*. *params* is copied, so the caller can go on
+    changing it for the next scan. With the fly scan counters *fly* (flir.fly_counts) the angle of each
+    projection is reconciled with the PSO triggers, otherwise *theta* is written as it is. A scan taken
+    without white and dark fields gets links to the ones of the *references* file. The steps are added
+    as background phases to the scan *timeline* (timeline.stop), which is then saved.
+    Blocks only when QUEUE_SIZE scans are already waiting.
+
+    Returns
+    -------
+    dict
+        Status record of the scan: file, submitted/started/finished times, steps {name: seconds} and
+        errors [(step, message)] and, with *fly*, the frames report of flir.reconcile_theta; finished is
+        None until the worker is done with the scan and the reconciled event is set once theta is written
+        (see frames).
+    """
+    global _worker
+
+    record = {'file': fullname, 'submitted': time.time(), 'started': None, 'finished': None, 'steps': {}, 'errors': [], 'frames': None,
+              'reconciled': threading.Event()}
+    with _lock:
+        _status.append(record)
+        if _worker is None or not _worker.is_alive():
+            _worker = threading.Thread(target=_run, name='finalize', daemon=True)
+            _worker.start()
+    tic = time.monotonic()
+    full = _queue.full()
+    if full:
+        log.warning('  *** Finalization is %d scans behind, waiting' % _queue.qsize())
+    _queue.put((copy.copy(params), fullname, None if theta is None else np.array(theta), fly, references, transfer, timeline, record))
+    if full and timeline is not None:
+        # the wait holds the next scan back; the scans queued ahead keep the worker from saving this timeline yet
+        scan_timeline.add(timeline, 'finalize_wait', tic, time.monotonic())
+    return record
+
+
+def wait():
+    """Block until every submitted scan is finalized."""
+    _queue.join()
+
+
+def frames(record, timeout=FRAMES_TIMEOUT):
+    """Wait for the projections report (flir.reconcile_theta) of the scan of *record*, None if there is none."""
+    if not record['reconciled'].wait(timeout):
+        log.warning('  *** %s: projections not reconciled after %3.1f s' % (record['file'], timeout))
+    return record['frames']
+
+
+def status():
+    return list(_status)
+
+
+def log_status():
+
+    wait()
+    failed = [record for record in _status if record['errors']]
+    log.info('  *** Finalized %d scans, %d with errors' % (len(_status), len(failed)))
+    frames = [record['frames'] for record in _status if record['frames']]
+    if frames:
+        dropped = sum(report['dropped'] for report in frames)
+        expected = sum(report['saved'] + report['dropped'] for report in frames)
+        log.info('  *** Dropped projections: %d of %d (%4.2f%%), worst scan %4.2f%%' 
+                 % (dropped, expected, 100.0 * dropped / max(expected, 1), 100 * max(report['drop_rate'] for report in frames)))
+    for record in failed:
+        for step, message in record['errors']:
+            log.error('  *** Finalization of %s failed at %s: %s' % (record['file'], step, message))
+
+
+def _run():
+
+    while True:
+        params, fullname, theta, fly, references, transfer, timeline, record = _queue.get()
+        try:
+            _finalize(params, fullname, theta, fly, references, transfer, timeline, record)
+        finally:
+            _queue.task_done()
+
+
+def _finalize(params, fullname, theta, fly, references, transfer, timeline, record):
+
+    record['started'] = time.time()
+    if fly is None or _step(record, 'reconcile', lambda: flir.reconcile_theta(fullname, fly), timeline) is False:
+        _step(record, 'add_theta', lambda: flir.write_theta(fullname, theta), timeline)
+    record['reconciled'].set()
+    if references is not None:
+        _step(record, 'link_references', lambda: flir.link_references(fullname, references), timeline)
+    _step(record, 'update_config', lambda: config.update_config(params), timeline)
+    if transfer:
+        _step(record, 'transfer', lambda: dm.scp_file(params, fullname), timeline)
+    record['finished'] = time.time()
+    if timeline is not None:
+        scan_timeline.save(params, timeline)
+    log.info('  *** Finalized %s in %4.2f s (%4.2f s after submission)' % (fullname, record['finished'] - record['started'], record['finished'] - record['submitted']))
+
+
+def _step(record, step, func, timeline=None):
+
+    # runs one step, returns False when it failed
+    tic = time.time()
+    tic_monotonic = time.monotonic()
+    try:
+        ret = func()
+        if isinstance(ret, dict):
+            record['frames'] = ret
+        elif ret is not None and ret < 0:
+            record['errors'].append((step, 'returned %d' % ret))
+    except Exception as e:
+        traceback.print_exc(file=sys.stdout)
+        record['errors'].append((step, '%s: %s' % (type(e).__name__, e)))
+    record['steps'][step] = time.time() - tic
+    if timeline is not None:
+        scan_timeline.add(timeline, step, tic_monotonic, time.monotonic(), background=True)
+    if record['errors'] and record['errors'][-1][0] == step:
+        log.error('  *** Finalization of %s failed at %s: %s' % (record['file'], step, record['errors'][-1][1]))
+        return False
+    return True
+
+
+# do not lose the scans still queued when the program ends
+atexit.register(wait)
@@ -47,16 +47,24 @@
 Detector lib for Sector 2-BM  using Point Grey Grasshooper3 or FLIR Oryx cameras.
 """
 
+import os
 import sys
 import json
 import time
 import h5py
+import threading
 import traceback
 import numpy as np
 
 from tomo2bm import aps2bm
+from tomo2bm import motion
 from tomo2bm import log
 
+try:
+    from p4p.client.thread import Context as PvaContext
+except ImportError:
+    PvaContext = None
+
 FrameTypeData = 0
 FrameTypeDark = 1
 FrameTypeWhite = 2
@@ -66,21 +74,113 @@ DetectorAcquire = 1
 
 Recursive_Filter_Type = 'RecursiveAve'
 
+PIXEL_TYPES = {'Mono8': np.uint8, 'Mono16': np.uint16}
+PVA_TIMEOUT = 5.0
+FRAME_TYPE_SETTLE = 2.0       # s, wait after setting the data frame type before the fly scan
+HDF_DRAIN_POLL = 0.5          # s, longest interval between samples of the HDF plugin queue
+HDF_DRAIN_POLL_MIN = 0.05     # s, shortest interval between samples of the HDF plugin queue
+HDF_DRAIN_MARGIN = 2.0        # the queue gets this many times its drain time at the measured write rate
+HDF_DRAIN_STALL = 10.0        # s without a frame written before the file is forced to close, no write rate measured yet
+HDF_DRAIN_IDLE = 2.0          # s to wait for late frames once the queue is empty
+
+# reusable frame buffers of take_image, keyed by purpose ('image', 'dark', 'white')
+_frame_buffers = {}
+_pva_context = None
+
+# disk write rate measured by checkclose_hdf for each scan: [(file name, frames, frames/s)]
+_hdf_write_rates = []
+
+# NDArrayUniqueId the first projection of the last fly scan gets, the camera array counter at the start + 1
+_fly_first_id = None
+
+
+# settings CameraConfig always writes: the IOC only (re)loads the attribute and layout XML files when their
+# file name is written, so an edited file with an unchanged name needs the write
+ALWAYS_WRITE = frozenset(('Cam1_AttributeFile', 'HDF1_XMLFileName'))
+
+
+class CameraConfig(object):
+    """
+    Settings of the camera and its plugins. apply() reads the current value of each setting back (from the
+    pv cache) and only writes the settings that differ, and the ones in ALWAYS_WRITE. The last value applied
+    and the last time taken to write each setting are kept, so that the time saved by the settings that did
+    not need writing, and by the waits that could be skipped, can be reported.
+    """
+
+    def __init__(self):
+        self.applied = {}
+        self.put_times = {}
+        self.reset()
+
+    def reset(self):
+        self.written = 0
+        self.unchanged = 0
+        self.saved = 0.0
+
+    def changed(self, global_PVs, settings):
+
+        # the settings whose current value differs from the one requested, and the ones always written
+        changed = {}
+        for name, value in settings.items():
+            if name in ALWAYS_WRITE:
+                changed[name] = value
+                continue
+            current = aps2bm.cached_get(global_PVs, name, as_string=isinstance(value, str))
+            if not _same_setting(current, value):
+                changed[name] = value
+        return changed
+
+    def apply(self, global_PVs, stages, timeout=aps2bm.PUT_TIMEOUT):
+
+        # write the settings that changed, one stage after the other as in aps2bm.put_PVs_ordered
+        for settings in stages:
+            changed = self.changed(global_PVs, settings)
+            put_times = aps2bm.put_PVs(global_PVs, changed, timeout)
+            for name, value in settings.items():
+                if name in changed:
+                    self.written += 1
+                    if put_times[name] is not None:
+                        self.put_times[name] = put_times[name]
+                else:
+                    self.unchanged += 1
+                    self.saved += self.put_times.get(name, 0.0)
+                self.applied[name] = value
+
+    def skip_wait(self, wait_time):
+        self.saved += wait_time
+
+    def report(self, what):
+        log.info('  *** %s: %d settings written, %d unchanged, %4.2f s saved' % (what, self.written, self.unchanged, self.saved))
+        self.reset()
+
+
+def _same_setting(current, value):
+
+    if current is None:
+        return False
+    if isinstance(value, str):
+        return str(current).strip() == value
+    try:
+        return abs(float(current) - float(value)) <= 1e-6 * max(abs(float(value)), 1.0)
+    except (TypeError, ValueError):
+        return False
+
+
+_camera_config = CameraConfig()
+
+
 def init(global_PVs, params):
     if (params.camera_ioc_prefix == '2bmbPG3:'):   
         log.info('  *** init Point Grey camera')
         global_PVs['Cam1_TriggerMode'].put('Internal', wait=True)    # 
         global_PVs['Cam1_TriggerMode'].put('Overlapped', wait=True)  # sequence Internal / Overlapped / internal because of CCD bug!!
         global_PVs['Cam1_TriggerMode'].put('Internal', wait=True)    #
-        global_PVs['Proc1_Filter_Callbacks'].put( 'Every array' )
-        global_PVs['Cam1_ImageMode'].put('Single', wait=True)
-        global_PVs['Cam1_Display'].put(1)
+        _camera_config.apply(global_PVs, [{'Proc1_Filter_Callbacks': 'Every array', 'Cam1_ImageMode': 'Single', 'Cam1_Display': 1}])
         global_PVs['Cam1_Acquire'].put(DetectorAcquire)
         aps2bm.wait_pv(global_PVs['Cam1_Acquire'], DetectorAcquire, 2)
-        global_PVs['Proc1_Callbacks'].put('Disable')
-        global_PVs['Proc1_Filter_Enable'].put('Disable')
-        global_PVs['HDF1_ArrayPort'].put('PG3')
+        _camera_config.apply(global_PVs, [{'Proc1_Callbacks': 'Disable', 'Proc1_Filter_Enable': 'Disable', 'HDF1_ArrayPort': 'PG3'}])
         log.info('  *** init Point Grey camera: Done!')
+        _camera_config.report('init Point Grey camera')
     elif (params.camera_ioc_prefix == '2bmbSP1:'):   
         log.info(' ')                
         log.info('  *** init FLIR camera')
@@ -89,31 +189,30 @@ def init(global_PVs, params):
         aps2bm.wait_pv(global_PVs['Cam1_Acquire'], DetectorIdle, 2)
         log.info('  *** *** set detector to idle:  Done')
         # global_PVs['Proc1_Filter_Callbacks'].put( 'Every array', wait=True) # commented out to test if crash (ValueError: invalid literal for int() with base 0: 'Single') still occurs
-        time.sleep(2) 
-        log.info('  *** *** set trigger mode to Off')
-        global_PVs['Cam1_TriggerMode'].put('Off', wait=True)    # 
-        log.info('  *** *** set trigger mode to Off: done')
-        time.sleep(7) 
-        log.info('  *** *** set image mode to single')
-        global_PVs['Cam1_ImageMode'].put('Single', wait=True)   # here is where it crashes with (ValueError: invalid literal for int() with base 0: 'Single') Added 7 s delay before
-        log.info('  *** *** set image mode to single: done')
-        log.info('  *** *** set cam display to 1')
-        global_PVs['Cam1_Display'].put(1)
-        log.info('  *** *** set cam display to 1: done')
+        # the waits around the trigger mode change are only needed when the trigger mode actually changes
+        if _camera_config.changed(global_PVs, {'Cam1_TriggerMode': 'Off'}):
+            time.sleep(2) 
+            log.info('  *** *** set trigger mode to Off')
+            _camera_config.apply(global_PVs, [{'Cam1_TriggerMode': 'Off'}])
+            log.info('  *** *** set trigger mode to Off: done')
+            time.sleep(7) 
+        else:
+            log.info('  *** *** trigger mode is already Off')
+            _camera_config.apply(global_PVs, [{'Cam1_TriggerMode': 'Off'}])
+            _camera_config.skip_wait(2 + 7)
+        log.info('  *** *** set image mode to single and cam display to 1')
+        _camera_config.apply(global_PVs, [{'Cam1_ImageMode': 'Single'}, {'Cam1_Display': 1}])   # here is where it crashes with (ValueError: invalid literal for int() with base 0: 'Single') Added 7 s delay before
+        log.info('  *** *** set image mode to single and cam display to 1: done')
         log.info('  *** *** set cam acquire')
         global_PVs['Cam1_Acquire'].put(DetectorAcquire)
         aps2bm.wait_pv(global_PVs['Cam1_Acquire'], DetectorAcquire, 2) 
         log.info('  *** *** set cam acquire: done')
-        if params.station == '2-BM-A':
-            global_PVs['Cam1_AttributeFile'].put('flir2bmaDetectorAttributes.xml')
-            global_PVs['HDF1_XMLFileName'].put('flir2bmaLayout.xml')           
-        else: # Mona (B-station)
-            global_PVs['Cam1_AttributeFile'].put('flir2bmbDetectorAttributes.xml', wait=True) 
-            global_PVs['HDF1_XMLFileName'].put('flir2bmbLayout.xml', wait=True) 
+        _camera_config.apply(global_PVs, [_layout_settings(params)])
         log.info('  *** init FLIR camera: Done!')
+        _camera_config.report('init FLIR camera')
 
 
-def set(global_PVs, params):
+def set(global_PVs, params, references=True):
 
     fname = params.file_name
     # Set detectors
@@ -122,20 +221,19 @@ def set(global_PVs, params):
         log.info('  *** setup Point Grey')
 
         # mona runf always in B with PG camera
-        global_PVs['Cam1_AttributeFile'].put('monaDetectorAttributes.xml', wait=True) 
-        global_PVs['HDF1_XMLFileName'].put('monaLayout.xml', wait=True) 
-
-        global_PVs['Cam1_ImageMode'].put('Multiple')
-        global_PVs['Cam1_ArrayCallbacks'].put('Enable')
-        #global_PVs['Image1_Callbacks'].put('Enable')
-        global_PVs['Cam1_AcquirePeriod'].put(float(params.exposure_time))
-        global_PVs['Cam1_AcquireTime'].put(float(params.exposure_time))
-        # if we are using external shutter then set the exposure time
-        global_PVs['Cam1_FrameRateOnOff'].put(0)
+        _camera_config.apply(global_PVs, [{'Cam1_AttributeFile': 'monaDetectorAttributes.xml',
+                                    'HDF1_XMLFileName': 'monaLayout.xml',
+                                    'Cam1_ImageMode': 'Multiple',
+                                    'Cam1_ArrayCallbacks': 'Enable',
+                                    #'Image1_Callbacks': 'Enable',
+                                    'Cam1_AcquirePeriod': float(params.exposure_time),
+                                    'Cam1_AcquireTime': float(params.exposure_time),
+                                    # if we are using external shutter then set the exposure time
+                                    'Cam1_FrameRateOnOff': 0,
+                                    'Cam1_TriggerMode': 'Overlapped', #Ext. Standard
+                                    'Cam1_NumImages': 1}])
 
         wait_time_sec = int(params.exposure_time) + 5
-        global_PVs['Cam1_TriggerMode'].put('Overlapped', wait=True) #Ext. Standard
-        global_PVs['Cam1_NumImages'].put(1, wait=True)
         global_PVs['Cam1_Acquire'].put(DetectorAcquire)
         aps2bm.wait_pv(global_PVs['Cam1_Acquire'], DetectorAcquire, 2)
         global_PVs['Cam1_SoftwareTrigger'].put(1)
@@ -150,36 +248,31 @@ def set(global_PVs, params):
         log.info(' ')
         log.info('  *** setup FLIR camera')
 
-        if params.station == '2-BM-A':
-            global_PVs['Cam1_AttributeFile'].put('flir2bmaDetectorAttributes.xml')
-            global_PVs['HDF1_XMLFileName'].put('flir2bmaLayout.xml')           
-        else: # Mona (B-station)
-            global_PVs['Cam1_AttributeFile'].put('flir2bmbDetectorAttributes.xml', wait=True) 
-            global_PVs['HDF1_XMLFileName'].put('flir2bmbLayout.xml', wait=True) 
-
         global_PVs['Cam1_Acquire'].put(DetectorIdle)
+        _camera_config.apply(global_PVs, [_layout_settings(params)])
         aps2bm.wait_pv(global_PVs['Cam1_Acquire'], DetectorIdle, 2)
 
-        global_PVs['Cam1_TriggerMode'].put('Off', wait=True)
-        global_PVs['Cam1_TriggerSource'].put('Line2', wait=True)
-        global_PVs['Cam1_TriggerOverlap'].put('ReadOut', wait=True)
-        global_PVs['Cam1_ExposureMode'].put('Timed', wait=True)
-        global_PVs['Cam1_TriggerSelector'].put('FrameStart', wait=True)
-        global_PVs['Cam1_TriggerActivation'].put('RisingEdge', wait=True)
-
-        global_PVs['Cam1_ImageMode'].put('Multiple')
-        global_PVs['Cam1_ArrayCallbacks'].put('Enable')
-        #global_PVs['Image1_Callbacks'].put('Enable')
-        #global_PVs['Cam1_AcquirePeriod'].put(float(params.exposure_time))
-        global_PVs['Cam1_FrameRateOnOff'].put(0)
-        global_PVs['Cam1_AcquireTimeAuto'].put('Off')
-
-        global_PVs['Cam1_AcquireTime'].put(float(params.exposure_time))
-        # if we are using external shutter then set the exposure time
+        # the trigger settings are changed with the trigger mode off, and the trigger source, overlap and
+        # activation apply to the selected trigger so the selector goes first
+        _camera_config.apply(global_PVs, [
+            {'Cam1_TriggerMode': 'Off'},
+            {'Cam1_TriggerSelector': 'FrameStart',
+             'Cam1_ExposureMode': 'Timed',
+             'Cam1_ImageMode': 'Multiple',
+             'Cam1_ArrayCallbacks': 'Enable',
+             #'Image1_Callbacks': 'Enable',
+             #'Cam1_AcquirePeriod': float(params.exposure_time),
+             'Cam1_FrameRateOnOff': 0,
+             'Cam1_AcquireTimeAuto': 'Off'},
+            {'Cam1_TriggerSource': 'Line2',
+             'Cam1_TriggerOverlap': 'ReadOut',
+             'Cam1_TriggerActivation': 'RisingEdge',
+             # if we are using external shutter then set the exposure time
+             'Cam1_AcquireTime': float(params.exposure_time)},
+            {'Cam1_TriggerMode': 'On'},
+            ])
 
         wait_time_sec = int(params.exposure_time) + 5
-
-        global_PVs['Cam1_TriggerMode'].put('On', wait=True)
         log.info('  *** setup FLIR camera: Done!')
     
     else:
@@ -188,51 +281,60 @@ def set(global_PVs, params):
     if fname is None:
         log.warning('  *** hdf_writer will not be configured')
     else:
-        _setup_hdf_writer(global_PVs, params, fname)
+        _setup_hdf_writer(global_PVs, params, fname, references)
+    _camera_config.report('setup camera')
 
 
-def _setup_hdf_writer(global_PVs, params, fname=None):
+def _setup_hdf_writer(global_PVs, params, fname=None, references=True):
 
     if (params.camera_ioc_prefix == '2bmbPG3:') or (params.camera_ioc_prefix == '2bmbSP1:'):   
         # setup Point Grey hdf writer PV's
         log.info('  ')
         log.info('  *** setup hdf_writer')
-        _setup_frame_type(global_PVs, params)
+        settings = _frame_type_settings()
+        filter_reset = {}
         if params.recursive_filter == True:
             log.info('    *** Recursive Filter Enabled')
-            global_PVs['Proc1_Enable_Background'].put('Disable', wait=True)
-            global_PVs['Proc1_Enable_FlatField'].put('Disable', wait=True)
-            global_PVs['Proc1_Enable_Offset_Scale'].put('Disable', wait=True)
-            global_PVs['Proc1_Enable_Low_Clip'].put('Disable', wait=True)
-            global_PVs['Proc1_Enable_High_Clip'].put('Disable', wait=True)
-
-            global_PVs['Proc1_Callbacks'].put('Enable', wait=True)
-            global_PVs['Proc1_Filter_Enable'].put('Enable', wait=True)
-            global_PVs['HDF1_ArrayPort'].put('PROC1', wait=True)
-            global_PVs['Proc1_Filter_Type'].put(Recursive_Filter_Type, wait=True)
-            global_PVs['Proc1_Num_Filter'].put(int(params.recursive_filter_n_images), wait=True)
-            global_PVs['Proc1_Reset_Filter'].put(1, wait=True)
-            global_PVs['Proc1_AutoReset_Filter'].put('Yes', wait=True)
-            global_PVs['Proc1_Filter_Callbacks'].put('Array N only', wait=True)
-            log.info('    *** Recursive Filter Enabled: Done!')
+            settings.update({'Proc1_Enable_Background': 'Disable',
+                             'Proc1_Enable_FlatField': 'Disable',
+                             'Proc1_Enable_Offset_Scale': 'Disable',
+                             'Proc1_Enable_Low_Clip': 'Disable',
+                             'Proc1_Enable_High_Clip': 'Disable',
+                             'Proc1_Callbacks': 'Enable',
+                             'Proc1_Filter_Enable': 'Enable',
+                             'HDF1_ArrayPort': 'PROC1',
+                             'Proc1_Filter_Type': Recursive_Filter_Type,
+                             'Proc1_Num_Filter': int(params.recursive_filter_n_images)})
+            # the filter is reset once its type and number of images are set
+            filter_reset = {'Proc1_Reset_Filter': 1,
+                            'Proc1_AutoReset_Filter': 'Yes',
+                            'Proc1_Filter_Callbacks': 'Array N only'}
         else:
-            global_PVs['Proc1_Filter_Enable'].put('Disable')
-            global_PVs['HDF1_ArrayPort'].put(global_PVs['Proc1_ArrayPort'].get())
-        global_PVs['HDF1_AutoSave'].put('Yes')
-        global_PVs['HDF1_DeleteDriverFile'].put('No')
-        global_PVs['HDF1_EnableCallbacks'].put('Enable')
-        global_PVs['HDF1_BlockingCallbacks'].put('No')
+            settings.update({'Proc1_Filter_Enable': 'Disable',
+                             'HDF1_ArrayPort': global_PVs['Proc1_ArrayPort'].get()})
 
         # if (params.recursive_filter == False):
         #     params.recursive_filter_n_images = 1
 
         totalProj = ((int(params.num_projections / params.recursive_filter_n_images)) + int(params.num_dark_images) + \
                         int(params.num_white_images))
-
-        global_PVs['HDF1_NumCapture'].put(totalProj)
-        global_PVs['HDF1_FileWriteMode'].put(str(params.file_write_mode), wait=True)
+        if not references:
+            # the white and dark fields are linked from the file of an other scan
+            totalProj = int(params.num_projections / params.recursive_filter_n_images)
+
+        settings.update({'HDF1_AutoSave': 'Yes',
+                         'HDF1_DeleteDriverFile': 'No',
+                         'HDF1_EnableCallbacks': 'Enable',
+                         'HDF1_BlockingCallbacks': 'No',
+                         'HDF1_NumCapture': totalProj,
+                         'HDF1_FileWriteMode': str(params.file_write_mode)})
         if fname is not None:
-            global_PVs['HDF1_FileName'].put(str(fname), wait=True)
+            settings['HDF1_FileName'] = str(fname)
+        # capture starts once the file writer is set up
+        _camera_config.apply(global_PVs, [settings])
+        aps2bm.put_PVs(global_PVs, filter_reset)
+        if params.recursive_filter == True:
+            log.info('    *** Recursive Filter Enabled: Done!')
         global_PVs['HDF1_Capture'].put(1)
         aps2bm.wait_pv(global_PVs['HDF1_Capture'], 1)
         log.info('  *** setup hdf_writer: Done!')
@@ -241,10 +343,17 @@ def _setup_hdf_writer(global_PVs, params, fname=None):
         return
 
 
-def _setup_frame_type(global_PVs, params):
-    global_PVs['Cam1_FrameTypeZRST'].put('/exchange/data')
-    global_PVs['Cam1_FrameTypeONST'].put('/exchange/data_dark')
-    global_PVs['Cam1_FrameTypeTWST'].put('/exchange/data_white')
+def _layout_settings(params):
+    if params.station == '2-BM-A':
+        return {'Cam1_AttributeFile': 'flir2bmaDetectorAttributes.xml', 'HDF1_XMLFileName': 'flir2bmaLayout.xml'}
+    else: # Mona (B-station)
+        return {'Cam1_AttributeFile': 'flir2bmbDetectorAttributes.xml', 'HDF1_XMLFileName': 'flir2bmbLayout.xml'}
+
+
+def _frame_type_settings():
+    return {'Cam1_FrameTypeZRST': '/exchange/data',
+            'Cam1_FrameTypeONST': '/exchange/data_dark',
+            'Cam1_FrameTypeTWST': '/exchange/data_white'}
 
 
 
@@ -252,14 +361,15 @@ def acquire(global_PVs, params):
     theta = []
 
     # Estimate the time needed for the flyscan
-    angular_range =  params.sample_rotation_end -  params.sample_rotation_start
-    flyscan_time_estimate = angular_range / params.slew_speed
+    fly_model_time = motion.fly_model_time(global_PVs, params)
+    flyscan_time_estimate = motion.predict('fly', fly_model_time)
+    fly_timeout = motion.timeout(flyscan_time_estimate, None)
 
     # log.info(' ')
     log.warning('  *** Fly Scan Time Estimate: %4.2f minutes' % (flyscan_time_estimate/60.))
 
     global_PVs['Cam1_FrameType'].put(FrameTypeData, wait=True)
-    time.sleep(2)    
+    time.sleep(FRAME_TYPE_SETTLE)    
 
     # global_PVs['Cam1_AcquireTime'].put(float(params.exposure_time) )
 
@@ -268,6 +378,8 @@ def acquire(global_PVs, params):
 
     num_images = int(params.num_projections)  * params.recursive_filter_n_images   
     global_PVs['Cam1_NumImages'].put(num_images, wait=True)
+    # count the arrays the HDF plugin drops from this scan on
+    global_PVs['HDF1_DroppedArrays'].put(0, wait=True)
 
 
     # Set detectors
@@ -280,11 +392,18 @@ def acquire(global_PVs, params):
     global_PVs['Cam1_Acquire'].put(DetectorAcquire)
     aps2bm.wait_pv(global_PVs['Cam1_Acquire'], 1)
 
+    global _fly_first_id
+    _fly_first_id = int(global_PVs['Cam1_ArrayCounter_RBV'].get()) + 1
+
     log.info(' ')
     log.info('  *** Fly Scan: Start!')
-    global_PVs['Fly_Run'].put(1, wait=True)
+    tic = time.time()
+    global_PVs['Fly_Run'].put(1, wait=True, timeout=fly_timeout)
     # wait for acquire to finish 
-    aps2bm.wait_pv(global_PVs['Fly_Run'], 0)
+    if aps2bm.wait_pv(global_PVs['Fly_Run'], 0, fly_timeout):
+        motion.calibrate('fly', fly_model_time, time.time() - tic)
+    else:
+        log.error('  *** Fly Scan did not end in %4.2f s' % fly_timeout)
 
     # if the fly scan wait times out we should call done on the detector
 #    if aps2bm.wait_pv(global_PVs['Cam1_Acquire'], DetectorIdle, flyscan_time_estimate) == False:
@@ -305,96 +424,120 @@ def acquire(global_PVs, params):
         theta = np.mean(theta.reshape(-1, params.recursive_filter_n_images), axis=1)
     
     return theta
+
+
+def fly_counts(global_PVs, params):
+
+    # trigger and frame counters right after the fly scan, and the angle of every PSO trigger;
+    # reconcile_theta matches them with the frames saved in the HDF file once it is closed
+    num_triggers = int(global_PVs['Theta_Cnt'].get())
+    fly = {'triggers': num_triggers,
+           'camera': int(global_PVs['Cam1_NumImagesCounter'].get()),
+           'positions': global_PVs['Theta_Array'].get(count=num_triggers) if num_triggers > 0 else np.zeros(0),
+           'period': aps2bm.cached_get(global_PVs, 'Fly_ScanDelta') / aps2bm.cached_get(global_PVs, 'Fly_SlewSpeed'),
+           'frames_per_projection': max(int(params.recursive_filter_n_images), 1),
+           'first_id': _fly_first_id}
+    if fly['camera'] < num_triggers:
+        log.warning('  *** Camera missed %d of %d triggers' % (num_triggers - fly['camera'], num_triggers))
+    return fly
             
 
 def acquire_flat(global_PVs, params):
     log.info('      *** White Fields')
-   
-    global_PVs['Cam1_ImageMode'].put('Multiple')
-    global_PVs['Cam1_FrameType'].put(FrameTypeWhite)             
-
-    if (params.camera_ioc_prefix == '2bmbPG3:'):
-        global_PVs['Cam1_TriggerMode'].put('Overlapped')
-    elif (params.camera_ioc_prefix == '2bmbSP1:'):
-        global_PVs['Cam1_TriggerMode'].put('Off', wait=True)
-        
-    # Set detectors
-    if (params.camera_ioc_prefix == '2bmbPG3:'):   
-        wait_time_sec = int(params.exposure_time) + 5
-        global_PVs['Cam1_NumImages'].put(1)
-
-        for i in range(int(params.num_white_images) * params.recursive_filter_n_images):
-            global_PVs['Cam1_Acquire'].put(DetectorAcquire)
-            time.sleep(0.1)
-            aps2bm.wait_pv(global_PVs['Cam1_Acquire'], DetectorAcquire, 2)
-            time.sleep(0.1)
-            global_PVs['Cam1_SoftwareTrigger'].put(1, wait=True)
-            time.sleep(0.1)
-            aps2bm.wait_pv(global_PVs['Cam1_Acquire'], DetectorIdle, wait_time_sec)
-            time.sleep(0.1)
-
-    elif (params.camera_ioc_prefix == '2bmbSP1:'):
-        wait_time_sec = float(params.num_white_images) * float(params.exposure_time) + 60.0
-        global_PVs['Cam1_NumImages'].put(int(params.num_white_images))
-        global_PVs['Cam1_Acquire'].put(DetectorAcquire, wait=True, timeout=5.0) # it was 1000.0
-
-        # time.sleep(0.1)
-        if aps2bm.wait_pv(global_PVs['Cam1_Acquire'], DetectorIdle, wait_time_sec) == False: # adjust wait time
-            global_PVs['Cam1_Acquire'].put(DetectorIdle)
-    
+    _acquire_references(global_PVs, params, FrameTypeWhite, int(params.num_white_images), 'White Fields')
     log.info('      *** White Fields: Done!')
 
 
 def acquire_dark(global_PVs, params):
     log.info("      *** Dark Fields") 
-    global_PVs['Cam1_ImageMode'].put('Multiple')
-    global_PVs['Cam1_FrameType'].put(FrameTypeDark)             
-
-    if (params.camera_ioc_prefix == '2bmbPG3:'):
-        global_PVs['Cam1_TriggerMode'].put('Overlapped')
-    elif (params.camera_ioc_prefix == '2bmbSP1:'):
-        global_PVs['Cam1_TriggerMode'].put('Off', wait=True)
-        
-    # Set detectors
+    _acquire_references(global_PVs, params, FrameTypeDark, int(params.num_dark_images), 'Dark Fields')
     if (params.camera_ioc_prefix == '2bmbPG3:'):   
-
-        wait_time_sec = int(params.exposure_time) + 5
-        global_PVs['Cam1_NumImages'].put(1)
-
-        for i in range(int(params.num_dark_images) * params.recursive_filter_n_images):
-            global_PVs['Cam1_Acquire'].put(DetectorAcquire)
-            time.sleep(0.1)
-            aps2bm.wait_pv(global_PVs['Cam1_Acquire'], DetectorAcquire, 2)
-            time.sleep(0.1)
-            global_PVs['Cam1_SoftwareTrigger'].put(1, wait=True)
-            time.sleep(0.1)
-            aps2bm.wait_pv(global_PVs['Cam1_Acquire'], DetectorIdle, wait_time_sec)
-            time.sleep(0.1)
         aps2bm.wait_pv(global_PVs["HDF1_Capture_RBV"], 0, 600)
+    log.info('      *** Dark Fields: Done!')
+    log.info('  *** Acquisition: Done!')        
+
+
+def _acquire_references(global_PVs, params, frame_type, num_images, name):
+
+    # take all the flat or dark fields in a single acquisition, internally triggered. With the recursive
+    # filter on, the camera takes recursive_filter_n_images frames for each image saved in the file.
+    num_frames = num_images * params.recursive_filter_n_images
 
+    # Set detectors
+    if (params.camera_ioc_prefix == '2bmbPG3:'):
+        trigger_mode = 'Internal'
     elif (params.camera_ioc_prefix == '2bmbSP1:'):
-        wait_time_sec = float(params.num_dark_images) * float(params.exposure_time) + 60.0
-        global_PVs['Cam1_NumImages'].put(int(params.num_dark_images))
-        global_PVs['Cam1_Acquire'].put(DetectorAcquire, wait=True, timeout=5.0) # it was 1000.0
-        if aps2bm.wait_pv(global_PVs['Cam1_Acquire'], DetectorIdle, wait_time_sec) == False: # adjust wait time
-            global_PVs['Cam1_Acquire'].put(DetectorIdle)
+        trigger_mode = 'Off'
+    # the FLIR crashes when the image mode changes while the trigger mode is still changing: the trigger
+    # mode goes first, on its own
+    aps2bm.put_PVs_ordered(global_PVs, [{'Cam1_TriggerMode': trigger_mode},
+                                        {'Cam1_ImageMode': 'Multiple',
+                                         'Cam1_FrameType': frame_type,
+                                         'Cam1_NumImages': num_frames}])
+
+    wait_time_sec = num_frames * (float(params.exposure_time) + float(params.ccd_readout)) + 60.0
+    tic = time.time()
+    global_PVs['Cam1_Acquire'].put(DetectorAcquire, wait=True, timeout=5.0) # it was 1000.0
+    if aps2bm.wait_pv(global_PVs['Cam1_Acquire'], DetectorIdle, wait_time_sec) == False: # adjust wait time
+        global_PVs['Cam1_Acquire'].put(DetectorIdle)
+    acquire_time = time.time() - tic
 
-    log.info('      *** Dark Fields: Done!')
-    log.info('  *** Acquisition: Done!')        
+    num_acquired = global_PVs['Cam1_NumImagesCounter'].get()
+    if num_acquired != num_frames:
+        log.error('      *** %s: %s of %d frames acquired' % (name, num_acquired, num_frames))
+    if num_acquired:
+        log.info('      *** %s: %d frames in %4.2f s (%4.1f fps)' % (name, num_acquired, acquire_time, num_acquired / acquire_time))
 
 
 def checkclose_hdf(global_PVs, params):
 
-    buffer_queue = global_PVs['HDF1_QueueSize'].get() - global_PVs['HDF1_QueueFree'].get()
-    # wait_on_hdd = 10
-    frate = 55.0
-    wait_on_hdd = buffer_queue / frate + 10
-    # wait_on_hdd = (global_PVs['HDF1_QueueSize'].get() - global_PVs['HDF1_QueueFree'].get()) / 55.0 + 10
-    log.info('  *** Buffer Queue (frames): %d ' % buffer_queue)
-    log.info('  *** Wait HDD (s): %f' % wait_on_hdd)
-    if aps2bm.wait_pv(global_PVs["HDF1_Capture_RBV"], 0, wait_on_hdd) == False: # needs to wait for HDF plugin queue to dump to disk
+    # wait for the HDF plugin queue to dump to disk. The timeout is the time the remaining queue needs at the
+    # write rate measured now or, until it is, at the slowest rate of the previous scans; the poll interval is
+    # a fraction of it. Without any measured rate the fixed stall windows are used
+    queue_size = global_PVs['HDF1_QueueSize'].get()
+    queued = queue_size - global_PVs['HDF1_QueueFree'].get()
+    captured = global_PVs['HDF1_NumCaptured_RBV'].get()
+    log.info('  *** Buffer Queue (frames): %d ' % queued)
+
+    # the write rate is measured only over the intervals the writer was busy for, i.e. ended with frames still queued
+    start = last_sample = last_progress = time.time()
+    start_captured = captured
+    busy_frames = 0
+    busy_time = 0.0
+    history_rate = min(rate for fullname, frames, rate in _hdf_write_rates) if _hdf_write_rates else None
+    timeout, poll = _hdf_drain_timeout(queued, history_rate)
+    if history_rate:
+        log.info('  *** Wait HDD (s): %f at %4.1f frames/s of the previous scans' % (queued / history_rate, history_rate))
+    estimated = False
+    while global_PVs['HDF1_Capture_RBV'].get() == 1:
+        time.sleep(poll)
+        now = time.time()
+        new_queued = queue_size - global_PVs['HDF1_QueueFree'].get()
+        new_captured = global_PVs['HDF1_NumCaptured_RBV'].get()
+        if new_captured > captured or new_queued < queued:
+            last_progress = now
+        if new_queued > 0 and new_captured > captured:
+            busy_frames += new_captured - captured
+            busy_time += now - last_sample
+            if not estimated:
+                log.info('  *** Wait HDD (s): %f at %4.1f frames/s' % (new_queued * busy_time / busy_frames, busy_frames / busy_time))
+                estimated = True
+        queued, captured, last_sample = new_queued, new_captured, now
+        timeout, poll = _hdf_drain_timeout(queued, busy_frames / busy_time if busy_frames else history_rate)
+        if now - last_progress > timeout:
+            break
+
+    fullname = global_PVs['HDF1_FullFileName_RBV'].get(as_string=True)
+    if busy_frames > 0:
+        rate = busy_frames / busy_time
+        _hdf_write_rates.append((fullname, captured - start_captured, rate))
+        log.info('  *** HDF write rate (frames/s): %4.1f, %d frames drained in %4.2f s' % (rate, captured - start_captured, time.time() - start))
+    else:
+        log.info('  *** HDF queue drained in %4.2f s' % (time.time() - start))
+
+    if global_PVs['HDF1_Capture_RBV'].get() == 1:
         global_PVs["HDF1_Capture"].put(0)
-        log.info('  *** File was not closed => forced to close')
+        log.info('  *** File was not closed => forced to close (%d frames left in the queue)' % queued)
         log.info('      *** before %d' % global_PVs["HDF1_Capture_RBV"].get())
         aps2bm.wait_pv(global_PVs["HDF1_Capture_RBV"], 0, 5) 
         log.info('      *** after %d' % global_PVs["HDF1_Capture_RBV"].get())
@@ -402,31 +545,145 @@ def checkclose_hdf(global_PVs, params):
             log.error('  *** ERROR HDF FILE DID NOT CLOSE; add_theta will fail')
 
 
+def _hdf_drain_timeout(queued, rate):
+
+    # time without progress before the file is forced to close and poll interval, for the frames still queued
+    if not rate:
+        return (HDF_DRAIN_STALL if queued > 0 else HDF_DRAIN_IDLE), HDF_DRAIN_POLL
+    drain_time = queued / rate
+    return HDF_DRAIN_MARGIN * drain_time + HDF_DRAIN_IDLE, min(max(drain_time / 10.0, HDF_DRAIN_POLL_MIN), HDF_DRAIN_POLL)
+
+
+def log_hdf_write_stats():
+
+    if _hdf_write_rates:
+        rates = [rate for fullname, frames, rate in _hdf_write_rates]
+        log.info('  *** HDF write rate: %d files, mean %4.1f frames/s, min %4.1f frames/s' % (len(rates), np.mean(rates), np.min(rates)))
+
+
 def add_theta(global_PVs, params, theta_arr):
     log.info(' ')
     log.info('  *** add_theta')
     
     fullname = global_PVs['HDF1_FullFileName_RBV'].get(as_string=True)
     try:
-        hdf_f = h5py.File(fullname, mode='a')
-        if theta_arr is not None:
-            theta_ds = hdf_f.create_dataset('/exchange/theta', (len(theta_arr),))
-            theta_ds[:] = theta_arr[:]
-        hdf_f.close()
-        log.info('  *** add_theta: Done!')
+        write_theta(fullname, theta_arr)
     except:
         traceback.print_exc(file=sys.stdout)
         log.info('  *** add_theta: Failed accessing: %s' % fullname)
 
 
-def take_image(global_PVs, params):
+def write_theta(fullname, theta_arr):
 
+    # raises when the file cannot be written, add_theta logs the error
+    with h5py.File(fullname, mode='a') as hdf_f:
+        if theta_arr is not None:
+            theta_ds = hdf_f.create_dataset('/exchange/theta', (len(theta_arr),))
+            theta_ds[:] = theta_arr[:]
+    log.info('  *** add_theta: Done!')
+
+
+def link_references(fullname, reference_file):
+
+    # replace the empty white and dark fields of a scan taken without references by links to the ones of
+    # reference_file; the link is relative, so both files must stay in the same directory
+    with h5py.File(fullname, mode='a') as hdf_f:
+        for dataset in ('/exchange/data_white', '/exchange/data_dark'):
+            if dataset in hdf_f:
+                del hdf_f[dataset]
+            hdf_f[dataset] = h5py.ExternalLink(os.path.basename(reference_file), dataset)
+    log.info('  *** %s: white and dark fields linked to %s' % (fullname, reference_file))
+
+
+def reconcile_theta(fullname, fly):
+    """
+    Assign each projection saved in *fullname* the angle of the PSO trigger(s) it was exposed at, and
+    write them to /exchange/theta with the trigger index of each projection in /exchange/theta_index.
+
+    The first saved projection is placed by its NDArrayUniqueId after the id the camera gave the first
+    frame of the fly scan (fly['first_id']), so the frames the HDF plugin lost at the start do not shift
+    the angles. The triggers are evenly spaced in time, so the following projections are placed by their
+    NDArrayTimeStamp after the first one in units of the trigger period; frames lost by the camera or by
+    the HDF plugin leave gaps in the index instead of shifting all the following angles. Without time
+    stamps the NDArrayUniqueId gaps are used, which only find the frames lost after the camera. The
+    triggers the camera missed (Theta_Cnt - camera counter) that are not found between the saved
+    projections are reported: they cannot be located and are assumed to be at the end.
+
+    Parameters
+    ----------
+    fullname : str
+        Closed HDF file of the scan
+    fly : dict
+        Counters and trigger angles returned by fly_counts
+
+    Returns
+    -------
+    dict
+        triggers, camera (frames), saved (projections), dropped (projections) and drop_rate
+    """
+    n = fly['frames_per_projection']
+    positions = np.asarray(fly['positions'], dtype=float)
+    num_expected = len(positions) // n
+    angles = np.mean(positions[:num_expected * n].reshape(-1, n), axis=1)
+
+    with h5py.File(fullname, mode='a') as hdf_f:
+        num_saved = hdf_f['/exchange/data'].shape[0]
+        index = None
+        id_index = None
+        if '/defaults/NDArrayUniqueId' in hdf_f and num_saved > 0:
+            unique_ids = hdf_f['/defaults/NDArrayUniqueId'][:num_saved]
+            first_id = fly.get('first_id')
+            if first_id is None or unique_ids[0] < first_id:
+                first_id = unique_ids[0]
+            id_index = (unique_ids - first_id) // n
+        if '/defaults/NDArrayTimeStamp' in hdf_f and num_saved > 0 and fly['period'] > 0:
+            timestamps = hdf_f['/defaults/NDArrayTimeStamp'][:num_saved]
+            index = np.rint((timestamps - timestamps[0]) / (fly['period'] * n)).astype(int)
+            if id_index is not None:
+                index += id_index[0]
+        if (index is None or np.any(np.diff(index) <= 0)) and id_index is not None:
+            if index is not None:
+                log.warning('  *** %s: time stamps do not follow the triggers, using the unique ids' % fullname)
+            index = id_index
+        if index is None or np.any(np.diff(index) <= 0) or (num_saved and index[-1] >= num_expected):
+            log.warning('  *** %s: cannot match the frames to the triggers, assuming no frame was dropped' % fullname)
+            index = np.arange(num_saved)
+        index = np.minimum(index, max(num_expected - 1, 0))
+
+        if num_saved and id_index is not None:
+            # camera misses found as gaps: the projection index moved on more than the camera frame ids
+            found = (index[-1] - index[0]) - (id_index[-1] - id_index[0])
+            missed = (fly['triggers'] - fly['camera']) // n
+            if missed > found:
+                log.warning('  *** %s: %d projections missed by the camera before the first or after the last saved one, assumed at the end'
+                            % (fullname, missed - found))
+
+        theta = angles[index] if num_expected else np.zeros(num_saved)
+        for dataset, values in (('/exchange/theta', theta), ('/exchange/theta_index', index)):
+            if dataset in hdf_f:
+                del hdf_f[dataset]
+            hdf_f.create_dataset(dataset, data=values)
+
+    dropped = max(num_expected - num_saved, 0)
+    report = {'triggers': fly['triggers'], 'camera': fly['camera'], 'saved': num_saved, 'dropped': dropped,
+              'drop_rate': dropped / float(num_expected) if num_expected else 0.0}
+    if dropped:
+        log.warning('  *** %s: %d of %d projections dropped (%4.2f%%), camera got %d of %d triggers' 
+                    % (fullname, dropped, num_expected, 100 * report['drop_rate'], fly['camera'], fly['triggers']))
+    else:
+        log.info('  *** %s: all %d projections saved' % (fullname, num_saved))
+    return report
+
+
+def take_image(global_PVs, params, purpose='image'):
+
+    # returns the frame as uint8/uint16 (nRow, nCol) array. When the transferred array already has the
+    # pixel size it is returned as is (no copy), otherwise it is converted into the reusable buffer of
+    # purpose, which the next take_image for the same purpose overwrites. The transfer itself allocates
+    # a new array for each frame, see _fetch_image.
     log.info('  ***  *** taking a single image')
    
-    nRow = global_PVs['Cam1_SizeY_RBV'].get()
-    nCol = global_PVs['Cam1_SizeX_RBV'].get()
-
-    image_size = nRow * nCol
+    nRow, nCol, dtype = _frame_format(global_PVs)
 
     global_PVs['Cam1_NumImages'].put(1, wait=True)
 
@@ -439,32 +696,150 @@ def take_image(global_PVs, params):
         global_PVs['Cam1_Acquire'].put(DetectorIdle)
     
     # Get the image loaded in memory
-    img_vect = global_PVs['Cam1_Image'].get(count=image_size)
-    img = np.reshape(img_vect,[nRow, nCol])
-
-    pixelFormat = global_PVs['Cam1PixelFormat_RBV'].get(as_string=True)
-    if (pixelFormat == "Mono16"):
-        pixel_f = 16
-    elif (pixelFormat == "Mono8"):
-        pixel_f = 8
+    return _read_frame(global_PVs, params, nRow, nCol, dtype, purpose)
+
+
+def take_burst(global_PVs, params, num_frames, reduce='mean', purpose='image'):
+
+    # take num_frames frames in one acquisition and reduce them, as they arrive, into a float32 (nRow, nCol)
+    # array: their mean (summed in a float32 accumulator) or their median (frames kept in a preallocated
+    # stack). A new frame is signalled by the image1 array counter; frames arriving while the previous one
+    # is read are skipped and the reduction uses the frames that were read.
+    log.info('  ***  *** taking %d images (%s)' % (num_frames, reduce))
+
+    nRow, nCol, dtype = _frame_format(global_PVs)
+    if reduce == 'median':
+        stack = _frame_buffer(purpose + '_stack', (num_frames, nRow, nCol), dtype)
     else:
+        accumulator = _frame_buffer(purpose + '_sum', (nRow, nCol), np.float32)
+        accumulator.fill(0)
+
+    new_frame = threading.Event()
+    index = global_PVs['Cam1_ArrayCounter'].add_callback(lambda **kws: new_frame.set(), with_ctrlvars=False)
+    try:
+        # trigger mode first, on its own, as in _acquire_references
+        aps2bm.put_PVs_ordered(global_PVs, [{'Cam1_TriggerMode': 'Off'}, {'Cam1_ImageMode': 'Multiple', 'Cam1_NumImages': num_frames}])
+        wait_time_sec = float(params.exposure_time) + 5
+        tic = time.time()
+        last_counter = global_PVs['Cam1_ArrayCounter'].get()
+        new_frame.clear()
+        global_PVs['Cam1_Acquire'].put(DetectorAcquire)
+
+        num_read = 0
+        num_skipped = 0
+        while num_read < num_frames:
+            if not new_frame.wait(wait_time_sec):
+                log.error('  ***  *** no new frame after %4.2f s' % wait_time_sec)
+                break
+            new_frame.clear()
+            counter = global_PVs['Cam1_ArrayCounter'].get()
+            if counter == last_counter:
+                continue
+            num_skipped += max(counter - last_counter - 1, 0)
+            last_counter = counter
+            frame = _read_frame(global_PVs, params, nRow, nCol, dtype, purpose)
+            if reduce == 'median':
+                stack[num_read] = frame
+            else:
+                np.add(accumulator, frame, out=accumulator)
+            num_read += 1
+            if num_read + num_skipped >= num_frames:
+                break
+    finally:
+        global_PVs['Cam1_ArrayCounter'].remove_callback(index)
+    if aps2bm.wait_pv(global_PVs['Cam1_Acquire'], DetectorIdle, wait_time_sec) == False:
+        global_PVs['Cam1_Acquire'].put(DetectorIdle)
+
+    if num_read == 0:
+        log.error('  ***  *** no frame read')
+        return None
+    if reduce == 'median':
+        result = np.median(stack[:num_read], axis=0).astype(np.float32)
+    else:
+        result = accumulator / np.float32(num_read)
+    log.info('  ***  *** %s of %d frames (%d skipped) in %4.2f s' % (reduce, num_read, num_skipped, time.time() - tic))
+
+    return result
+
+
+def _frame_format(global_PVs):
+
+    nRow = aps2bm.cached_get(global_PVs, 'Cam1_SizeY_RBV')
+    nCol = aps2bm.cached_get(global_PVs, 'Cam1_SizeX_RBV')
+
+    pixelFormat = aps2bm.cached_get(global_PVs, 'Cam1PixelFormat_RBV', as_string=True)
+    if pixelFormat not in PIXEL_TYPES:
         log.error('  ***  *** bit %s format not supported' % pixelFormat)
         exit()
-    img_uint = np.mod(img, 2**pixel_f)
+    return nRow, nCol, np.dtype(PIXEL_TYPES[pixelFormat])
+
+
+def _read_frame(global_PVs, params, nRow, nCol, dtype, purpose):
+
+    image_size = nRow * nCol
+
+    tic = time.time()
+    img_vect, source = _fetch_image(global_PVs, params, image_size)
+    fetch_time = time.time() - tic
+
+    tic = time.time()
+    img_vect = np.ravel(img_vect)[:image_size]
+    if (img_vect.dtype.itemsize == dtype.itemsize) and img_vect.flags.c_contiguous:
+        # signed or unsigned pixels of the right size: reinterpret them in place
+        img_uint = img_vect.view(dtype).reshape(nRow, nCol)
+    else:
+        # wider pixels: the unsafe cast wraps them modulo 2**bits into the reusable buffer
+        img_uint = _frame_buffer(purpose, (nRow, nCol), dtype)
+        np.copyto(img_uint, img_vect.reshape(nRow, nCol), casting='unsafe')
+    convert_time = time.time() - tic
+    log.info('  ***  *** %s frame %dx%d %s: fetch %4.3f s (%s), convert %4.3f s' % (purpose, nCol, nRow, dtype.name, fetch_time, source, convert_time))
 
     return img_uint
 
 
+def _frame_buffer(purpose, shape, dtype):
+
+    buffer = _frame_buffers.get(purpose)
+    if (buffer is None) or (buffer.shape != shape) or (buffer.dtype != dtype):
+        buffer = np.empty(shape, dtype)
+        _frame_buffers[purpose] = buffer
+    return buffer
+
+
+def _fetch_image(global_PVs, params, image_size):
+
+    # read the last frame over PVAccess from NDPluginPva when configured, otherwise (or if that fails)
+    # over Channel Access from the image1 plugin. Returns the pixel array and the protocol used.
+    # Neither client reads into a caller's array: pyepics and p4p return a newly allocated array for
+    # every get, so the reusable buffers of _frame_buffer only save the allocation of the conversion.
+    global _pva_context
+    if params.pva_image_pv is not None:
+        if PvaContext is None:
+            log.warning('  ***  *** p4p is not installed: reading %s over Channel Access' % params.pva_image_pv)
+        else:
+            try:
+                if _pva_context is None:
+                    _pva_context = PvaContext('pva')
+                return _pva_context.get(params.pva_image_pv, timeout=PVA_TIMEOUT), 'pva'
+            except Exception as e:
+                log.warning('  ***  *** PVAccess read of %s failed (%s): reading over Channel Access' % (params.pva_image_pv, e))
+    return global_PVs['Cam1_Image'].get(count=image_size), 'ca'
+
+
 def take_flat(global_PVs, params):
 
     log.info('  ***  *** acquire white')
-    return take_image(global_PVs, params)
+    if params.reference_frames > 1:
+        return take_burst(global_PVs, params, params.reference_frames, params.reference_reduce, 'white')
+    return take_image(global_PVs, params, 'white')
 
 
 def take_dark(global_PVs, params):
     
     log.info('  ***  *** acquire dark')
-    return take_image(global_PVs, params)
+    if params.reference_frames > 1:
+        return take_burst(global_PVs, params, params.reference_frames, params.reference_reduce, 'dark')
+    return take_image(global_PVs, params, 'dark')
 
 
 def take_dark_and_white(global_PVs, params):
@@ -0,0 +1,265 @@
+# #########################################################################
+# Copyright (c) 2019-2020, UChicago Argonne, LLC. All rights reserved.    #
+#                                                                         #
+# Copyright 2019-2020. UChicago Argonne, LLC. This software was produced  #
+# under U.S. Government contract DE-AC02-06CH11357 for Argonne National   #
+# Laboratory (ANL), which is operated by UChicago Argonne, LLC for the    #
+# U.S. Department of Energy. The U.S. Government has rights to use,       #
+# reproduce, and distribute this software.  NEITHER THE GOVERNMENT NOR    #
+# UChicago Argonne, LLC MAKES ANY WARRANTY, EXPRESS OR IMPLIED, OR        #
+# ASSUMES ANY LIABILITY FOR THE USE OF THIS SOFTWARE.  If software is     #
+# modified to produce derivative works, such modified software should     #
+# be clearly marked, so as not to confuse it with the version available   #
+# from ANL.                                                               #
+#                                                                         #
+# Additionally, redistribution and use in source and binary forms, with   #
+# or without modification, are permitted provided that the following      #
+# conditions are met:                                                     #
+#                                                                         #
+#     * Redistributions of source code must retain the above copyright    #
+#       notice, this list of conditions and the following disclaimer.     #
+#                                                                         #
+#     * Redistributions in binary form must reproduce the above copyright #
+#       notice, this list of conditions and the following disclaimer in   #
+#       the documentation and/or other materials provided with the        #
+#       distribution.                                                     #
+#                                                                         #
+#     * Neither the name of UChicago Argonne, LLC, Argonne National       #
+#       Laboratory, ANL, the U.S. Government, nor the names of its        #
+#       contributors may be used to endorse or promote products derived   #
+#       from this software without specific prior written permission.     #
+#                                                                         #
+# THIS SOFTWARE IS PROVIDED BY UChicago Argonne, LLC AND CONTRIBUTORS     #
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT       #
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS       #
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL UChicago     #
+# Argonne, LLC OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT,        #
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING,    #
+# BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;        #
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER        #
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT      #
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN       #
+# ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE         #
+# POSSIBILITY OF SUCH DAMAGE.                                             #
+# #########################################################################
+
+"""
+Motion-time model of the rotary and linear stages.
+
+Each move follows a trapezoidal velocity profile: the motor reaches its speed (VELO) in ACCL s, moves at
+constant speed and slows down in ACCL s. A fly scan is one such move of the rotary stage at the slew speed
+from the taxi position (start minus the acceleration distance) to the end plus the deceleration distance.
+The model times are corrected by a per-motion calibration factor, an exponentially weighted moving average
+of measured / model time, so that the predictions and the timeouts follow the real stages.
+"""
+
+import numpy as np
+
+from tomo2bm import log
+
+TIMEOUT_FACTOR = 3.0          # a motion times out after this many times its predicted duration ...
+TIMEOUT_MARGIN = 30.0         # ... plus this margin (s)
+CALIBRATION_ALPHA = 0.3       # weight of the last measurement in the calibration factor
+CALIBRATION_MIN_TIME = 0.05   # s, shorter motions are not used for calibration
+
+# measured / model time of each motion, keyed by motor pv name, 'taxi' or 'fly'
+_calibration = {}
+
+
+def move_time(distance, velo, accl):
+    """
+    Duration of trapezoidal moves.
+
+    Parameters
+    ----------
+    distance : float or array
+        Move lengths (EGU)
+    velo : float or array
+        Slew speeds (EGU/s)
+    accl : float or array
+        Times to reach the slew speed (s), as in the motor record ACCL field
+
+    Returns
+    -------
+    float or array
+        Move durations (s). Moves too short to reach the slew speed follow a triangular profile.
+    """
+    distance = np.abs(np.asarray(distance, dtype=float))
+    velo = np.asarray(velo, dtype=float)
+    accl = np.maximum(np.asarray(accl, dtype=float), 1e-6)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        trapezoid = distance / velo + accl
+        triangle = 2 * np.sqrt(distance * accl / velo)
+        duration = np.where(distance >= velo * accl, trapezoid, triangle)
+    duration = np.where((velo > 0) & (distance > 0), duration, 0.0)
+    if duration.ndim == 0:
+        return float(duration)
+    return duration
+
+
+def motor_speed(global_PVs, motor):
+
+    # (VELO, ACCL) of a motor from its motor + '_Velo' / '_Accl' pv's, None when not available
+    try:
+        velo = global_PVs[motor + '_Velo'].get()
+        accl = global_PVs[motor + '_Accl'].get()
+    except KeyError:
+        return None
+    if (velo is None) or (accl is None):
+        return None
+    return float(velo), float(accl)
+
+
+def motor_position(global_PVs, motor):
+
+    return global_PVs.get(motor + '_RBV', global_PVs[motor]).get()
+
+
+def rotary_accl_time(global_PVs, params):
+
+    # time for the rotary stage to reach the slew speed: its ACCL field when available, otherwise
+    # from the accl_rot (deg/s^2) stage setting
+    speed = motor_speed(global_PVs, 'Motor_SampleRot')
+    if speed is not None:
+        return speed[1]
+    return params.slew_speed / params.accl_rot
+
+
+def predict(kind, model_time):
+
+    # model time corrected by the calibration of this motion
+    return model_time * _calibration.get(kind, 1.0)
+
+
+def calibrate(kind, model_time, measured_time):
+
+    # update the calibration of a motion with a measured duration
+    if (model_time is None) or (measured_time is None) or (model_time < CALIBRATION_MIN_TIME):
+        return
+    ratio = measured_time / model_time
+    _calibration[kind] = (1 - CALIBRATION_ALPHA) * _calibration.get(kind, ratio) + CALIBRATION_ALPHA * ratio
+    log.info('      *** *** %s: %4.2f s measured, %4.2f s model (calibration %4.2f)' % (kind, measured_time, model_time, _calibration[kind]))
+
+
+def timeout(predicted_time, default):
+
+    # timeout for a motion predicted to last predicted_time, default when there is no prediction
+    if predicted_time is None:
+        return default
+    return TIMEOUT_FACTOR * predicted_time + TIMEOUT_MARGIN
+
+
+def move_model_times(global_PVs, positions):
+
+    # {motor: model time (s)} to move each motor of positions from where it is now, None for the motors
+    # whose speed is not known
+    times = {}
+    for motor, position in positions.items():
+        speed = motor_speed(global_PVs, motor)
+        current = motor_position(global_PVs, motor)
+        if (speed is None) or (current is None):
+            times[motor] = None
+        else:
+            times[motor] = move_time(float(position) - current, *speed)
+    return times
+
+
+def planned_move_time(global_PVs, motor, distance):
+
+    # model time of a planned move of a motor by distance, None when its speed is not known
+    speed = motor_speed(global_PVs, motor)
+    if speed is None:
+        return None
+    return move_time(distance, *speed)
+
+
+def rotation_range(params, backward=False):
+
+    # fly scan start and end positions, swapped for a backward scan
+    if backward:
+        return params.sample_rotation_end, params.sample_rotation_start
+    return params.sample_rotation_start, params.sample_rotation_end
+
+
+def taxi_model_time(global_PVs, params, current=None, backward=False):
+
+    # model time of the taxi move from the current rotary position (or current) to the fly start position
+    speed = motor_speed(global_PVs, 'Motor_SampleRot')
+    if current is None:
+        current = motor_position(global_PVs, 'Motor_SampleRot')
+    if (speed is None) or (current is None):
+        return None
+    start, end = rotation_range(params, backward)
+    direction = np.sign(end - start) or 1
+    ramp = 0.5 * params.slew_speed * rotary_accl_time(global_PVs, params)
+    return move_time(start - direction * ramp - current, *speed)
+
+
+def fly_end_position(global_PVs, params, backward=False):
+
+    # where the rotary stage stops after the fly scan: the end position plus the deceleration distance
+    start, end = rotation_range(params, backward)
+    direction = np.sign(end - start) or 1
+    return end + direction * 0.5 * params.slew_speed * rotary_accl_time(global_PVs, params)
+
+
+def fly_model_time(global_PVs, params):
+
+    # model time of the fly move: the angular range at the slew speed plus the acceleration and deceleration
+    accl = rotary_accl_time(global_PVs, params)
+    angular_range = abs(params.sample_rotation_end - params.sample_rotation_start)
+    return move_time(angular_range + params.slew_speed * accl, params.slew_speed, accl)
+
+
+def predict_scan_time(global_PVs, params, start=None, backward=False):
+    """
+    Predict the duration of the motions and references of one tomo_fly_scan.
+
+    Parameters
+    ----------
+    start : float
+        Rotary stage position before the scan, by default where the previous fly scan ended, which
+        makes the taxi a no move in bidirectional series
+    backward : bool
+        Scan from the end to the start
+
+    Returns
+    -------
+    dict
+        Predicted time (s) of each phase (taxi, fly, sample out/in, flat and dark fields) and their 'total'.
+    """
+    if start is None:
+        start = fly_end_position(global_PVs, params, params.bidirectional != backward)
+
+    if params.sample_in_out == 'vertical':
+        motor = 'Motor_SampleY'
+    else:
+        motor = 'Motor_SampleX'
+    speed = motor_speed(global_PVs, motor)
+    sample_move = 0.0
+    if speed is not None:
+        sample_move = predict(motor, move_time(params.sample_out_position - params.sample_in_position, *speed))
+
+    n_images = params.recursive_filter_n_images if params.recursive_filter else 1
+    frame_time = float(params.exposure_time) + float(params.ccd_readout)
+
+    phases = {}
+    taxi = taxi_model_time(global_PVs, params, start, backward)
+    phases['taxi'] = predict('taxi', taxi) if taxi is not None else 0.0
+    phases['fly'] = predict('fly', fly_model_time(global_PVs, params))
+    phases['sample_out'] = sample_move
+    phases['flat'] = int(params.num_white_images) * n_images * frame_time
+    phases['sample_in'] = sample_move
+    phases['dark'] = int(params.num_dark_images) * n_images * frame_time
+    phases['total'] = sum(phases.values())
+    return phases
+
+
+def log_prediction(phases, name='per scan'):
+
+    log.info(' ')
+    log.info('  *** Predicted scan time')
+    for phase, predicted in phases.items():
+        if phase != 'total':
+            log.info('  *** *** %s: %4.2f s' % (phase, predicted))
+    log.info('  *** *** Predicted time %s: %4.2f s' % (name, phases['total']))
@@ -0,0 +1,178 @@
+# #########################################################################
+# Copyright (c) 2019-2020, UChicago Argonne, LLC. All rights reserved.    #
+#                                                                         #
+# Copyright 2019-2020. UChicago Argonne, LLC. This software was produced  #
+# under U.S. Government contract DE-AC02-06CH11357 for Argonne National   #
+# Laboratory (ANL), which is operated by UChicago Argonne, LLC for the    #
+# U.S. Department of Energy. The U.S. Government has rights to use,       #
+# reproduce, and distribute this software.  NEITHER THE GOVERNMENT NOR    #
+# UChicago Argonne, LLC MAKES ANY WARRANTY, EXPRESS OR IMPLIED, OR        #
+# ASSUMES ANY LIABILITY FOR THE USE OF THIS SOFTWARE.  If software is     #
+# modified to produce derivative works, such modified software should     #
+# be clearly marked, so as not to confuse it with the version available   #
+# from ANL.                                                               #
+#                                                                         #
+# Additionally, redistribution and use in source and binary forms, with   #
+# or without modification, are permitted provided that the following      #
+# conditions are met:                                                     #
+#                                                                         #
+#     * Redistributions of source code must retain the above copyright    #
+#       notice, this list of conditions and the following disclaimer.     #
+#                                                                         #
+#     * Redistributions in binary form must reproduce the above copyright #
+#       notice, this list of conditions and the following disclaimer in   #
+#       the documentation and/or other materials provided with the        #
+#       distribution.                                                     #
+#                                                                         #
+#     * Neither the name of UChicago Argonne, LLC, Argonne National       #
+#       Laboratory, ANL, the U.S. Government, nor the names of its        #
+#       contributors may be used to endorse or promote products derived   #
+#       from this software without specific prior written permission.     #
+#                                                                         #
+# THIS SOFTWARE IS PROVIDED BY UChicago Argonne, LLC AND CONTRIBUTORS     #
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT       #
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS       #
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL UChicago     #
+# Argonne, LLC OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT,        #
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING,    #
+# BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;        #
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER        #
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT      #
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN       #
+# ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE         #
+# POSSIBILITY OF SUCH DAMAGE.                                             #
+# #########################################################################
+
+"""
+Acquisition planner for the 2-BM fly scans.
+
+Sweeps exposure time, number of projections, rotation slow factor and camera binning on a grid and returns
+the fastest scan that meets the constraints of the planner config section:
+
+- blur: rotation during the exposure at the edge of the sensor, in binned pixels, as checked by
+  scan.calc_blur_pixel
+- angular sampling: number of projections as a fraction of the Nyquist number pi/2 * width * range/180
+- counts: white field counts per binned pixel, when the count rate of the beamline is known
+
+The scan time model is the one of scan.calc_blur_pixel: the camera frame time is exposure + readout, with
+the readout (ccd_readout for the full sensor) scaling with the number of rows of the ROI, and the rotary
+stage runs at the full frame rate speed times the slow factor.
+"""
+
+import numpy as np
+
+from tomo2bm import log
+from tomo2bm import aps2bm
+from tomo2bm import motion
+
+NUM_EXPOSURES = 60            # exposure times swept, log spaced between plan-exposure-min and max
+NUM_PROJECTIONS = 60          # numbers of projections swept between plan-projections-min and max
+SLOW_FACTORS = np.round(np.arange(1.0, 0.04, -0.05), 2)
+
+
+def sweep(params, width, rows, max_rows, accl_time=0.0, blur_width=None):
+    """
+    Evaluate every candidate scan of the planner grid.
+
+    Parameters
+    ----------
+    params : namespace
+        exposure, projections and binning ranges, ccd_readout, rotation range and number of references
+    width : int
+        Camera ROI width in unbinned pixels
+    rows, max_rows : int
+        Camera ROI and sensor height in unbinned pixels, scale the readout time
+    accl_time : float
+        Time for the rotary stage to reach the slew speed (s)
+    blur_width : int
+        Width in unbinned pixels the blur is computed at, the ROI width by default
+
+    Returns
+    -------
+    dict
+        Flat arrays, one entry per candidate: exposure_time, num_projections, rotation_slow_factor, binning,
+        readout, rot_speed, scan_time, total_time, blur, sampling, counts and feasible
+    """
+    exposures = np.geomspace(params.plan_exposure_min, params.plan_exposure_max, NUM_EXPOSURES)
+    projections = np.unique(np.linspace(params.plan_projections_min, params.plan_projections_max, NUM_PROJECTIONS).astype(int))
+    binnings = 2 ** np.arange(int(np.log2(params.plan_max_binning)) + 1)
+    exposure, num_projections, slow_factor, binning = [a.ravel() for a in np.meshgrid(exposures, projections, SLOW_FACTORS, binnings, indexing='ij')]
+
+    angular_range = abs(params.sample_rotation_end - params.sample_rotation_start)
+    readout = params.ccd_readout * rows / float(max_rows)
+    frame_time = exposure + readout
+    rot_speed = slow_factor * angular_range / (num_projections * frame_time)
+    scan_time = angular_range / rot_speed
+    num_references = (params.num_white_images + params.num_dark_images) * (params.recursive_filter_n_images if params.recursive_filter else 1)
+    total_time = scan_time + 2 * accl_time + num_references * frame_time
+
+    if blur_width is None:
+        blur_width = width
+    blur = blur_width / (2.0 * binning) * np.sin(np.radians(exposure * rot_speed))
+    sampling = num_projections / (np.pi / 2 * width / binning * angular_range / 180.0)
+    counts = params.plan_count_rate * exposure * binning ** 2
+
+    feasible = (blur <= params.plan_max_blur) & (sampling >= params.plan_min_sampling)
+    if params.plan_count_rate > 0:
+        feasible &= counts >= params.plan_min_counts
+
+    return {'exposure_time': exposure, 'num_projections': num_projections, 'rotation_slow_factor': slow_factor,
+            'binning': binning, 'readout': np.broadcast_to(readout, exposure.shape), 'rot_speed': rot_speed,
+            'scan_time': scan_time, 'total_time': total_time, 'blur': blur, 'sampling': sampling,
+            'counts': counts, 'feasible': feasible}
+
+
+def best(candidates):
+    """Index of the fastest feasible candidate (lowest blur among equally fast ones), None if none is feasible."""
+    feasible = np.flatnonzero(candidates['feasible'])
+    if len(feasible) == 0:
+        return None
+    order = np.lexsort((candidates['blur'][feasible], np.round(candidates['total_time'][feasible], 3)))
+    return feasible[order[0]]
+
+
+def plan(global_PVs, params):
+    """
+    Find the fastest feasible scan for the current camera ROI.
+
+    Returns
+    -------
+    dict
+        The chosen candidate (see sweep), or None when no candidate meets the constraints
+    """
+    width = aps2bm.cached_get(global_PVs, 'Cam1_SizeX')
+    rows = aps2bm.cached_get(global_PVs, 'Cam1_SizeY')
+    max_rows = aps2bm.cached_get(global_PVs, 'Cam1_MaxSizeY_RBV')
+    # the blur at the sensor edge, as calc_blur_pixel checks it before the scan
+    candidates = sweep(params, width, rows, max_rows, motion.rotary_accl_time(global_PVs, params),
+                       aps2bm.cached_get(global_PVs, 'Cam1_MaxSizeX_RBV'))
+
+    log.info(' ')
+    log.info('  *** Plan scan: %d candidates, %d feasible' % (len(candidates['feasible']), np.count_nonzero(candidates['feasible'])))
+    if params.plan_count_rate <= 0:
+        log.warning('  *** Plan scan: --plan-count-rate not set, the counts constraint is not used')
+    index = best(candidates)
+    if index is None:
+        log.error('  *** Plan scan: no scan meets blur <= %4.2f pixels and sampling >= %4.2f' % (params.plan_max_blur, params.plan_min_sampling))
+        return None
+
+    result = {name: values[index].item() for name, values in candidates.items()}
+    log.info('  *** *** Exposure Time: %f s' % result['exposure_time'])
+    log.info('  *** *** Projections: %d' % result['num_projections'])
+    log.info('  *** *** Rotation slow factor: %4.2f' % result['rotation_slow_factor'])
+    log.info('  *** *** Binning: %d' % result['binning'])
+    log.info('  *** *** Blur: %4.2f pixels, angular sampling: %4.2f, counts: %d' % (result['blur'], result['sampling'], result['counts']))
+    log.info('  *** *** Scan Time: %4.2f s (total %4.2f s with references)' % (result['scan_time'], result['total_time']))
+    return result
+
+
+def apply(global_PVs, params, result, camera=True):
+    """Set the planned exposure, projections, slow factor and binning in *params* and, with *camera*, in the camera."""
+    params.exposure_time = result['exposure_time']
+    params.num_projections = result['num_projections']
+    params.rotation_slow_factor = result['rotation_slow_factor']
+    if camera:
+        aps2bm.put_PVs(global_PVs, {'Cam1_AcquireTime': result['exposure_time'],
+                                    'Cam1_BinX': result['binning'],
+                                    'Cam1_BinY': result['binning']})
+        log.info('  *** Plan scan: applied')
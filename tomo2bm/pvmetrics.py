@@ -0,0 +1,219 @@
+# #########################################################################
+# Copyright (c) 2019-2020, UChicago Argonne, LLC. All rights reserved.    #
+#                                                                         #
+# Copyright 2019-2020. UChicago Argonne, LLC. This software was produced  #
+# under U.S. Government contract DE-AC02-06CH11357 for Argonne National   #
+# Laboratory (ANL), which is operated by UChicago Argonne, LLC for the    #
+# U.S. Department of Energy. The U.S. Government has rights to use,       #
+# reproduce, and distribute this software.  NEITHER THE GOVERNMENT NOR    #
+# UChicago Argonne, LLC MAKES ANY WARRANTY, EXPRESS OR IMPLIED, OR        #
+# ASSUMES ANY LIABILITY FOR THE USE OF THIS SOFTWARE.  If software is     #
+# modified to produce derivative works, such modified software should     #
+# be clearly marked, so as not to confuse it with the version available   #
+# from ANL.                                                               #
+#                                                                         #
+# Additionally, redistribution and use in source and binary forms, with   #
+# or without modification, are permitted provided that the following      #
+# conditions are met:                                                     #
+#                                                                         #
+#     * Redistributions of source code must retain the above copyright    #
+#       notice, this list of conditions and the following disclaimer.     #
+#                                                                         #
+#     * Redistributions in binary form must reproduce the above copyright #
+#       notice, this list of conditions and the following disclaimer in   #
+#       the documentation and/or other materials provided with the        #
+#       distribution.                                                     #
+#                                                                         #
+#     * Neither the name of UChicago Argonne, LLC, Argonne National       #
+#       Laboratory, ANL, the U.S. Government, nor the names of its        #
+#       contributors may be used to endorse or promote products derived   #
+#       from this software without specific prior written permission.     #
+#                                                                         #
+# THIS SOFTWARE IS PROVIDED BY UChicago Argonne, LLC AND CONTRIBUTORS     #
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT       #
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS       #
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL UChicago     #
+# Argonne, LLC OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT,        #
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING,    #
+# BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;        #
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER        #
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT      #
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN       #
+# ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE         #
+# POSSIBILITY OF SUCH DAMAGE.                                             #
+# #########################################################################
+
+"""
+Per-pv latency instrumentation.
+
+The pv's of the global_PVs dictionary can be wrapped in an InstrumentedPV that records, for each pv,
+the number of get/put/wait calls, a latency histogram, the number of timeouts and the bytes moved by
+array pv's (Theta_Array, Cam1_Image, ...). The metrics are exported at the end of a run as JSON and,
+optionally, as a Prometheus text file.
+"""
+
+import json
+import time
+import threading
+
+import numpy as np
+
+from tomo2bm import log
+
+# upper bounds (s) of the latency histogram buckets, the last bucket is +Inf
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+OPERATIONS = ('get', 'put', 'wait')
+
+# metrics of all instrumented pv's, keyed by global_PVs name
+_metrics = {}
+_lock = threading.Lock()
+
+
+def _new_metrics(pvname):
+
+    metrics = {'pvname': pvname}
+    for op in OPERATIONS:
+        metrics[op] = {'count': 0, 'timeouts': 0, 'bytes': 0, 'total': 0.0, 'max': 0.0, 'buckets': [0] * (len(BUCKETS) + 1)}
+    return metrics
+
+
+def _nbytes(value):
+
+    if isinstance(value, np.ndarray):
+        return value.nbytes
+    return 0
+
+
+class InstrumentedPV(object):
+    """
+    Wrap a pv and time its get and put calls. Everything else is passed through to the wrapped pv.
+    """
+
+    def __init__(self, name, pv):
+        self.__dict__['_name'] = name
+        self.__dict__['_pv'] = pv
+        with _lock:
+            _metrics.setdefault(name, _new_metrics(pv.pvname))
+
+    def __getattr__(self, attr):
+        return getattr(self._pv, attr)
+
+    def __setattr__(self, attr, value):
+        setattr(self._pv, attr, value)
+
+    def __repr__(self):
+        return '<InstrumentedPV %s: %r>' % (self._name, self._pv)
+
+    def record(self, op, elapsed, timeout=False, nbytes=0):
+
+        metrics = _metrics[self._name][op]
+        with _lock:
+            metrics['count'] += 1
+            metrics['total'] += elapsed
+            metrics['max'] = max(metrics['max'], elapsed)
+            metrics['bytes'] += nbytes
+            metrics['buckets'][np.searchsorted(BUCKETS, elapsed)] += 1
+            if timeout:
+                metrics['timeouts'] += 1
+
+    def record_wait(self, elapsed, timeout=False):
+        self.record('wait', elapsed, timeout)
+
+    def record_get(self, elapsed, value):
+        self.record('get', elapsed, value is None, _nbytes(value))
+
+    def get(self, *args, **kws):
+        tic = time.time()
+        value = self._pv.get(*args, **kws)
+        self.record_get(time.time() - tic, value)
+        return value
+
+    def put(self, value, *args, **kws):
+        tic = time.time()
+        callback = kws.get('callback')
+        if (callback is not None) and not kws.get('wait'):
+            # the put returns once sent: record the time to its completion, when the callback runs;
+            # aps2bm.put_PVs records the puts that never complete as timeouts
+            def on_complete(*cb_args, **cb_kws):
+                self.record('put', time.time() - tic, nbytes=_nbytes(value))
+                return callback(*cb_args, **cb_kws)
+            kws['callback'] = on_complete
+            return self._pv.put(value, *args, **kws)
+        ret = self._pv.put(value, *args, **kws)
+        # a put with wait=True returns a negative status when it did not complete in time
+        self.record('put', time.time() - tic, ret is not None and ret < 0, _nbytes(value))
+        return ret
+
+
+def instrument(global_PVs):
+
+    # wrap in place all pv's of global_PVs that are not instrumented yet
+    for name, pv in global_PVs.items():
+        if not isinstance(pv, InstrumentedPV):
+            global_PVs[name] = InstrumentedPV(name, pv)
+    return global_PVs
+
+
+def metrics():
+
+    # copy of the per-pv metrics with the mean latency added
+    with _lock:
+        result = json.loads(json.dumps(_metrics))
+    for name, pv_metrics in result.items():
+        for op in OPERATIONS:
+            count = pv_metrics[op]['count']
+            pv_metrics[op]['mean'] = pv_metrics[op]['total'] / count if count else 0.0
+    return result
+
+
+def top(n=10, key='total'):
+
+    # the n (name, op, metrics) entries with the largest key (total time by default)
+    entries = [(name, op, pv_metrics[op]) for name, pv_metrics in metrics().items() for op in OPERATIONS]
+    entries = [entry for entry in entries if entry[2]['count']]
+    return sorted(entries, key=lambda entry: entry[2][key], reverse=True)[:n]
+
+
+def log_top(n=10):
+
+    log.info('  *** PV calls taking the most time:')
+    for name, op, op_metrics in top(n):
+        log.info('  *** *** %-28s %-4s %6d calls, total %7.2f s, mean %7.4f s, max %7.4f s, %d timeouts' \
+                    % (name, op, op_metrics['count'], op_metrics['total'], op_metrics['mean'], op_metrics['max'], op_metrics['timeouts']))
+
+
+def export_json(fname):
+
+    with open(fname, 'w') as f:
+        json.dump({'buckets': BUCKETS, 'pvs': metrics()}, f, indent=2, sort_keys=True)
+    log.info('  *** PV metrics saved at %s' % fname)
+
+
+def export_prometheus(fname):
+
+    # Prometheus text exposition format, for the node exporter textfile collector
+    lines = ['# HELP tomo2bm_pv_latency_seconds Latency of the pv get/put/wait calls.',
+             '# TYPE tomo2bm_pv_latency_seconds histogram']
+    for name, pv_metrics in sorted(metrics().items()):
+        for op in OPERATIONS:
+            op_metrics = pv_metrics[op]
+            if not op_metrics['count']:
+                continue
+            labels = 'name="%s",pv="%s",op="%s"' % (name, pv_metrics['pvname'], op)
+            cumulative = np.cumsum(op_metrics['buckets'])
+            for le, count in zip(BUCKETS + ('+Inf',), cumulative):
+                lines.append('tomo2bm_pv_latency_seconds_bucket{%s,le="%s"} %d' % (labels, le, count))
+            lines.append('tomo2bm_pv_latency_seconds_sum{%s} %f' % (labels, op_metrics['total']))
+            lines.append('tomo2bm_pv_latency_seconds_count{%s} %d' % (labels, op_metrics['count']))
+    for metric, key, text in (('tomo2bm_pv_timeouts_total', 'timeouts', 'Number of pv calls that timed out.'),
+                              ('tomo2bm_pv_bytes_total', 'bytes', 'Bytes transferred by array pv calls.')):
+        lines.append('# HELP %s %s' % (metric, text))
+        lines.append('# TYPE %s counter' % metric)
+        for name, pv_metrics in sorted(metrics().items()):
+            for op in OPERATIONS:
+                if pv_metrics[op]['count']:
+                    lines.append('%s{name="%s",pv="%s",op="%s"} %d' % (metric, name, pv_metrics['pvname'], op, pv_metrics[op][key]))
+
+    with open(fname, 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+    log.info('  *** PV metrics saved at %s' % fname)
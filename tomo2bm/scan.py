@@ -7,243 +7,366 @@ import time
 import signal
 import numpy as np
 
-from tomo2bm import dm
 from tomo2bm import log
 from tomo2bm import flir
 from tomo2bm import aps2bm
-from tomo2bm import config
+from tomo2bm import motion
+from tomo2bm import planner
+from tomo2bm import autotune
+from tomo2bm import finalize
+from tomo2bm import timeline
+
+# file with the white and dark fields of the last scan that took them
+_reference_file = None
+# (fly counts, finalize record) of the last scan, until the slow factor is updated from its dropped projections
+_autotune_pending = None
 
 
 def fly_scan(params):
 
-    tic =  time.time()
+    run_series(params, 'standard')
+
+
+def fly_scan_vertical(params):
+
+    run_series(params, 'vertical')
+
+
+def fly_scan_mosaic(params):
+
+    run_series(params, 'mosaic')
+
+
+def run_series(params, scan_type):
+    """Compile the standard, vertical or mosaic series of params into a plan and run it."""
     global_PVs = aps2bm.init_general_PVs(params)
     aps2bm.user_info_params_update_from_pv(global_PVs, params)
 
     try: 
-        detector_sn = global_PVs['Cam1_SerialNumber'].get()
-        if ((detector_sn == None) or (detector_sn == 'Unknown')):
-            log.info('*** The Point Grey Camera with EPICS IOC prefix %s is down' % params.camera_ioc_prefix)
-            log.info('  *** Failed!')
-        else:
-            log.info('*** The Point Grey Camera with EPICS IOC prefix %s and serial number %s is on' \
-                        % (params.camera_ioc_prefix, detector_sn))
-            
-            # calling global_PVs['Cam1_AcquireTime'] to replace the default 'ExposureTime' with the one set in the camera
-            params.exposure_time = global_PVs['Cam1_AcquireTime'].get()
-            # calling calc_blur_pixel() to replace the default 'SlewSpeed' 
-            rot_speed = calc_blur_pixel(global_PVs, params)
-            params.slew_speed = rot_speed
+        if _camera_on(global_PVs, params):
+            _prepare(global_PVs, params)
 
             # init camera
             flir.init(global_PVs, params)
 
-            log.info(' ')
-            log.info("  *** Running %d sleep scans" % params.sleep_steps)
-            for i in np.arange(0, params.sleep_steps, 1):
-                tic_01 =  time.time()
-                # set sample file name
-                #fname = str('{:03}'.format(global_PVs['HDF1_FileNumber'].get())) + '_' + global_PVs['Sample_Name'].get(as_string=True)
-                params.scan_counter = global_PVs['HDF1_FileNumber'].get()
-                params.file_path = global_PVs['HDF1_FilePath'].get(as_string=True)
-                params.file_name = str('{:03}'.format(global_PVs['HDF1_FileNumber'].get())) + '_' + global_PVs['Sample_Name'].get(as_string=True)
-                log.info(' ')
-                log.info('  *** Start scan %d/%d' % (i, (params.sleep_steps -1)))
-                tomo_fly_scan(global_PVs, params)
-                if ((i+1)!= params.sleep_steps):
-                    log.warning('  *** Wait (s): %s ' % str(params.sleep_time))
-                    time.sleep(params.sleep_time) 
-
-                log.info(' ')
-                log.info('  *** Data file: %s' % global_PVs['HDF1_FullFileName_RBV'].get(as_string=True))
-                log.info('  *** Total scan time: %s minutes' % str((time.time() - tic_01)/60.))
-                log.info('  *** Scan Done!')
-    
-                dm.scp(global_PVs, params)
+            plan = compile_plan(global_PVs, params, scan_type)
+            log_plan(plan)
+            run_plan(global_PVs, params, plan)
+
+    except  KeyError:
+        log.error('  *** Some PV assignment failed!')
+        pass
 
-            log.info('  *** Total loop scan time: %s minutes' % str((time.time() - tic)/60.))
- 
-            log.info('  *** Moving rotary stage to start position')
-            global_PVs["Motor_SampleRot"].put(params.sample_rotation_start, wait=True, timeout=600.0)
-            log.info('  *** Moving rotary stage to start position: Done!')
 
-            global_PVs['Cam1_ImageMode'].put('Continuous')
- 
-            log.info('  *** Done!')
+def plan_only(params, scan_type):
+    """Compile and log the plan of a series without moving any motor or setting the camera."""
+    global_PVs = aps2bm.init_general_PVs(params)
+
+    try: 
+        if _camera_on(global_PVs, params):
+            _prepare(global_PVs, params, apply=False)
+            plan = compile_plan(global_PVs, params, scan_type)
+            log_plan(plan)
+            return plan
 
     except  KeyError:
         log.error('  *** Some PV assignment failed!')
         pass
 
 
-def fly_scan_vertical(params):
+def _camera_on(global_PVs, params):
 
-    tic =  time.time()
-    global_PVs = aps2bm.init_general_PVs(params)
-    aps2bm.user_info_params_update_from_pv(global_PVs, params)
+    detector_sn = global_PVs['Cam1_SerialNumber'].get()
+    if ((detector_sn == None) or (detector_sn == 'Unknown')):
+        log.info('*** The Point Grey Camera with EPICS IOC prefix %s is down' % params.camera_ioc_prefix)
+        log.info('  *** Failed!')
+        return False
+    log.info('*** The Point Grey Camera with EPICS IOC prefix %s and serial number %s is on' \
+                % (params.camera_ioc_prefix, detector_sn))
+    return True
 
-    try: 
-        detector_sn = global_PVs['Cam1_SerialNumber'].get()
-        if ((detector_sn == None) or (detector_sn == 'Unknown')):
-            log.info('*** The Point Grey Camera with EPICS IOC prefix %s is down' % params.camera_ioc_prefix)
-            log.info('  *** Failed!')
+
+def _prepare(global_PVs, params, apply=True):
+
+    # calling global_PVs['Cam1_AcquireTime'] to replace the default 'ExposureTime' with the one set in the camera
+    params.exposure_time = global_PVs['Cam1_AcquireTime'].get()
+    binning = None
+    if params.auto_plan:
+        # replace exposure time, projections, slow factor and binning with the fastest feasible scan
+        result = planner.plan(global_PVs, params)
+        if result is not None:
+            planner.apply(global_PVs, params, result, camera=apply)
+            binning = result['binning']
+    if params.auto_slow_factor:
+        autotune.start(global_PVs, params)
+    # calling calc_blur_pixel() to replace the default 'SlewSpeed' 
+    rot_speed = calc_blur_pixel(global_PVs, params, binning)
+    params.slew_speed = rot_speed
+
+
+def compile_plan(global_PVs, params, scan_type):
+    """
+    Compile the scans of a standard, vertical or mosaic series.
+
+    Returns
+    -------
+    list of dict
+        One entry per scan in acquisition order with: index, repeat (sleep step), v, h and y, x (tile indices and
+        positions, None when the stage does not move), file_name, suffix (file_name without the file number),
+        references, backward (rotation from the end to the start), after (the {motor: position} moves once the
+        scan is done), sleep (s) and predicted (s, moves and scan without the sleep)
+    """
+    if scan_type == 'vertical':
+        ys = np.arange(params.vertical_scan_start, params.vertical_scan_end, params.vertical_scan_step_size)
+        xs = [None]
+    elif scan_type == 'mosaic':
+        # set scan stop so also ends are included
+        ys = np.arange(params.vertical_scan_start, params.vertical_scan_end + params.vertical_scan_step_size, params.vertical_scan_step_size)
+        xs = np.arange(params.horizontal_scan_start, params.horizontal_scan_end + params.horizontal_scan_step_size, params.horizontal_scan_step_size)
+    else:
+        ys = [None]
+        xs = [None]
+    if scan_type == 'mosaic':
+        tiles = mosaic_tiles(global_PVs, params, ys, xs)
+    else:
+        tiles = [(v, y, h, x, h == 0) for v, y in enumerate(ys) for h, x in enumerate(xs)]
+    num_scans = params.sleep_steps * len(tiles)
+
+    # back to the first tile after each repeat
+    after = {}
+    if scan_type == 'vertical':
+        after = {'Motor_SampleY': ys[0]}
+    elif scan_type == 'mosaic':
+        after = {'Motor_SampleY': ys[0], 'Motor_SampleX': xs[0]}
+        if not params.bidirectional:
+            after['Motor_SampleRot'] = params.sample_rotation_start
+
+    file_number = aps2bm.cached_get(global_PVs, 'HDF1_FileNumber')
+    sample_name = aps2bm.cached_get(global_PVs, 'Sample_Name', as_string=True)
+    positions = {'Motor_SampleY': motion.motor_position(global_PVs, 'Motor_SampleY'), 'Motor_SampleX': params.sample_in_position,
+                 'Motor_SampleRot': motion.motor_position(global_PVs, 'Motor_SampleRot')}
+    # a bidirectional series left at the end of the rotation by the last one starts backward
+    rotation = positions['Motor_SampleRot']
+    first_backward = (rotation is not None) and (abs(rotation - params.sample_rotation_end) < abs(rotation - params.sample_rotation_start))
+    # the phases of the first scan, from where the rotary stage is now; the taxi of each scan is added below
+    phases = motion.predict_scan_time(global_PVs, params, rotation, _backward(params, 0, file_number, first_backward))
+    phases['frame_type'] = flir.FRAME_TYPE_SETTLE
+    phases['shutters'] = aps2bm.shutter_time(params)
+    phases['total'] += phases['frame_type'] + phases['shutters']
+    motion.log_prediction(phases, 'of the first scan')
+    references_time = phases['sample_out'] + phases['flat'] + phases['sample_in'] + phases['dark']
+
+    plan = []
+    for repeat in range(params.sleep_steps):
+        for v, y, h, x, row_start in tiles:
+            index = len(plan)
+            # mosaic tiles come with their row start
+            if scan_type == 'vertical':
+                row_start = v == 0
+            elif scan_type == 'standard':
+                row_start = index == 0
+            suffix = '_' + sample_name
+            if scan_type == 'mosaic':
+                suffix += '_y' + str(v) + '_x' + str(h)
+            entry = {'index': index, 'repeat': repeat, 'v': v, 'h': h, 'y': y, 'x': x,
+                     'file_name': str('{:03}'.format(file_number + index)) + suffix, 'suffix': suffix,
+                     'references': take_references(params, index, num_scans, row_start),
+                     'backward': _backward(params, index, file_number + index, first_backward), 'after': {}, 'sleep': 0.0}
+
+            predicted = phases['total'] - phases['taxi'] - (0.0 if entry['references'] else references_time)
+            taxi = motion.taxi_model_time(global_PVs, params, positions['Motor_SampleRot'], entry['backward'])
+            if taxi is not None:
+                predicted += motion.predict('taxi', taxi)
+            positions['Motor_SampleRot'] = motion.fly_end_position(global_PVs, params, entry['backward'])
+            moves = {}
+            if y is not None:
+                moves['Motor_SampleY'] = y
+            if x is not None and not entry['references']:
+                # without references the sample goes straight from the last tile to this one
+                moves['Motor_SampleX'] = x
+            predicted += _predicted_moves(global_PVs, positions, moves)
+            if x is not None:
+                positions['Motor_SampleX'] = x
+
+            if (v, h) == tiles[-1][:3:2]:
+                entry['after'] = after
+                predicted += _predicted_moves(global_PVs, positions, after)
+                if repeat < params.sleep_steps - 1:
+                    entry['sleep'] = float(params.sleep_time)
+            entry['predicted'] = predicted
+            plan.append(entry)
+    return plan
+
+
+def _backward(params, index, file_number, first_backward=False):
+
+    # bidirectional series alternate the rotation from scan to scan, reverse alternates it with the file number
+    if params.bidirectional:
+        return (index % 2 == 1) != first_backward
+    return (params.reverse == 'True') and (file_number % 2 == 1)
+
+
+def mosaic_tiles(global_PVs, params, ys, xs):
+    """
+    Order the mosaic tiles for the motor travel.
+
+    Parameters
+    ----------
+    ys, xs : array
+        Y and X tile positions (mm), tile indices follow their order
+
+    Returns
+    -------
+    list of tuple
+        (v, y, h, x, row_start) in acquisition order, row_start is True for the first tile of each row (or column)
+    """
+    by_rows = [[(v, y, h, x) for h, x in enumerate(xs)] for v, y in enumerate(ys)]
+    by_columns = [[(v, y, h, x) for v, y in enumerate(ys)] for h, x in enumerate(xs)]
+    orders = {'raster': _sweep(by_rows, False), 'serpentine': _sweep(by_rows, True),
+              'serpentine by columns': _sweep(by_columns, True)}
+    travel = {name: _travel_time(global_PVs, tiles) for name, tiles in orders.items()}
+
+    name = params.mosaic_order
+    if name == 'travel':
+        if None in travel.values():
+            log.warning('  *** Motor speeds are not known: using the serpentine mosaic order')
+            name = 'serpentine'
         else:
-            log.info('*** The Point Grey Camera with EPICS IOC prefix %s and serial number %s is on' \
-                        % (params.camera_ioc_prefix, detector_sn))
-            
-            # calling global_PVs['Cam1_AcquireTime'] to replace the default 'ExposureTime' with the one set in the camera
-            params.exposure_time = global_PVs['Cam1_AcquireTime'].get()
-            # calling calc_blur_pixel() to replace the default 'SlewSpeed' 
-            rot_speed = calc_blur_pixel(global_PVs, params)
-            params.slew_speed = rot_speed
+            name = min(['serpentine', 'serpentine by columns'], key=lambda order: travel[order])
+    if travel[name] is not None:
+        log.info('  *** Mosaic order %s: predicted travel %4.2f s, %4.2f s less than raster' % (name, travel[name], travel['raster'] - travel[name]))
+    return orders[name]
 
-            start_y = params.vertical_scan_start
-            end_y = params.vertical_scan_end
-            step_size_y = params.vertical_scan_step_size
 
-            # init camera
-            flir.init(global_PVs, params)
+def _sweep(lines, serpentine):
 
-            log.info(' ')
-            log.info("  *** Running %d scans" % params.sleep_steps)
-            log.info(' ')
-            log.info('  *** Vertical Positions (mm): %s' % np.arange(start_y, end_y, step_size_y))
-
-            for ii in np.arange(0, params.sleep_steps, 1):
-                log.info(' ')
-                log.info('  *** Start scan %d/%d' % (ii, (params.sleep_steps -1)))
-                for i in np.arange(start_y, end_y, step_size_y):
-                    tic_01 =  time.time()
-                    params.scan_counter = global_PVs['HDF1_FileNumber'].get()
-                    # set sample file name
-                    params.file_path = global_PVs['HDF1_FilePath'].get(as_string=True)
-                    params.file_name = str('{:03}'.format(global_PVs['HDF1_FileNumber'].get())) + '_' + global_PVs['Sample_Name'].get(as_string=True)
-
-                    log.info(' ')
-                    log.info('  *** The sample vertical position is at %s mm' % (i))
-                    global_PVs['Motor_SampleY'].put(i, wait=True, timeout=1000.0)
-                    tomo_fly_scan(global_PVs, params)
-
-                    log.info(' ')
-                    log.info('  *** Data file: %s' % global_PVs['HDF1_FullFileName_RBV'].get(as_string=True))
-                    log.info('  *** Total scan time: %s minutes' % str((time.time() - tic_01)/60.))
-                    log.info('  *** Scan Done!')
-        
-                    dm.scp(global_PVs, params)
-
-                log.info('  *** Moving vertical stage to start position')
-                global_PVs['Motor_SampleY'].put(start_y, wait=True, timeout=1000.0)
-
-                if ((ii+1)!=params.sleep_steps):
-                    log.warning('  *** Wait (s): %s ' % str(params.sleep_time))
-                    time.sleep(params.sleep_time) 
-
-            log.info('  *** Total loop scan time: %s minutes' % str((time.time() - tic)/60.))
-            log.info('  *** Moving rotary stage to start position')
-            global_PVs["Motor_SampleRot"].put(params.sample_rotation_start, wait=True, timeout=600.0)
-            log.info('  *** Moving rotary stage to start position: Done!')
-
-            global_PVs['Cam1_ImageMode'].put('Continuous')
- 
-            log.info('  *** Done!')
+    # tiles line after line, every other line reversed for the serpentine
+    tiles = []
+    for i, line in enumerate(lines):
+        if serpentine and i % 2 == 1:
+            line = line[::-1]
+        tiles += [tile + (j == 0,) for j, tile in enumerate(line)]
+    return tiles
 
-    except  KeyError:
-        log.error('  *** Some PV assignment failed!')
-        pass
 
+def _travel_time(global_PVs, tiles):
 
-def fly_scan_mosaic(params):
+    # predicted time of the Y and X moves between the tiles and back to the first one, None when a speed is unknown
+    total = 0.0
+    path = tiles + tiles[:1]
+    for (_, y0, _, x0, _), (_, y1, _, x1, _) in zip(path[:-1], path[1:]):
+        times = [0.0]
+        for motor, distance in (('Motor_SampleY', y1 - y0), ('Motor_SampleX', x1 - x0)):
+            if distance:
+                model_time = motion.planned_move_time(global_PVs, motor, float(distance))
+                if model_time is None:
+                    return None
+                times.append(motion.predict(motor, model_time))
+        total += max(times)
+    return total
 
-    tic =  time.time()
-    global_PVs = aps2bm.init_general_PVs(params)
-    aps2bm.user_info_params_update_from_pv(global_PVs, params)
 
-    try: 
-        detector_sn = global_PVs['Cam1_SerialNumber'].get()
-        if ((detector_sn == None) or (detector_sn == 'Unknown')):
-            log.info('*** The Point Grey Camera with EPICS IOC prefix %s is down' % params.camera_ioc_prefix)
-            log.info('  *** Failed!')
-        else:
-            log.info('*** The Point Grey Camera with EPICS IOC prefix %s and serial number %s is on' \
-                        % (params.camera_ioc_prefix, detector_sn))
-            
-            # calling global_PVs['Cam1_AcquireTime'] to replace the default 'ExposureTime' with the one set in the camera
-            params.exposure_time = global_PVs['Cam1_AcquireTime'].get()
-            # calling calc_blur_pixel() to replace the default 'SlewSpeed' 
-            rot_speed = calc_blur_pixel(global_PVs, params)
-            params.slew_speed = rot_speed
+def _predicted_moves(global_PVs, positions, moves):
+
+    # predicted time of moving the motors together from the planned positions, which are updated
+    times = [0.0]
+    for motor, position in moves.items():
+        if positions.get(motor) is not None:
+            model_time = motion.planned_move_time(global_PVs, motor, float(position) - positions[motor])
+            if model_time is not None:
+                times.append(motion.predict(motor, model_time))
+        positions[motor] = position
+    return max(times)
 
-            start_y = params.vertical_scan_start
-            end_y = params.vertical_scan_end
-            step_size_y = params.vertical_scan_step_size
 
+def log_plan(plan):
 
-            start_x = params.horizontal_scan_start
-            end_x = params.horizontal_scan_end
-            step_size_x = params.horizontal_scan_step_size
+    log.info(' ')
+    log.info('  *** Scan plan: %d scans' % len(plan))
+    for entry in plan:
+        position = ''
+        if entry['y'] is not None:
+            position += ' y %s mm' % entry['y']
+        if entry['x'] is not None:
+            position += ' x %s mm' % entry['x']
+        log.info('  *** *** %3d %s%s%s%s: %4.2f s%s' % (entry['index'], entry['file_name'], position,
+                 ', references' if entry['references'] else '', ', backward' if entry['backward'] else '', entry['predicted'],
+                 ', then wait %s s' % entry['sleep'] if entry['sleep'] else ''))
+    log.warning('  *** Predicted time for %d scans: %4.2f minutes' % (len(plan), _plan_time(plan, 'predicted') / 60.))
 
-            # set scan stop so also ends are included
-            stop_x = end_x + step_size_x
-            stop_y = end_y + step_size_y
 
-            # init camera
-            flir.init(global_PVs, params)
+def _plan_time(plan, key):
 
+    return sum(entry[key] + entry['sleep'] for entry in plan if entry.get(key) is not None)
+
+
+def run_plan(global_PVs, params, plan):
+
+    tic =  time.time()
+    y = None
+    log.info(' ')
+    log.info("  *** Running %d scans" % len(plan))
+    for entry in plan:
+        tic_01 =  time.time()
+        if entry['y'] is not None and entry['y'] != y:
             log.info(' ')
-            log.info("  *** Running %d sleep scans" % params.sleep_steps)
-            for ii in np.arange(0, params.sleep_steps, 1):
-                tic_01 =  time.time()
-
-                log.info(' ')
-                log.info("  *** Running %d mosaic scans" % (len(np.arange(start_x, stop_x, step_size_x)) * len(np.arange(start_y, stop_y, step_size_y))))
-                log.info(' ')
-                log.info('  *** Horizontal Positions (mm): %s' % np.arange(start_x, stop_x, step_size_x))
-                log.info('  *** Vertical Positions (mm): %s' % np.arange(start_y, stop_y, step_size_y))
-
-                h = 0
-                v = 0
-                
-                for i in np.arange(start_y, stop_y, step_size_y):
-                    log.info(' ')
-                    log.error('  *** The sample vertical position is at %s mm' % (i))
-                    global_PVs['Motor_SampleY'].put(i, wait=True)
-                    for j in np.arange(start_x, stop_x, step_size_x):
-                        log.error('  *** The sample horizontal position is at %s mm' % (j))
-                        params.sample_in_position = j
-                        params.scan_counter = global_PVs['HDF1_FileNumber'].get()
-                        # set sample file name
-                        params.file_path = global_PVs['HDF1_FilePath'].get(as_string=True)
-                        params.file_name = str('{:03}'.format(global_PVs['HDF1_FileNumber'].get())) + '_' + global_PVs['Sample_Name'].get(as_string=True) + '_y' + str(v) + '_x' + str(h)
-                        tomo_fly_scan(global_PVs, params)
-                        h = h + 1
-                        dm.scp(global_PVs, params)
-                    log.info(' ')
-                    log.info('  *** Total scan time: %s minutes' % str((time.time() - tic)/60.))
-                    log.info('  *** Data file: %s' % global_PVs['HDF1_FullFileName_RBV'].get(as_string=True))
-                    v = v + 1
-                    h = 0
-
-                log.info('  *** Moving vertical stage to start position')
-                global_PVs['Motor_SampleY'].put(start_y, wait=True, timeout=1000.0)
-
-                log.info('  *** Moving horizontal stage to start position')
-                global_PVs['Motor_SampleX'].put(start_x, wait=True, timeout=1000.0)
-
-                log.info('  *** Moving rotary stage to start position')
-                global_PVs["Motor_SampleRot"].put(params.sample_rotation_start, wait=True, timeout=600.0)
-                log.info('  *** Moving rotary stage to start position: Done!')
-
-                if ((ii+1)!=params.sleep_steps):
-                    log.warning('  *** Wait (s): %s ' % str(params.sleep_time))
-                    time.sleep(params.sleep_time) 
-
-                global_PVs['Cam1_ImageMode'].put('Continuous')
-
-                log.info('  *** Done!')
+            log.info('  *** The sample vertical position is at %s mm' % (entry['y']))
+            aps2bm.move_motors(global_PVs, {'Motor_SampleY': entry['y']})
+            y = entry['y']
+        if entry['x'] is not None:
+            log.info('  *** The sample horizontal position is at %s mm' % (entry['x']))
+            params.sample_in_position = entry['x']
+
+        # set sample file name
+        params.scan_counter = aps2bm.cached_get(global_PVs, 'HDF1_FileNumber')
+        params.file_path = aps2bm.cached_get(global_PVs, 'HDF1_FilePath', as_string=True)
+        params.file_name = str('{:03}'.format(params.scan_counter)) + entry['suffix']
+        if params.file_name != entry['file_name']:
+            log.warning('  *** File name %s instead of the planned %s' % (params.file_name, entry['file_name']))
+        log.info(' ')
+        log.info('  *** Start scan %d/%d' % (entry['index'], len(plan) - 1))
+        tomo_fly_scan(global_PVs, params, entry['references'], entry['backward'])
+
+        if entry['after']:
+            log.info('  *** Moving back to the first position')
+            aps2bm.move_motors(global_PVs, entry['after'])
+            y = entry['after'].get('Motor_SampleY', y)
+        entry['measured'] = time.time() - tic_01
+        if entry['sleep']:
+            log.warning('  *** Wait (s): %s ' % str(entry['sleep']))
+            time.sleep(entry['sleep']) 
 
-    except  KeyError:
-        log.error('  *** Some PV assignment failed!')
-        pass
+        log.info(' ')
+        log.info('  *** Data file: %s' % global_PVs['HDF1_FullFileName_RBV'].get(as_string=True))
+        log.info('  *** Total scan time: %s minutes (predicted %4.2f minutes)' % (str(entry['measured']/60.), entry['predicted']/60.))
+        log.info('  *** Scan Done!')
+        remaining = plan[entry['index'] + 1:]
+        if remaining:
+            # remaining time corrected by the measured / predicted ratio of the scans done so far
+            done = plan[:entry['index'] + 1]
+            ratio = sum(e['measured'] for e in done) / sum(e['predicted'] for e in done)
+            log.info('  *** Remaining %d scans: %4.2f minutes' % (len(remaining), (ratio * sum(e['predicted'] for e in remaining) + sum(e['sleep'] for e in remaining)) / 60.))
+
+    measured = time.time() - tic
+    update_slow_factor(global_PVs, params)
+    predicted = _plan_time(plan, 'predicted')
+    log.info('  *** Total loop scan time: %s minutes' % str(measured/60.))
+    log.info('  *** Predicted loop scan time: %4.2f minutes (%+4.1f%%)' % (predicted/60., 100. * (predicted - measured) / measured))
+    aps2bm.log_shutter_stats()
+    aps2bm.log_pv_cache_stats()
+    flir.log_hdf_write_stats()
+    finalize.log_status()
+
+    if params.bidirectional:
+        log.info('  *** Rotary stage left at %s' % str(motion.motor_position(global_PVs, 'Motor_SampleRot')))
+    else:
+        log.info('  *** Moving rotary stage to start position')
+        aps2bm.move_motors(global_PVs, {'Motor_SampleRot': params.sample_rotation_start})
+        log.info('  *** Moving rotary stage to start position: Done!')
+
+    global_PVs['Cam1_ImageMode'].put('Continuous')
+
+    log.info('  *** Done!')
 
 
 def dummy_scan(params):
@@ -271,7 +394,7 @@ def set_image_factor(global_PVs, params):
     return params.recursive_filter_n_images
 
    
-def tomo_fly_scan(global_PVs, params):
+def tomo_fly_scan(global_PVs, params, references=True, backward=False):
     log.info(' ')
     log.info('  *** start_scan')
 
@@ -286,28 +409,37 @@ def tomo_fly_scan(global_PVs, params):
 
     # moved to outer loop in main()
     # init(global_PVs, params)
+    update_slow_factor(global_PVs, params)
     set_image_factor(global_PVs, params)
 
     rotation_start = params.sample_rotation_start
     rotation_end = params.sample_rotation_end
 
-    if ((params.reverse == 'True') and ((params.scan_counter % 2) == 1)):
-        params.sample_rotation_start = rotation_end
-        params.sample_rotation_end = rotation_start
+    # a backward scan flies from the end to the start, theta is saved in acquisition order
+    if backward:
+        log.info('  *** Backward rotation')
+        params.sample_rotation_start, params.sample_rotation_end = motion.rotation_range(params, backward)
 
-    aps2bm.set_pso(global_PVs, params)
+    timeline.start(params)
+    with timeline.phase('pso_taxi'):
+        aps2bm.set_pso(global_PVs, params)
 
     # fname = global_PVs['HDF1_FileName'].get(as_string=True)
     log.info('  *** File name prefix: %s' % params.file_name)
-    flir.set(global_PVs, params) 
+    with timeline.phase('camera_set'):
+        flir.set(global_PVs, params, references) 
 
-    aps2bm.open_shutters(global_PVs, params)
-    aps2bm.move_sample_in(global_PVs, params)
+    with timeline.phase('shutter_open'):
+        aps2bm.open_shutters(global_PVs, params)
+    with timeline.phase('sample_in'):
+        aps2bm.move_sample_in(global_PVs, params)
 
 
-    theta = flir.acquire(global_PVs, params)
+    with timeline.phase('fly'):
+        theta = flir.acquire(global_PVs, params)
+        fly = flir.fly_counts(global_PVs, params)
 
-    if ((params.reverse == 'True') and ((params.scan_counter % 2) == 1)):
+    if backward:
         params.sample_rotation_start = rotation_start
         params.sample_rotation_end = rotation_end
 
@@ -316,22 +448,71 @@ def tomo_fly_scan(global_PVs, params):
         # print('\x1b[2;30;41m' + '  *** Rotary Stage ERROR. Theta stopped at: ***' + theta_end + '\x1b[0m')
         log.error('  *** Rotary Stage ERROR. Theta stopped at: %s ***' % str(theta_end))
 
-    aps2bm.move_sample_out(global_PVs, params)
-    flir.acquire_flat(global_PVs, params)
-    aps2bm.move_sample_in(global_PVs, params)
+    global _reference_file, _autotune_pending
+    fullname = global_PVs['HDF1_FullFileName_RBV'].get(as_string=True)
+    if references:
+        with timeline.phase('sample_out'):
+            aps2bm.move_sample_out(global_PVs, params)
+        with timeline.phase('flats'):
+            flir.acquire_flat(global_PVs, params)
+        with timeline.phase('sample_in'):
+            aps2bm.move_sample_in(global_PVs, params)
+
+    with timeline.phase('shutter_close'):
+        aps2bm.close_shutters(global_PVs, params)
+
+    if references:
+        with timeline.phase('darks'):
+            flir.acquire_dark(global_PVs, params)
+    with timeline.phase('hdf_close'):
+        flir.checkclose_hdf(global_PVs, params)
+
+    # add theta, update the config file and transfer the data while the next scan runs
+    scan_timeline = timeline.stop(fullname)
+    if references:
+        _reference_file = fullname
+        record = finalize.submit(params, fullname, theta, fly, timeline=scan_timeline)
+    else:
+        record = finalize.submit(params, fullname, theta, fly, _reference_file, timeline=scan_timeline)
+
+    # the rotation of the next scan is tuned from the projections dropped by this one once the finalize worker
+    # has counted them, see update_slow_factor
+    if params.auto_slow_factor:
+        _autotune_pending = (fly, record)
 
-    aps2bm.close_shutters(global_PVs, params)
-    time.sleep(2)
 
-    flir.acquire_dark(global_PVs, params)
-    flir.checkclose_hdf(global_PVs, params)
-    flir.add_theta(global_PVs, params, theta)
+def update_slow_factor(global_PVs, params):
 
-    # update config file
-    config.update_config(params)
+    # speed up or slow down the rotation from the projections dropped by the last scan. Called before the next
+    # scan and at the end of the series rather than right after the scan, so the acquisition only waits for
+    # the finalize worker when it is still counting the frames once the moves between the scans are done
+    global _autotune_pending
+    if _autotune_pending is not None:
+        fly, record = _autotune_pending
+        _autotune_pending = None
+        autotune.update(global_PVs, params, fly, finalize.frames(record), record['file'])
 
 
-def calc_blur_pixel(global_PVs, params):
+def take_references(params, scan_index, num_scans, row_start):
+    """
+    Whether scan *scan_index* of a series of *num_scans* takes its own white and dark fields.
+
+    The first scan of a series always does. With --reference-policy every-n-scans every reference-every-n
+    scans do, with per-row the first scan of each vertical pass or mosaic row (*row_start*) does and with
+    series-ends the last scan does too.
+    """
+    if scan_index == 0 or params.reference_policy == 'every-scan':
+        return True
+    if params.reference_policy == 'every-n-scans':
+        return scan_index % params.reference_every_n == 0
+    if params.reference_policy == 'per-row':
+        return row_start
+    if params.reference_policy == 'series-ends':
+        return scan_index == num_scans - 1
+    return True
+
+
+def calc_blur_pixel(global_PVs, params, binning=None):
     """
     Calculate the blur error (pixel units) due to a rotary stage fly scan motion durng the exposure.
     
@@ -349,6 +530,8 @@ def calc_blur_pixel(global_PVs, params):
         Tomographic scan angle start
     variableDict[''Projections'] : int
         Numember of projections
+    binning : int
+        Camera binning, read from the camera when not given; the blur is in binned pixels
 
     Returns
     -------
@@ -363,7 +546,9 @@ def calc_blur_pixel(global_PVs, params):
     max_rot_speed = angular_range / min_scan_time
 
     max_blur_delta = params.exposure_time * max_rot_speed
-    mid_detector = global_PVs['Cam1_MaxSizeX_RBV'].get() / 2.0
+    if binning is None:
+        binning = aps2bm.cached_get(global_PVs, 'Cam1_BinX') or 1
+    mid_detector = aps2bm.cached_get(global_PVs, 'Cam1_MaxSizeX_RBV') / (2.0 * binning)
     max_blur_pixel = mid_detector * np.sin(max_blur_delta * np.pi /180.)
     max_frame_rate = params.num_projections / min_scan_time
 
@@ -372,7 +557,6 @@ def calc_blur_pixel(global_PVs, params):
 
 
     blur_delta = params.exposure_time * rot_speed  
-    mid_detector = global_PVs['Cam1_MaxSizeX_RBV'].get() / 2.0
     blur_pixel = mid_detector * np.sin(blur_delta * np.pi /180.)
 
     frame_rate = params.num_projections / scan_time
@@ -383,7 +567,8 @@ def calc_blur_pixel(global_PVs, params):
     log.info("  *** *** Exposure Time: %s s" % params.exposure_time)
     log.info("  *** *** Readout Time: %s s" % params.ccd_readout)
     log.info("  *** *** Angular Range: %s degrees" % angular_range)
-    log.info("  *** *** Camera X size: %s " % global_PVs['Cam1_SizeX'].get())
+    log.info("  *** *** Camera X size: %s " % aps2bm.cached_get(global_PVs, 'Cam1_SizeX'))
+    log.info("  *** *** Camera binning: %s " % binning)
     log.info(' ')
     log.info("  *** *** *** *** Angular Step: %4.2f degrees" % angular_step)   
     log.info("  *** *** *** *** Scan Time: %4.2f (min %4.2f) s" % (scan_time, min_scan_time))
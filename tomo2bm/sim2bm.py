@@ -0,0 +1,763 @@
+# #########################################################################
+# Copyright (c) 2019-2020, UChicago Argonne, LLC. All rights reserved.    #
+#                                                                         #
+# Copyright 2019-2020. UChicago Argonne, LLC. This software was produced  #
+# under U.S. Government contract DE-AC02-06CH11357 for Argonne National   #
+# Laboratory (ANL), which is operated by UChicago Argonne, LLC for the    #
+# U.S. Department of Energy. The U.S. Government has rights to use,       #
+# reproduce, and distribute this software.  NEITHER THE GOVERNMENT NOR    #
+# UChicago Argonne, LLC MAKES ANY WARRANTY, EXPRESS OR IMPLIED, OR        #
+# ASSUMES ANY LIABILITY FOR THE USE OF THIS SOFTWARE.  If software is     #
+# modified to produce derivative works, such modified software should     #
+# be clearly marked, so as not to confuse it with the version available   #
+# from ANL.                                                               #
+#                                                                         #
+# Additionally, redistribution and use in source and binary forms, with   #
+# or without modification, are permitted provided that the following      #
+# conditions are met:                                                     #
+#                                                                         #
+#     * Redistributions of source code must retain the above copyright    #
+#       notice, this list of conditions and the following disclaimer.     #
+#                                                                         #
+#     * Redistributions in binary form must reproduce the above copyright #
+#       notice, this list of conditions and the following disclaimer in   #
+#       the documentation and/or other materials provided with the        #
+#       distribution.                                                     #
+#                                                                         #
+#     * Neither the name of UChicago Argonne, LLC, Argonne National       #
+#       Laboratory, ANL, the U.S. Government, nor the names of its        #
+#       contributors may be used to endorse or promote products derived   #
+#       from this software without specific prior written permission.     #
+#                                                                         #
+# THIS SOFTWARE IS PROVIDED BY UChicago Argonne, LLC AND CONTRIBUTORS     #
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT       #
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS       #
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL UChicago     #
+# Argonne, LLC OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT,        #
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING,    #
+# BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;        #
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER        #
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT      #
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN       #
+# ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE         #
+# POSSIBILITY OF SUCH DAMAGE.                                             #
+# #########################################################################
+
+"""
+Simulated Sector 2-BM IOCs used as an in-process pv backend.
+
+Covers the sample stack motors (trapezoidal moves using VELO and ACCL), the PSO fly scan controller,
+the shutters, the FLIR / Point Grey camera and its HDF5 file writer plugin so that the scan code can be
+run, and timed, without the beamline: tomo scan --pv-backend sim
+"""
+
+import os
+import re
+import time
+import queue
+import threading
+import numpy as np
+import h5py
+
+from tomo2bm import log
+
+MOTOR_VELO = 5.0                # default motor speed (EGU/s)
+MOTOR_ACCL = 0.2                # default motor acceleration time (s)
+MOTOR_UPDATE = 0.05             # s, period of the RBV updates during a move
+
+SHUTTER_DELAY = 1.0             # s, time for the A and B shutter status to follow the open/close command
+
+PSO_CALC_DELAY = 0.1            # s, time for the PSO controller to update numTriggers
+
+CAMERA_SIZE = (1224, 1024)      # sensor (x, y) size
+CAMERA_READOUT = 0.01           # s
+DARK_LEVEL = 100.0
+FLAT_LEVEL = 30000.0
+NOISE_LEVEL = 50.0
+
+HDF_QUEUE_SIZE = 2000           # frames
+HDF_WRITE_RATE = 200.0          # frames/s written to disk by the HDF5 plugin
+
+PIXEL_SIZE = 2.0                # um, to project the alignment sphere on the detector
+SPHERE_RADIUS = 0.25            # mm
+
+# sample stack motors of each station, used to draw the sphere in the simulated images
+STAGES = {
+    '2-BM-A': {'rot': '2bma:m82', 'x': '2bma:m49', 'y': '2bma:m20', 'top_0': '2bmS1:m2', 'top_90': '2bmS1:m1'},
+    '2-BM-B': {'rot': '2bmb:m100', 'x': '2bmb:m63', 'y': '2bmb:m57', 'top_0': '2bmb:m76', 'top_90': '2bmb:m77'},
+    }
+
+# rotary stage driven by each PSO fly scan controller
+PSO_MOTORS = {'2bma:PSOFly2': '2bma:m82', '2bmb:PSOFly': '2bmb:m100'}
+
+SHUTTER_STATUS = {'A': 'PA:02BM:STA_A_FES_OPEN_PL', 'B': 'PA:02BM:STA_B_SBS_OPEN_PL'}
+FAST_SHUTTER = '2bma:m23'
+
+ENUMS = {
+    'cam1:ImageMode': ['Single', 'Multiple', 'Continuous'],
+    'cam1:TriggerMode': ['Internal', 'Overlapped', 'Off', 'On'],
+    'cam1:PixelFormat_RBV': ['Mono8', 'Mono16'],
+    'cam1:ArrayCallbacks': ['Disable', 'Enable'],
+    'cam1:AcquireTimeAuto': ['Off', 'Once', 'Continuous'],
+    'cam1:TriggerSource': ['Line0', 'Line1', 'Line2', 'Line3', 'Software'],
+    'cam1:TriggerOverlap': ['Off', 'ReadOut'],
+    'cam1:ExposureMode': ['Timed', 'TriggerWidth'],
+    'cam1:TriggerSelector': ['FrameStart', 'FrameBurstStart'],
+    'cam1:TriggerActivation': ['RisingEdge', 'FallingEdge'],
+    'image1:EnableCallbacks': ['Disable', 'Enable'],
+    'HDF1:AutoSave': ['No', 'Yes'],
+    'HDF1:DeleteDriverFile': ['No', 'Yes'],
+    'HDF1:EnableCallbacks': ['Disable', 'Enable'],
+    'HDF1:BlockingCallbacks': ['No', 'Yes'],
+    'HDF1:FileWriteMode': ['Single', 'Capture', 'Stream'],
+    'Proc1:EnableCallbacks': ['Disable', 'Enable'],
+    'Proc1:EnableFilter': ['Disable', 'Enable'],
+    'Proc1:FilterType': ['RecursiveAve', 'Average', 'Sum', 'Difference', 'RecursiveAveDiff', 'CopyToFilter'],
+    'Proc1:AutoResetFilter': ['No', 'Yes'],
+    'Proc1:FilterCallbacks': ['Every array', 'Array N only'],
+    'Proc1:EnableBackground': ['Disable', 'Enable'],
+    'Proc1:EnableFlatField': ['Disable', 'Enable'],
+    'Proc1:EnableOffsetScale': ['Disable', 'Enable'],
+    'Proc1:EnableLowClip': ['Disable', 'Enable'],
+    'Proc1:EnableHighClip': ['Disable', 'Enable'],
+    }
+
+_ioc = None
+
+
+def PV(pvname, **kws):
+
+    # same call signature as epics.PV so init_general_PVs can create its pv's from either backend
+    return get_ioc().pv(pvname)
+
+
+def get_ioc():
+
+    global _ioc
+    if _ioc is None:
+        _ioc = SimIOC()
+    return _ioc
+
+
+def _later(delay, function, *args):
+
+    timer = threading.Timer(delay, function, args)
+    timer.daemon = True
+    timer.start()
+
+
+def trapezoid(distance, velo, accl):
+    """
+    Trapezoidal velocity profile of a move.
+
+    Parameters
+    ----------
+    distance : float
+        Move length (EGU)
+    velo : float
+        Slew speed (EGU/s)
+    accl : float
+        Time to reach the slew speed (s), as in the motor record ACCL field
+
+    Returns
+    -------
+    float, function
+        Move duration (s) and the travelled distance as a function of the time from the start of the move
+    """
+    distance = abs(distance)
+    if velo <= 0 or distance == 0:
+        return 0.0, lambda t: distance
+    accl = max(accl, 1e-6)
+    a = velo / accl
+    t_acc = accl
+    if velo * accl > distance:
+        # the slew speed is never reached
+        t_acc = np.sqrt(distance / a)
+    v_max = a * t_acc
+    d_acc = 0.5 * a * t_acc**2
+    t_flat = (distance - 2 * d_acc) / v_max
+    duration = 2 * t_acc + t_flat
+
+    def travelled(t):
+        if t <= 0:
+            return 0.0
+        if t < t_acc:
+            return 0.5 * a * t**2
+        if t < t_acc + t_flat:
+            return d_acc + v_max * (t - t_acc)
+        if t < duration:
+            return distance - 0.5 * a * (duration - t)**2
+        return distance
+
+    return duration, travelled
+
+
+class SimPV(object):
+    """Minimal epics.PV look-alike holding its value in the simulated IOC."""
+
+    def __init__(self, pvname, value=0, enum_strs=None, on_put=None, on_get=None):
+        self.pvname = pvname
+        self.value = value
+        self.enum_strs = enum_strs
+        self.on_put = on_put
+        self.on_get = on_get
+        self.connected = True
+        self.put_complete = True
+        self.callbacks = {}
+        self.connection_callbacks = []
+
+    def wait_for_connection(self, timeout=None):
+        return True
+
+    def get(self, count=None, as_string=False, **kws):
+        value = self.on_get() if self.on_get is not None else self.value
+        if as_string:
+            if self.enum_strs is not None and isinstance(value, int) and 0 <= value < len(self.enum_strs):
+                return self.enum_strs[value]
+            return str(value)
+        if count is not None and isinstance(value, np.ndarray):
+            return value[:count]
+        return value
+
+    def put(self, value, wait=False, timeout=30.0, use_complete=False, callback=None, callback_data=None):
+        value = self._convert(value)
+        done = threading.Event()
+
+        def complete():
+            self.put_complete = True
+            done.set()
+            if callback is not None:
+                callback(pvname=self.pvname, data=callback_data)
+
+        self.put_complete = False
+        if self.on_put is None:
+            self.post(value)
+            complete()
+        else:
+            self.on_put(self, value, complete)
+        if wait and not done.wait(timeout):
+            return -1
+        return 1
+
+    def post(self, value):
+        # update the value and run the monitor callbacks
+        self.value = value
+        kws = {'pvname': self.pvname, 'value': value, 'status': 0, 'timestamp': time.time()}
+        if not isinstance(value, np.ndarray):
+            kws['char_value'] = self.get(as_string=True)
+        for index, (callback, kw) in list(self.callbacks.items()):
+            args = dict(kws, cb_info=(index, self))
+            args.update(kw)
+            callback(**args)
+
+    def add_callback(self, callback=None, index=None, run_now=False, with_ctrlvars=True, **kw):
+        if index is None:
+            index = 1 + max(list(self.callbacks) + [0])
+        self.callbacks[index] = (callback, kw)
+        if run_now:
+            callback(pvname=self.pvname, value=self.value, cb_info=(index, self), **kw)
+        return index
+
+    def remove_callback(self, index=None):
+        self.callbacks.pop(index, None)
+
+    def _convert(self, value):
+        if self.enum_strs is not None:
+            if isinstance(value, str):
+                if value in self.enum_strs:
+                    return self.enum_strs.index(value)
+                try:
+                    return int(value)
+                except ValueError:
+                    log.error('  *** sim: %s is not a valid value for %s' % (value, self.pvname))
+                    return self.value
+            return int(value)
+        try:
+            if isinstance(self.value, float):
+                return float(value)
+            if isinstance(self.value, int):
+                return int(float(value))
+        except (TypeError, ValueError):
+            pass
+        return value
+
+
+class SimMotor(object):
+    """Motor record moving with a trapezoidal velocity profile."""
+
+    def __init__(self, name):
+        self.name = name
+        self.position = 0.0
+        self.move_id = 0
+        self.lock = threading.Lock()
+        self.fields = {
+            'VAL': SimPV(name + '.VAL', 0.0, on_put=self._put_val),
+            'RBV': SimPV(name + '.RBV', 0.0),
+            'VELO': SimPV(name + '.VELO', MOTOR_VELO),
+            'ACCL': SimPV(name + '.ACCL', MOTOR_ACCL),
+            'STOP': SimPV(name + '.STOP', 0, on_put=self._put_stop),
+            'SET': SimPV(name + '.SET', 0),
+            'CNEN': SimPV(name + '.CNEN', 1),
+            'DMOV': SimPV(name + '.DMOV', 1),
+            'DESC': SimPV(name + '.DESC', 'sim ' + name),
+            }
+
+    def pv(self, field):
+        if field not in self.fields:
+            self.fields[field] = SimPV('%s.%s' % (self.name, field), 0)
+        return self.fields[field]
+
+    def _put_val(self, pv, value, complete):
+        pv.post(value)
+        self.move(value, self.fields['VELO'].value, self.fields['ACCL'].value, complete)
+
+    def _put_stop(self, pv, value, complete):
+        if value:
+            with self.lock:
+                self.move_id += 1
+            self.fields['VAL'].post(self.position)
+            self.fields['DMOV'].post(1)
+        complete()
+
+    def move(self, target, velo, accl, complete=None):
+        with self.lock:
+            self.move_id += 1
+            move_id = self.move_id
+        start = self.position
+        direction = 1 if target >= start else -1
+        duration, travelled = trapezoid(target - start, velo, accl)
+        self.fields['DMOV'].post(0)
+
+        def run():
+            t0 = time.time()
+            while self.move_id == move_id:
+                t = time.time() - t0
+                self.position = start + direction * travelled(t)
+                self.fields['RBV'].post(self.position)
+                if t >= duration:
+                    self.fields['DMOV'].post(1)
+                    break
+                time.sleep(min(MOTOR_UPDATE, duration - t))
+            if complete is not None:
+                complete()
+
+        threading.Thread(target=run, daemon=True).start()
+        return move_id
+
+
+class SimPSO(object):
+    """PSO fly scan controller: taxi, fly and one trigger every scanDelta degrees."""
+
+    def __init__(self, ioc, name):
+        self.ioc = ioc
+        self.name = name
+        self.motor = ioc.motor(PSO_MOTORS.get(name, name + ':motor'))
+        self.fields = {
+            'startPos': SimPV(name + ':startPos', 0.0, on_put=self._put_setting),
+            'endPos': SimPV(name + ':endPos', 180.0, on_put=self._put_setting),
+            'slewSpeed': SimPV(name + ':slewSpeed', 1.0, on_put=self._put_setting),
+            'scanDelta': SimPV(name + ':scanDelta', 0.12, on_put=self._put_setting),
+            'scanControl': SimPV(name + ':scanControl', 'Standard'),
+            'numTriggers': SimPV(name + ':numTriggers', 1500),
+            'taxi': SimPV(name + ':taxi', 0, on_put=self._put_taxi),
+            'fly': SimPV(name + ':fly', 0, on_put=self._put_fly),
+            'motorPos.AVAL': SimPV(name + ':motorPos.AVAL', np.zeros(0)),
+            'motorPos.NORD': SimPV(name + ':motorPos.NORD', 0),
+            }
+
+    def pv(self, field):
+        if field not in self.fields:
+            self.fields[field] = SimPV('%s:%s' % (self.name, field), 0)
+        return self.fields[field]
+
+    def _value(self, field):
+        return float(self.fields[field].value)
+
+    def _direction(self):
+        return 1 if self._value('endPos') >= self._value('startPos') else -1
+
+    def _accel_distance(self):
+        return 0.5 * self._value('slewSpeed') * self.motor.fields['ACCL'].value
+
+    def _put_setting(self, pv, value, complete):
+        pv.post(value)
+
+        def calc():
+            delta = self._value('scanDelta')
+            if delta > 0:
+                self.fields['numTriggers'].post(int(round(abs(self._value('endPos') - self._value('startPos')) / delta)))
+
+        _later(PSO_CALC_DELAY, calc)
+        complete()
+
+    def _put_taxi(self, pv, value, complete):
+        if not value:
+            complete()
+            return
+        pv.post(1)
+        target = self._value('startPos') - self._direction() * self._accel_distance()
+
+        def done():
+            pv.post(0)
+            complete()
+
+        self.motor.move(target, self.motor.fields['VELO'].value, self.motor.fields['ACCL'].value, done)
+
+    def _put_fly(self, pv, value, complete):
+        if not value:
+            complete()
+            return
+        pv.post(1)
+        start = self._value('startPos')
+        delta = self._value('scanDelta')
+        slew_speed = self._value('slewSpeed')
+        direction = self._direction()
+        accl = self.motor.fields['ACCL'].value
+        num_triggers = int(self.fields['numTriggers'].value)
+        positions = start + direction * delta * np.arange(num_triggers)
+        target = self._value('endPos') + direction * self._accel_distance()
+
+        def done():
+            pv.post(0)
+            complete()
+
+        t0 = time.time()
+        move_id = self.motor.move(target, slew_speed, accl, done)
+        # the triggers start once the stage is at the slew speed, i.e. at startPos after the taxi move
+        trigger_times = t0 + accl + delta * np.arange(num_triggers) / slew_speed
+
+        def run():
+            num_triggered = 0
+            for trigger_time in trigger_times:
+                time.sleep(max(trigger_time - time.time(), 0))
+                if self.motor.move_id != move_id:
+                    break
+                self.ioc.trigger(trigger_time)
+                num_triggered += 1
+            self.fields['motorPos.AVAL'].post(positions[:num_triggered])
+            self.fields['motorPos.NORD'].post(num_triggered)
+
+        threading.Thread(target=run, daemon=True).start()
+
+
+class SimShutter(object):
+    """A or B shutter: the status pv follows the open/close command after SHUTTER_DELAY."""
+
+    def __init__(self, ioc, station):
+        self.status = SimPV(SHUTTER_STATUS[station], 0)
+        self.open = SimPV('2bma:%s_shutter:open.VAL' % station, 0, on_put=self._put_open)
+        self.close = SimPV('2bma:%s_shutter:close.VAL' % station, 0, on_put=self._put_close)
+
+    def _put_open(self, pv, value, complete):
+        pv.post(value)
+        if value:
+            _later(SHUTTER_DELAY, self.status.post, 1)
+        complete()
+
+    def _put_close(self, pv, value, complete):
+        pv.post(value)
+        if value:
+            _later(SHUTTER_DELAY, self.status.post, 0)
+        complete()
+
+
+class SimCamera(object):
+    """FLIR / Point Grey areaDetector with its image1, Proc1 and HDF1 plugins."""
+
+    def __init__(self, ioc, prefix):
+        self.ioc = ioc
+        self.prefix = prefix
+        self.lock = threading.RLock()
+        self.acquire_id = 0
+        self.triggers = queue.Queue()
+        self.proc_count = 0
+        self.hdf_queue = []
+        self.hdf_frames = []
+        self.hdf_complete = None
+        self.hdf_changed = threading.Condition(self.lock)
+        self.rng = np.random.default_rng()
+        nx, ny = CAMERA_SIZE
+        self.fields = {}
+        for field, value in (
+                ('cam1:Acquire', 0), ('cam1:ImageMode', 0), ('cam1:TriggerMode', 0), ('cam1:NumImages', 1),
+                ('cam1:AcquireTime', 0.1), ('cam1:AcquirePeriod', 0.1), ('cam1:FrameType', 0),
+                ('cam1:FrameType.ZRST', '/exchange/data'), ('cam1:FrameType.ONST', '/exchange/data_dark'),
+                ('cam1:FrameType.TWST', '/exchange/data_white'), ('cam1:SerialNumber_RBV', 'SIM-' + prefix[:-1]),
+                ('cam1:SizeX', nx), ('cam1:SizeY', ny), ('cam1:SizeX_RBV', nx), ('cam1:SizeY_RBV', ny),
+                ('cam1:MaxSizeX_RBV', nx), ('cam1:MaxSizeY_RBV', ny), ('cam1:BinX', 1), ('cam1:BinY', 1), ('cam1:PixelFormat_RBV', 1),
+                ('cam1:ArrayCounter_RBV', 0), ('cam1:NumImagesCounter_RBV', 0), ('cam1:NDAttributesFile', ''),
+                ('image1:ArrayCounter_RBV', 0), ('image1:EnableCallbacks', 1),
+                ('HDF1:Capture', 0), ('HDF1:Capture_RBV', 0), ('HDF1:NumCapture', 0), ('HDF1:NumCaptured_RBV', 0),
+                ('HDF1:FilePath', '/tmp/'), ('HDF1:FileName', 'sim'), ('HDF1:FileNumber', 0),
+                ('HDF1:FileTemplate', '%s%s_%3.3d.h5'), ('HDF1:FullFileName_RBV', ''), ('HDF1:XMLFileName', ''),
+                ('HDF1:QueueSize', HDF_QUEUE_SIZE), ('HDF1:QueueFree', HDF_QUEUE_SIZE), ('HDF1:DroppedArrays_RBV', 0),
+                ('HDF1:NDArrayPort', prefix[-4:-1]), ('Proc1:NDArrayPort', prefix[-4:-1]), ('Proc1:NumFilter', 1),
+                ):
+            self.fields[field] = SimPV(prefix + field, value, ENUMS.get(field))
+        self.fields['cam1:Acquire'].on_put = self._put_acquire
+        self.fields['cam1:SoftwareTrigger'] = SimPV(prefix + 'cam1:SoftwareTrigger', 0, on_put=self._put_software_trigger)
+        self.fields['image1:ArrayData'] = SimPV(prefix + 'image1:ArrayData', on_get=self.image)
+        self.fields['HDF1:Capture'].on_put = self._put_capture
+        self.fields['HDF1:DroppedArrays'] = SimPV(prefix + 'HDF1:DroppedArrays', 0, on_put=self._put_dropped_arrays)
+
+    def pv(self, field):
+        if field not in self.fields:
+            self.fields[field] = SimPV(self.prefix + field, 0, ENUMS.get(field))
+        return self.fields[field]
+
+    def _value(self, field, as_string=False):
+        return self.fields[field].get(as_string=as_string) if field in self.fields else None
+
+    # detector
+
+    def _put_acquire(self, pv, value, complete):
+        with self.lock:
+            self.acquire_id += 1
+            acquire_id = self.acquire_id
+        if not value:
+            pv.post(0)
+            complete()
+            return
+        pv.post(1)
+        self.fields['cam1:NumImagesCounter_RBV'].post(0)
+        while not self.triggers.empty():
+            self.triggers.get()
+        threading.Thread(target=self._acquire, args=(acquire_id, complete), daemon=True).start()
+
+    def _put_software_trigger(self, pv, value, complete):
+        if value:
+            self.trigger(time.time())
+        complete()
+
+    def trigger(self, trigger_time):
+        if self.fields['cam1:Acquire'].value and self._value('cam1:TriggerMode', True) in ('Overlapped', 'On'):
+            self.triggers.put(trigger_time)
+
+    def _acquire(self, acquire_id, complete):
+        image_mode = self._value('cam1:ImageMode', True)
+        num_images = {'Single': 1, 'Multiple': int(self._value('cam1:NumImages'))}.get(image_mode, np.inf)
+        triggered = self._value('cam1:TriggerMode', True) in ('Overlapped', 'On')
+        exposure = float(self._value('cam1:AcquireTime'))
+        period = max(exposure + CAMERA_READOUT, float(self._value('cam1:AcquirePeriod')))
+        busy_until = 0
+        count = 0
+        while count < num_images and self.acquire_id == acquire_id:
+            if triggered:
+                try:
+                    trigger_time = self.triggers.get(timeout=0.1)
+                except queue.Empty:
+                    continue
+                if trigger_time < busy_until:
+                    # trigger received during the previous exposure / readout: the frame is lost
+                    continue
+                busy_until = trigger_time + exposure + CAMERA_READOUT
+                time.sleep(max(trigger_time + exposure - time.time(), 0))
+            else:
+                time.sleep(period)
+            if self.acquire_id != acquire_id:
+                break
+            self._frame()
+            count += 1
+        if self.acquire_id == acquire_id:
+            self.fields['cam1:Acquire'].post(0)
+        complete()
+
+    def _frame(self):
+        counter = self.fields['cam1:ArrayCounter_RBV'].value + 1
+        self.fields['cam1:ArrayCounter_RBV'].post(counter)
+        self.fields['cam1:NumImagesCounter_RBV'].post(self.fields['cam1:NumImagesCounter_RBV'].value + 1)
+        self.fields['image1:ArrayCounter_RBV'].post(counter)
+        if self._value('HDF1:NDArrayPort', True) == 'PROC1' and self._value('Proc1:EnableFilter', True) == 'Enable':
+            # recursive filter with 'Array N only' callbacks
+            self.proc_count += 1
+            if self.proc_count % max(int(self._value('Proc1:NumFilter')), 1):
+                return
+        self._hdf_receive(int(self._value('cam1:FrameType')), time.time(), counter)
+
+    def image(self):
+        nx = int(self._value('cam1:SizeX'))
+        ny = int(self._value('cam1:SizeY'))
+        img = np.full((ny, nx), DARK_LEVEL, dtype=np.float32)
+        if self.ioc.beam_on():
+            img += FLAT_LEVEL
+            stage = self.ioc.stage()
+            if stage is not None:
+                pos = dict((axis, self.ioc.motor(name).position) for axis, name in stage.items())
+                theta = np.deg2rad(pos['rot'])
+                # sphere sitting on the top stages, seen from the detector
+                cx = nx / 2.0 + (pos['x'] + pos['top_0'] * np.cos(theta) + pos['top_90'] * np.sin(theta)) * 1000.0 / PIXEL_SIZE
+                cy = ny / 2.0 - pos['y'] * 1000.0 / PIXEL_SIZE
+                r = SPHERE_RADIUS * 1000.0 / PIXEL_SIZE
+                y, x = np.ogrid[:ny, :nx]
+                d2 = ((x - cx)**2 + (y - cy)**2) / r**2
+                inside = d2 < 1
+                img[inside] -= FLAT_LEVEL * (1 - np.exp(-2 * np.sqrt(1 - d2[inside])))
+        img += self.rng.normal(0, NOISE_LEVEL, img.shape).astype(np.float32)
+        max_value = 255 if self._value('cam1:PixelFormat_RBV', True) == 'Mono8' else 65535
+        return np.clip(img, 0, max_value).astype(np.uint16).ravel()
+
+    # HDF5 file writer
+
+    def _put_dropped_arrays(self, pv, value, complete):
+        pv.post(value)
+        self.fields['HDF1:DroppedArrays_RBV'].post(value)
+        complete()
+
+    def _put_capture(self, pv, value, complete):
+        pv.post(value)
+        if not value:
+            self._hdf_close()
+            complete()
+            return
+        with self.lock:
+            template = self._value('HDF1:FileTemplate', True)
+            fullname = template % (self._value('HDF1:FilePath', True), self._value('HDF1:FileName', True), int(self._value('HDF1:FileNumber')))
+            self.hdf_queue = []
+            self.hdf_frames = []
+            self.hdf_complete = complete
+            self.fields['HDF1:FullFileName_RBV'].post(fullname)
+            self.fields['HDF1:NumCaptured_RBV'].post(0)
+            self.fields['HDF1:QueueFree'].post(int(self._value('HDF1:QueueSize')))
+            self.fields['HDF1:Capture_RBV'].post(1)
+        threading.Thread(target=self._hdf_write, daemon=True).start()
+
+    def _hdf_receive(self, frame_type, timestamp, unique_id):
+        with self.lock:
+            if not self.fields['HDF1:Capture_RBV'].value:
+                return
+            if len(self.hdf_queue) >= int(self._value('HDF1:QueueSize')):
+                self.fields['HDF1:DroppedArrays_RBV'].post(self.fields['HDF1:DroppedArrays_RBV'].value + 1)
+                return
+            self.hdf_queue.append((frame_type, timestamp, unique_id))
+            self.fields['HDF1:QueueFree'].post(int(self._value('HDF1:QueueSize')) - len(self.hdf_queue))
+            self.hdf_changed.notify()
+
+    def _hdf_write(self):
+        while True:
+            with self.lock:
+                while self.fields['HDF1:Capture_RBV'].value and not self.hdf_queue:
+                    self.hdf_changed.wait()
+                if not self.fields['HDF1:Capture_RBV'].value:
+                    return
+            time.sleep(1.0 / HDF_WRITE_RATE)
+            with self.lock:
+                if not self.fields['HDF1:Capture_RBV'].value:
+                    return
+                self.hdf_frames.append(self.hdf_queue.pop(0))
+                self.fields['HDF1:QueueFree'].post(int(self._value('HDF1:QueueSize')) - len(self.hdf_queue))
+                num_captured = len(self.hdf_frames)
+                self.fields['HDF1:NumCaptured_RBV'].post(num_captured)
+                num_capture = int(self._value('HDF1:NumCapture'))
+            if num_capture > 0 and num_captured >= num_capture:
+                self._hdf_close()
+                return
+
+    def _hdf_close(self):
+        with self.lock:
+            if not self.fields['HDF1:Capture_RBV'].value:
+                return
+            self._hdf_save(self._value('HDF1:FullFileName_RBV', True), self.hdf_frames)
+            self.fields['HDF1:Capture'].post(0)
+            self.fields['HDF1:Capture_RBV'].post(0)
+            self.fields['HDF1:FileNumber'].post(int(self._value('HDF1:FileNumber')) + 1)
+            self.hdf_changed.notify_all()
+            complete, self.hdf_complete = self.hdf_complete, None
+        if complete is not None:
+            complete()
+
+    def _hdf_save(self, fullname, frames):
+        # empty (unallocated) datasets with the frame counts and the per frame attributes
+        if not os.path.isdir(os.path.dirname(fullname)):
+            return
+        nx = int(self._value('cam1:SizeX'))
+        ny = int(self._value('cam1:SizeY'))
+        try:
+            with h5py.File(fullname, 'w') as hdf_file:
+                frame_types = np.array([frame[0] for frame in frames], dtype=int)
+                for frame_type, field in enumerate(('cam1:FrameType.ZRST', 'cam1:FrameType.ONST', 'cam1:FrameType.TWST')):
+                    num_frames = int(np.sum(frame_types == frame_type))
+                    # extendible like the datasets of the HDF plugin, which also allows the empty ones of a scan without references
+                    hdf_file.create_dataset(self._value(field, True), (num_frames, ny, nx), dtype=np.uint16, chunks=(1, ny, nx), maxshape=(None, ny, nx))
+                hdf_file.create_dataset('/defaults/NDArrayTimeStamp', data=np.array([frame[1] for frame in frames], dtype=float))
+                hdf_file.create_dataset('/defaults/NDArrayUniqueId', data=np.array([frame[2] for frame in frames], dtype=int))
+                hdf_file.create_dataset('/defaults/NDArrayFrameType', data=frame_types)
+        except (OSError, ValueError) as e:
+            log.error('  *** sim: could not write %s: %s' % (fullname, e))
+
+
+class SimIOC(object):
+    """All the simulated pv's of the beamline, created on first use."""
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.pvs = {}
+        self.motors = {}
+        self.psos = {}
+        self.cameras = {}
+        self.shutters = {}
+
+    def pv(self, pvname):
+        with self.lock:
+            if pvname not in self.pvs:
+                self.pvs[pvname] = self._create_pv(pvname)
+            return self.pvs[pvname]
+
+    def motor(self, name):
+        with self.lock:
+            if name not in self.motors:
+                self.motors[name] = SimMotor(name)
+            return self.motors[name]
+
+    def camera(self, prefix):
+        with self.lock:
+            if prefix not in self.cameras:
+                self.cameras[prefix] = SimCamera(self, prefix)
+            return self.cameras[prefix]
+
+    def pso(self, name):
+        with self.lock:
+            if name not in self.psos:
+                self.psos[name] = SimPSO(self, name)
+            return self.psos[name]
+
+    def shutter(self, station):
+        with self.lock:
+            if station not in self.shutters:
+                self.shutters[station] = SimShutter(self, station)
+            return self.shutters[station]
+
+    def _create_pv(self, pvname):
+        match = re.match(r'^(.+:PSOFly\d*):(.+)$', pvname)
+        if match:
+            return self.pso(match.group(1)).pv(match.group(2))
+        match = re.match(r'^(.+:m\d+)\.(\w+)$', pvname)
+        if match:
+            return self.motor(match.group(1)).pv(match.group(2))
+        match = re.match(r'^(\w+:)((cam1|image1|HDF1|Proc1):.+)$', pvname)
+        if match:
+            return self.camera(match.group(1)).pv(match.group(2))
+        match = re.match(r'^2bma:(A|B)_shutter:(open|close)\.VAL$', pvname)
+        if match:
+            shutter = self.shutter(match.group(1))
+            return shutter.open if match.group(2) == 'open' else shutter.close
+        for station, status in SHUTTER_STATUS.items():
+            if pvname == status:
+                return self.shutter(station).status
+        if ':ExpInfo:' in pvname:
+            name = pvname.split(':')[-1].split('.')[0]
+            return SimPV(pvname, 'sim' if name in ('SampleName', 'FileName') else '')
+        return SimPV(pvname, 0)
+
+    def trigger(self, trigger_time):
+        for camera in list(self.cameras.values()):
+            camera.trigger(trigger_time)
+
+    def beam_on(self):
+        shutter_a = self.shutter('A').status.value and self.motor(FAST_SHUTTER).position > 0.5
+        return bool(shutter_a or self.shutter('B').status.value)
+
+    def stage(self):
+        for station, stage in STAGES.items():
+            if stage['rot'] in self.motors:
+                return stage
+        return None
@@ -117,6 +117,8 @@ def adjust(params):
 
                 config.update_sphere(params)
 
+            aps2bm.log_pv_pool_stats()
+
     except  KeyError:
         log.error('  *** Some PV assignment failed!')
         pass
@@ -0,0 +1,221 @@
+# #########################################################################
+# Copyright (c) 2019-2020, UChicago Argonne, LLC. All rights reserved.    #
+#                                                                         #
+# Copyright 2019-2020. UChicago Argonne, LLC. This software was produced  #
+# under U.S. Government contract DE-AC02-06CH11357 for Argonne National   #
+# Laboratory (ANL), which is operated by UChicago Argonne, LLC for the    #
+# U.S. Department of Energy. The U.S. Government has rights to use,       #
+# reproduce, and distribute this software.  NEITHER THE GOVERNMENT NOR    #
+# UChicago Argonne, LLC MAKES ANY WARRANTY, EXPRESS OR IMPLIED, OR        #
+# ASSUMES ANY LIABILITY FOR THE USE OF THIS SOFTWARE.  If software is     #
+# modified to produce derivative works, such modified software should     #
+# be clearly marked, so as not to confuse it with the version available   #
+# from ANL.                                                               #
+#                                                                         #
+# Additionally, redistribution and use in source and binary forms, with   #
+# or without modification, are permitted provided that the following      #
+# conditions are met:                                                     #
+#                                                                         #
+#     * Redistributions of source code must retain the above copyright    #
+#       notice, this list of conditions and the following disclaimer.     #
+#                                                                         #
+#     * Redistributions in binary form must reproduce the above copyright #
+#       notice, this list of conditions and the following disclaimer in   #
+#       the documentation and/or other materials provided with the        #
+#       distribution.                                                     #
+#                                                                         #
+#     * Neither the name of UChicago Argonne, LLC, Argonne National       #
+#       Laboratory, ANL, the U.S. Government, nor the names of its        #
+#       contributors may be used to endorse or promote products derived   #
+#       from this software without specific prior written permission.     #
+#                                                                         #
+# THIS SOFTWARE IS PROVIDED BY UChicago Argonne, LLC AND CONTRIBUTORS     #
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT       #
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS       #
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL UChicago     #
+# Argonne, LLC OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT,        #
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING,    #
+# BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;        #
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER        #
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT      #
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN       #
+# ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE         #
+# POSSIBILITY OF SUCH DAMAGE.                                             #
+# #########################################################################
+
+"""
+Per-phase timeline of the scans.
+
+Every phase of tomo_fly_scan (PSO setup and taxi, camera set, shutters, sample moves, fly scan, white
+and dark fields, HDF close) is timed with the monotonic clock, and so are the finalization steps run by
+the background worker (theta, references, config update and transfer). The timeline of each scan is
+saved as JSON in the timeline directory of logs-home once it is finalized; profile combines the saved
+timelines into percentiles per phase and the dead time between the phases.
+"""
+
+import os
+import glob
+import json
+import time
+import threading
+import contextlib
+from datetime import datetime
+
+import numpy as np
+
+from tomo2bm import log
+
+TIMELINE_DIR = 'timeline'
+PERCENTILES = (50, 90, 99)
+
+# timeline of the scan being acquired, None between scans
+_current = None
+_lock = threading.Lock()
+
+
+def start(params):
+    """Start the timeline of a new scan, returns it."""
+    global _current
+
+    _current = {'file_name': params.file_name, 'file': None, 'started': datetime.now().isoformat(),
+                'pid': os.getpid(), 't0': time.monotonic(), 'phases': []}
+    return _current
+
+
+def stop(fullname):
+    """Close the acquisition phases of the current scan, returns its timeline (None if none was started)."""
+    global _current
+
+    timeline, _current = _current, None
+    if timeline is not None:
+        timeline['file'] = fullname
+        with _lock:
+            timeline['acquired'] = time.monotonic() - timeline['t0']
+    return timeline
+
+
+@contextlib.contextmanager
+def phase(name, timeline=None, background=False):
+    """Time the block as phase *name* of *timeline*, the current scan by default."""
+    timeline = timeline if timeline is not None else _current
+    tic = time.monotonic()
+    try:
+        yield
+    finally:
+        if timeline is not None:
+            add(timeline, name, tic, time.monotonic(), background)
+
+
+def add(timeline, name, tic, toc, background=False):
+
+    # tic and toc are time.monotonic() values
+    with _lock:
+        timeline['phases'].append({'name': name, 'start': tic - timeline['t0'], 'end': toc - timeline['t0'], 'background': background})
+
+
+def timeline_dir(params):
+    return os.path.join(params.logs_home, TIMELINE_DIR)
+
+
+def save(params, timeline):
+
+    fname = os.path.join(timeline_dir(params), '%s_%s.json' % (datetime.strftime(datetime.now(), "%Y-%m-%d_%H_%M_%S"), timeline['file_name']))
+    try:
+        os.makedirs(timeline_dir(params), exist_ok=True)
+        with _lock:
+            with open(fname, 'w') as f:
+                json.dump(timeline, f, indent=2)
+    except OSError as e:
+        log.error('  *** Could not save the scan timeline in %s: %s' % (fname, e))
+        return None
+    return fname
+
+
+def read(params):
+    """The saved timelines, oldest first; with params.profile_last only the last ones."""
+    timelines = []
+    for fname in sorted(glob.glob(os.path.join(timeline_dir(params), '*.json'))):
+        try:
+            with open(fname) as f:
+                timelines.append(json.load(f))
+        except (OSError, ValueError) as e:
+            log.error('  *** Could not read %s: %s' % (fname, e))
+    if params.profile_last:
+        timelines = timelines[-params.profile_last:]
+    return timelines
+
+
+def dead_time(timeline):
+
+    # acquisition time not covered by any foreground phase
+    intervals = sorted((p['start'], p['end']) for p in timeline['phases'] if not p['background'])
+    covered = 0.0
+    end = 0.0
+    for tic, toc in intervals:
+        if toc > end:
+            covered += toc - max(tic, end)
+            end = toc
+    return max(timeline.get('acquired', end) - covered, 0.0)
+
+
+def summarize(timelines):
+    """
+    Combine scan timelines.
+
+    Returns
+    -------
+    list of dict
+        One entry per phase, in the order of their first occurrence, plus 'dead time' (acquisition time
+        outside the phases), 'between scans' (from the end of a scan to the start of the next one of the
+        same run: motor moves, sleep) and 'scan' (whole acquisition), with: name, background, scans, per-scan
+        durations (s, a phase occurring twice in a scan counts once with the sum), total (s), share of the
+        total acquisition time and the PERCENTILES of the per-scan durations.
+    """
+    durations = {}
+    background = {}
+    last = None
+    for timeline in timelines:
+        per_scan = {}
+        for p in timeline['phases']:
+            per_scan[p['name']] = per_scan.get(p['name'], 0.0) + p['end'] - p['start']
+            background[p['name']] = p['background']
+        per_scan['dead time'] = dead_time(timeline)
+        if last is not None and last.get('pid') == timeline.get('pid') and timeline['t0'] > last['t0']:
+            per_scan['between scans'] = timeline['t0'] - last['t0'] - last.get('acquired', 0.0)
+        per_scan['scan'] = timeline.get('acquired', 0.0)
+        background['dead time'] = background['between scans'] = background['scan'] = False
+        last = timeline
+        for name, duration in per_scan.items():
+            durations.setdefault(name, []).append(duration)
+
+    acquired = sum(durations.get('scan', [])) or 1.0
+    summary = []
+    for name, values in durations.items():
+        values = np.array(values)
+        entry = {'name': name, 'background': background[name], 'scans': len(values), 'total': float(values.sum()),
+                 'share': float(values.sum()) / acquired, 'mean': float(values.mean()), 'max': float(values.max())}
+        for q, value in zip(PERCENTILES, np.percentile(values, PERCENTILES)):
+            entry['p%d' % q] = float(value)
+        summary.append(entry)
+    return summary
+
+
+def profile(params):
+    """Log the percentiles of each phase over the saved timelines."""
+    timelines = read(params)
+    if not timelines:
+        log.warning('  *** No scan timeline in %s' % timeline_dir(params))
+        return None
+    summary = summarize(timelines)
+    log.info('  *** Profile of %d scans from %s to %s' % (len(timelines), timelines[0]['started'], timelines[-1]['started']))
+    header = '  *** *** %-16s %5s %9s %6s' + ' %8s' * (len(PERCENTILES) + 1)
+    row = '  *** *** %-16s %5d %9.2f %5.1f%%' + ' %8.3f' * (len(PERCENTILES) + 1)
+    log.info(header % (('phase', 'scans', 'total s', 'share') + tuple('p%d s' % q for q in PERCENTILES) + ('max s',)))
+    for background in (False, True):
+        if background:
+            log.info('  *** Finalization (runs during the next scan):')
+        for entry in summary:
+            if entry['background'] == background:
+                log.info(row % ((entry['name'], entry['scans'], entry['total'], 100 * entry['share'])
+                                + tuple(entry['p%d' % q] for q in PERCENTILES) + (entry['max'],)))
+    return summary